@@ -0,0 +1,108 @@
+"""SlackRendererのマイクロベンチマーク
+
+    python benchmarks/bench_renderer.py
+
+以前の実装 (sumで子要素を結合し、validateとpostprocessで2回走査する) と比較する。
+"""
+
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from marko import Markdown
+from marko.renderer import Renderer
+
+from suisei.slack_markdown.extensions import SLACK_EXTENSION
+from suisei.slack_markdown.renderer import SlackRenderer
+
+
+class LegacySlackRenderer(SlackRenderer):
+    render = Renderer.render
+
+    def render_children(self, element):
+        rendered = [self.render(child) for child in element.children]
+        rendered = list(filter(None, rendered))
+        rendered = map(lambda x: x if isinstance(x, list) else [x], rendered)
+        return sum(rendered, [])
+
+
+def legacy_postprocess(children: list) -> list:
+    if not SlackRenderer.validate(children):
+        raise ValueError("invalid")
+
+    rendered = []
+    rich_text_children = []
+    for child in children:
+        if child["type"] == "rich_text":
+            if len(rich_text_children) > 0:
+                rendered.append({"type": "rich_text", "elements": rich_text_children})
+            rendered.append(child)
+            rich_text_children = []
+        elif not child["type"].startswith("rich_text"):
+            rich_text_children.append(
+                {"type": "rich_text_section", "elements": [child]}
+            )
+        else:
+            rich_text_children.append(child)
+    if len(rich_text_children) > 0:
+        rendered.append({"type": "rich_text", "elements": rich_text_children})
+    return rendered
+
+
+DOCUMENTS = {
+    "list": "\n".join(
+        f"- item {i} with **bold** and `code`\n  - nested {i}" for i in range(5000)
+    ),
+    "paragraph": "\n\n".join(
+        f"Paragraph {i} " + "*lorem* ipsum ~~dolor~~ [link](https://example.com) " * 5
+        for i in range(5000)
+    ),
+    "long_paragraph": "  \n".join(
+        f"line {i} *lorem* ipsum ~~dolor~~" for i in range(5000)
+    ),
+}
+
+
+def _markdown(renderer) -> Markdown:
+    markdown = Markdown(renderer=renderer)
+    markdown.use(SLACK_EXTENSION)
+    return markdown
+
+
+def main():
+    for name, text in DOCUMENTS.items():
+        legacy = _markdown(LegacySlackRenderer)
+        current = _markdown(SlackRenderer)
+        # パースは共通なので描画のみを計測する
+        legacy_doc = legacy.parse(text)
+        current_doc = current.parse(text)
+
+        assert legacy_postprocess(legacy.render(legacy_doc)) == (
+            SlackRenderer.postprocess(current.render(current_doc))
+        )
+
+        legacy_time = min(
+            timeit.repeat(
+                lambda: legacy_postprocess(legacy.render(legacy_doc)),
+                number=1,
+                repeat=5,
+            )
+        )
+        current_time = min(
+            timeit.repeat(
+                lambda: SlackRenderer.postprocess(current.render(current_doc)),
+                number=1,
+                repeat=5,
+            )
+        )
+        print(
+            f"{name:15} legacy {legacy_time * 1000:8.1f}ms "
+            f"current {current_time * 1000:8.1f}ms "
+            f"x{legacy_time / current_time:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
 from suisei.main import main
 
-main()
+if __name__ == "__main__":
+    main()
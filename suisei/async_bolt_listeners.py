@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import traceback
+from typing import Coroutine, Literal, Set, Union
+
+from slack_bolt.context.async_context import AsyncBoltContext
+from slack_sdk.web.async_client import AsyncWebClient
+
+from .async_llm_slack_executor import start_model_streamer
+from .listener_utils import (
+    REJECTED_TEXT,
+    admission_reaction,
+    collect_messages,
+    generation_priority,
+    is_duplicated_event,
+    is_ignored,
+)
+from .generation_limiter import AdmissionStatus, GenerationLimiter
+from .llm_slack_executor import generation_limiter
+from .slack_utils import async_fetch_thread_replies
+
+
+# create_taskの戻り値は弱参照でしか保持されないため、完了するまで参照を持っておく
+_tasks: Set[asyncio.Task] = set()
+
+
+def _spawn(coro: Coroutine) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def _responder(
+    context: AsyncBoltContext,
+    payload: dict,
+    client: AsyncWebClient,
+    logger: logging.Logger,
+    type: Union[Literal["mention"], Literal["message"]],
+):
+    thread_ts: str | None = payload.get("thread_ts")
+    channel: str = payload["channel"]
+    user: str = payload["user"]
+    ts: str = payload["ts"]
+
+    logger.debug(payload)
+
+    if is_ignored(context, payload, type):
+        return
+
+    if await asyncio.to_thread(is_duplicated_event, payload, logger, type):
+        return
+
+    loop = asyncio.get_running_loop()
+
+    def fetch_replies(channel: str, thread_ts: str, oldest: str | None = None):
+        # Valkeyへのアクセスはスレッドで行い、Slack APIはイベントループで呼ぶ
+        return asyncio.run_coroutine_threadsafe(
+            async_fetch_thread_replies(client, channel, thread_ts, oldest=oldest),
+            loop,
+        ).result()
+
+    messages = await asyncio.to_thread(
+        collect_messages, context, payload, fetch_replies, logger, type
+    )
+    if messages is None:
+        return
+
+    await _load_locale(context, logger)
+
+    async def run():
+        try:
+            await start_model_streamer(
+                context=context,
+                logger=logger,
+                channel=channel,
+                thread_ts=thread_ts if thread_ts is not None else ts,
+                messages=messages,
+            )
+        except Exception as e:
+            await _report_error(client, logger, payload, e)
+        finally:
+            generation_limiter.done(user, channel)
+
+    # 待っていた生成はdoneを呼んだ側から開始されるため、イベントループに戻して実行する
+    status = generation_limiter.submit(
+        generation_priority(type),
+        user,
+        channel,
+        lambda: loop.call_soon_threadsafe(_spawn, run()),
+    )
+    await _notify_admission(client, logger, payload, status)
+
+
+async def _notify_admission(
+    client: AsyncWebClient,
+    logger: logging.Logger,
+    payload: dict,
+    status: AdmissionStatus,
+):
+    reaction = admission_reaction(status)
+    if reaction is None:
+        return
+
+    logger.info(f"Generation {status}: {generation_limiter.stats()}")
+
+    # 待たせている・受け付けなかったことをすぐに伝える
+    try:
+        await client.reactions_add(
+            channel=payload["channel"], timestamp=payload["ts"], name=reaction
+        )
+        if status == GenerationLimiter.REJECTED:
+            await client.chat_postMessage(
+                channel=payload["channel"],
+                text=REJECTED_TEXT,
+                thread_ts=payload.get("thread_ts") or payload["ts"],
+            )
+    except Exception as e:
+        logger.error(f"Failed to notify admission: {e}")
+
+
+async def _load_locale(context: AsyncBoltContext, logger: logging.Logger):
+    # set_localeミドルウェアは取得を遅らせているため、返信すると決まってから取得する
+    get_locale = context.get("get_locale")
+    if get_locale is None:
+        return
+
+    try:
+        context["locale"] = await get_locale()
+    except Exception as e:
+        logger.error(f"Failed to get locale: {e}")
+
+
+async def _report_error(
+    client: AsyncWebClient,
+    logger: logging.Logger,
+    payload: dict,
+    e: Exception,
+):
+    ex = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+    logger.error(ex)
+    await client.chat_postMessage(
+        channel=payload["channel"],
+        text=f"エラーが発生しました\n{ex}",
+        thread_ts=payload["ts"],
+    )
+
+
+async def _respond(
+    context: AsyncBoltContext,
+    payload: dict,
+    client: AsyncWebClient,
+    logger: logging.Logger,
+    type: Union[Literal["mention"], Literal["message"]],
+):
+    try:
+        await _responder(
+            context=context,
+            payload=payload,
+            client=client,
+            logger=logger,
+            type=type,
+        )
+    except Exception as e:
+        await _report_error(client, logger, payload, e)
+
+
+async def respond_to_app_mention(
+    context: AsyncBoltContext,
+    payload: dict,
+    client: AsyncWebClient,
+    logger: logging.Logger,
+):
+    await _respond(context, payload, client, logger, "mention")
+
+
+async def respond_to_message(
+    context: AsyncBoltContext,
+    payload: dict,
+    client: AsyncWebClient,
+    logger: logging.Logger,
+):
+    if payload.get("subtype") in ["message_changed", "message_deleted"]:
+        return
+
+    await _respond(context, payload, client, logger, "message")
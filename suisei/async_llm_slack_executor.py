@@ -0,0 +1,222 @@
+import asyncio
+import logging
+from typing import List, Tuple
+
+from slack_bolt.context.async_context import AsyncBoltContext
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+from slack_sdk.web.async_client import AsyncWebClient
+from google.genai.types import Content, FunctionCall, GroundingChunk
+
+from .env import (
+    GEMINI_MODEL,
+    SLACK_BOT_TOKEN,
+    SLACK_MESSAGE_MAX_BLOCKS,
+    SLACK_MESSAGE_MAX_CHARS,
+    SLACK_POST_BURST,
+    SLACK_POST_MAX_RETRY,
+    SLACK_POST_RATE,
+    SLACK_STREAM_MODE,
+    SLACK_UPDATE_RATE,
+    TOOL_MAX_STEPS,
+)
+from .llm_slack_executor import (
+    _finish_stream,
+    _generate_config,
+    _handle_chunk,
+    _prepare_turn,
+    _save_turn,
+    _should_call_tools,
+    _use_context_cache,
+    gemini,
+    history_planner,
+    thread_queue,
+    thread_registry,
+    tool_runner,
+)
+from .llm_utils import drop_function_calls, merge_model_contents
+from .slack_markdown.async_chunker import AsyncSlackChunker, AsyncSlackUpdatingChunker
+from .slack_markdown.chunker import SlackChunker
+from .slack_post_queue import AsyncSlackPostQueue
+
+# 投稿もイベントループで行い、チャンネルごとのタスクで順番に実行する
+post_client = AsyncWebClient(token=SLACK_BOT_TOKEN)
+post_client.retry_handlers.append(AsyncRateLimitErrorRetryHandler(max_retry_count=2))
+post_queue = AsyncSlackPostQueue(
+    rate=SLACK_POST_RATE,
+    burst=SLACK_POST_BURST,
+    max_retry=SLACK_POST_MAX_RETRY,
+)
+
+
+def _create_chunker(channel: str, thread_ts: str) -> SlackChunker:
+    if SLACK_STREAM_MODE == "update":
+        return AsyncSlackUpdatingChunker(
+            client=post_client,
+            channel=channel,
+            thread_ts=thread_ts,
+            post_queue=post_queue,
+            updates_per_second=SLACK_UPDATE_RATE,
+            max_blocks=SLACK_MESSAGE_MAX_BLOCKS,
+            max_chars=SLACK_MESSAGE_MAX_CHARS,
+        )
+
+    return AsyncSlackChunker(
+        client=post_client,
+        channel=channel,
+        thread_ts=thread_ts,
+        post_queue=post_queue,
+    )
+
+
+async def _model_streamer(
+    context: AsyncBoltContext,
+    logger: logging.Logger,
+    channel: str,
+    thread_ts: str,
+    messages: List[Content],
+    cached_content: str | None = None,
+) -> Tuple[List[Content], List[int]]:
+    """生成したContentと、そのトークン数を返す"""
+    chunker = _create_chunker(channel, thread_ts)
+    grounding_chunks: List[GroundingChunk] = []
+    replies: List[Content] = []
+    # repliesのContentごとのトークン数
+    reply_tokens: List[int] = []
+    previous_usage = None
+    contents = list(messages)
+
+    # 関数呼び出しがあれば、その結果を渡して生成を続ける
+    for step in range(TOOL_MAX_STEPS + 1):
+        response = await gemini.aio.models.generate_content_stream(
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=_generate_config(context, cached_content),
+        )
+
+        deltas: List[Content] = []
+        function_calls: List[FunctionCall] = []
+        usage = None
+        async for chunk in response:
+            usage = chunk.usage_metadata or usage
+            if _handle_chunk(
+                chunk, chunker, logger, deltas, function_calls, grounding_chunks
+            ):
+                break
+
+        history_planner.record_usage(usage, logger)
+        if step > 0:
+            # 関数の実行結果のトークン数は、プロンプトが増えた分から求める
+            reply_tokens.append(
+                history_planner.function_response_tokens(
+                    replies[-1], previous_usage, usage
+                )
+            )
+
+        turn = merge_model_contents(deltas)
+        call_tools = _should_call_tools(function_calls, step, logger)
+        if not call_tools:
+            # 実行しない関数呼び出しは応答がなく、履歴に残すとGeminiが受け付けない
+            turn = drop_function_calls(turn)
+
+        replies.extend(turn)
+        reply_tokens.extend(history_planner.reply_tokens(turn, usage))
+        if not call_tools:
+            break
+
+        # 関数の実行はブロックするため、スレッドで行う
+        tool_response = await asyncio.to_thread(tool_runner.run, function_calls)
+        replies.append(tool_response)
+        contents = contents + turn + [tool_response]
+        previous_usage = usage
+
+    _finish_stream(chunker, logger, grounding_chunks)
+    await chunker.wait()
+
+    return (replies, reply_tokens)
+
+
+async def _run_turn(
+    context: AsyncBoltContext,
+    logger: logging.Logger,
+    channel: str,
+    thread_ts: str,
+    history: List[dict],
+    pending: List[dict],
+):
+    # ファイルのダウンロードやValkeyへのアクセスはブロックするため、スレッドで行う
+    prepared = await asyncio.to_thread(
+        _prepare_turn, context, channel, thread_ts, history, pending
+    )
+    if prepared is None:
+        return
+
+    llm_messages, stored_count, tokens = prepared
+    cached_content, uncached_messages = await asyncio.to_thread(
+        _use_context_cache, context, channel, thread_ts, llm_messages, stored_count
+    )
+    reply, reply_tokens = await _model_streamer(
+        context=context,
+        logger=logger,
+        channel=channel,
+        thread_ts=thread_ts,
+        messages=uncached_messages,
+        cached_content=cached_content,
+    )
+    await asyncio.to_thread(
+        _save_turn,
+        channel,
+        thread_ts,
+        llm_messages,
+        stored_count,
+        reply,
+        tokens + reply_tokens,
+        pending,
+    )
+
+
+async def start_model_streamer(
+    context: AsyncBoltContext,
+    logger: logging.Logger,
+    channel: str,
+    thread_ts: str,
+    messages: List[dict],
+):
+    """llm_slack_executor.start_model_streamerのasyncio版"""
+    history, trigger = messages[:-1], messages[-1]
+
+    # 以降のスレッド内のメッセージに反応するために記録する
+    await asyncio.to_thread(thread_registry.join, channel, thread_ts)
+
+    # 同じスレッドで生成中であれば、そちらで次のターンとしてまとめて処理される
+    await asyncio.to_thread(thread_queue.push, channel, thread_ts, trigger)
+
+    while True:
+        lock = await asyncio.to_thread(thread_queue.acquire, channel, thread_ts)
+        if lock is None:
+            logger.info(f"Generation in progress, queued {trigger['ts']}")
+            return
+
+        try:
+            while True:
+                pending = await asyncio.to_thread(
+                    thread_queue.pop_all, channel, thread_ts
+                )
+                if len(pending) == 0:
+                    break
+
+                logger.info(f"Start turn with {len(pending)} messages")
+                await _run_turn(
+                    context=context,
+                    logger=logger,
+                    channel=channel,
+                    thread_ts=thread_ts,
+                    history=history,
+                    pending=pending,
+                )
+                await asyncio.to_thread(lock.reacquire)
+        finally:
+            await asyncio.to_thread(lock.release)
+
+        # ロックを解放する直前に積まれたメッセージを取りこぼさない
+        if not await asyncio.to_thread(thread_queue.has_pending, channel, thread_ts):
+            return
@@ -0,0 +1,56 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable
+
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_bolt.async_app import AsyncAck, AsyncApp, AsyncBoltContext
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler
+from slack_sdk.web.async_client import AsyncWebClient
+
+from .async_bolt_listeners import respond_to_app_mention, respond_to_message
+from .env import ASYNC_BLOCKING_WORKERS, SLACK_APP_TOKEN, SLACK_BOT_TOKEN
+from .listener_utils import user_cache
+
+
+async def set_locale(
+    context: AsyncBoltContext,
+    client: AsyncWebClient,
+    next_: Callable[[], Awaitable[None]],
+):
+    user_id = context.actor_user_id or context.user_id
+
+    # 無視するイベントでusers_infoを呼ばないよう、context["locale"]は返信する時に設定する
+    async def get_locale() -> str | None:
+        if user_id is None:
+            return None
+        return await user_cache.aget_locale(client, user_id)
+
+    context["get_locale"] = get_locale
+    await next_()
+
+
+async def just_ack(ack: AsyncAck):
+    await ack()
+
+
+async def async_main():
+    # asyncio.to_threadで使うスレッド数は、CPU数ではなく同時に扱う会話の数に合わせる
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=ASYNC_BLOCKING_WORKERS, thread_name_prefix="async-blocking"
+        )
+    )
+
+    app = AsyncApp(
+        token=SLACK_BOT_TOKEN,
+        process_before_response=False,
+    )
+
+    app.client.retry_handlers.append(AsyncRateLimitErrorRetryHandler(max_retry_count=2))
+    app.middleware(set_locale)
+
+    app.event("app_mention")(ack=just_ack, lazy=[respond_to_app_mention])
+    app.event("message")(ack=just_ack, lazy=[respond_to_message])
+
+    handler = AsyncSocketModeHandler(app, SLACK_APP_TOKEN)
+    await handler.start_async()
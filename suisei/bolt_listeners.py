@@ -1,12 +1,26 @@
 import logging
-import traceback
+from functools import partial
 from typing import Literal, Union
 
-from slack_bolt import BoltContext
+from slack_bolt import Ack, BoltContext
 from slack_sdk import WebClient
 
-from .llm_slack_executor import start_model_streamer
-from .slack_utils import is_this_app_mentioned, remove_unused_element
+from .listener_utils import (
+    collect_messages,
+    generation_priority,
+    is_duplicated_event,
+    is_ignored,
+    load_locale,
+    notify_admission,
+    report_error,
+)
+from .llm_slack_executor import (
+    generation_limiter,
+    job_queue,
+    start_model_streamer,
+    submit_generation,
+)
+from .slack_utils import fetch_thread_replies
 
 
 def _responder(
@@ -16,99 +30,48 @@ def _responder(
     logger: logging.Logger,
     type: Union[Literal["mention"], Literal["message"]],
 ):
-    thread_ts: str | None = payload.get("thread_ts")
-    text: str = payload["text"]
-    channel: str = payload["channel"]
-    user: str = payload["user"]
-    ts: str = payload["ts"]
-    cleaned_text = remove_unused_element(context, text)
-
     print(payload)
 
-    # 自分は無視
-    if user == context.bot_user_id:
+    if is_ignored(context, payload, type):
         return
 
-    # メンションで内容がない場合は無視
-    if type == "mention" and cleaned_text == "":
+    if is_duplicated_event(payload, logger, type):
         return
 
-    # メンションでない場合で、自分が言及されていたらメンションのハンドラーと重複するため無視
-    if type != "mention" and is_this_app_mentioned(context, text):
+    messages = collect_messages(
+        context, payload, partial(fetch_thread_replies, client), logger, type
+    )
+    if messages is None:
         return
 
-    if type == "message" and thread_ts is None:
-        # メッセージの場合、メンションがなければ無視
-        if not is_this_app_mentioned(context, text):
-            return
-
-    messages = []
+    load_locale(context, logger)
 
-    # スレッド内であれば過去の履歴を取得してLLMに渡す
-    if thread_ts is not None:
-        history = client.conversations_replies(
-            channel=channel,
-            ts=thread_ts,
-            include_all_metadata=True,
-        )
+    channel: str = payload["channel"]
+    user: str = payload["user"]
 
-        # 全件取得できていない場合はエラーを返す
-        if history["has_more"]:
-            client.chat_postMessage(
+    def run():
+        try:
+            start_model_streamer(
+                context=context,
+                client=client,
+                logger=logger,
                 channel=channel,
-                text="スレッドが長すぎます",
-                thread_ts=thread_ts,
-            )
-            return
-
-        # メンションでない場合、過去に自分がメンションされている・自分が発言しているメッセージを確認する
-        if type == "message":
-            has_mentioned = any(
-                is_this_app_mentioned(context, message["text"])
-                for message in history["messages"]
-            ) or any(
-                message["user"] == context.bot_user_id
-                for message in history["messages"]
+                thread_ts=payload.get("thread_ts") or payload["ts"],
+                messages=messages,
             )
-
-            # 見つからなければ関係ないスレッドなので無視
-            if not has_mentioned:
-                return
-
-            has_abort = any(
-                message["user"] != context.bot_user_id
-                and message["text"].strip() == "abort"
-                for message in history["messages"]
-            ) or any(
-                message["user"] == context.bot_user_id
-                and message.get("meta", {}).get("suichan_type") == "abort"
-                for message in history["messages"]
-            )
-
-            # abortがあれば無視
-            if has_abort:
-                return
-
-        # 過去のメッセージを投入する
-        for message in history["messages"]:
-            # ただしトリガーのメッセージは無視
-            if message["ts"] == ts:
-                continue
-
-            messages.append(message)
-
-    messages.append(payload)
-
-    logger.info(f"Input {len(messages)} messages")
-
-    start_model_streamer(
-        context=context,
-        client=client,
-        logger=logger,
-        channel=channel,
-        thread_ts=thread_ts if thread_ts is not None else ts,
-        messages=messages,
+        except Exception as e:
+            report_error(client, logger, payload, e)
+        finally:
+            generation_limiter.done(user, channel)
+
+    # 生成は上限を超えないよう別スレッドで行い、リスナーのスレッドはすぐに返す
+    status = generation_limiter.submit(
+        generation_priority(type),
+        user,
+        channel,
+        lambda: submit_generation(run),
     )
+    notify_admission(client, logger, payload, status)
 
 
 def respond_to_app_mention(
@@ -126,13 +89,7 @@ def respond_to_app_mention(
             type="mention",
         )
     except Exception as e:
-        ex = "".join(traceback.format_exception(type(e), e, e.__traceback__))
-        logger.error(ex)
-        client.chat_postMessage(
-            channel=payload["channel"],
-            text=f"エラーが発生しました\n{ex}",
-            thread_ts=payload["ts"],
-        )
+        report_error(client, logger, payload, e)
 
 
 def respond_to_message(
@@ -153,10 +110,47 @@ def respond_to_message(
             type="message",
         )
     except Exception as e:
-        ex = "".join(traceback.format_exception(type(e), e, e.__traceback__))
-        logger.error(ex)
-        client.chat_postMessage(
-            channel=payload["channel"],
-            text=f"エラーが発生しました\n{ex}",
-            thread_ts=payload["ts"],
-        )
+        report_error(client, logger, payload, e)
+
+
+def _enqueue(
+    ack: Ack,
+    context: BoltContext,
+    payload: dict,
+    logger: logging.Logger,
+    type: Union[Literal["mention"], Literal["message"]],
+):
+    try:
+        # 明らかに反応しないイベントはキューに積まない
+        if is_ignored(context, payload, type):
+            return
+
+        if is_duplicated_event(payload, logger, type):
+            return
+
+        event = {"type": type, "bot_user_id": context.bot_user_id, "payload": payload}
+        job_queue.push(event)
+    finally:
+        ack()
+
+
+def enqueue_app_mention(
+    ack: Ack,
+    context: BoltContext,
+    payload: dict,
+    logger: logging.Logger,
+):
+    _enqueue(ack, context, payload, logger, "mention")
+
+
+def enqueue_message(
+    ack: Ack,
+    context: BoltContext,
+    payload: dict,
+    logger: logging.Logger,
+):
+    if payload.get("subtype") in ["message_changed", "message_deleted"]:
+        ack()
+        return
+
+    _enqueue(ack, context, payload, logger, "message")
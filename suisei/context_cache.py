@@ -0,0 +1,157 @@
+import hashlib
+import json
+import logging
+import time
+from typing import List, Tuple
+
+from google.genai import Client
+from google.genai.types import (
+    Content,
+    CreateCachedContentConfig,
+    Tool,
+    UpdateCachedContentConfig,
+)
+from valkey import Valkey
+
+from .env import (
+    CONTEXT_CACHE_MIN_TOKENS,
+    CONTEXT_CACHE_REBUILD_TURNS,
+    CONTEXT_CACHE_TTL,
+    GEMINI_MODEL,
+    SYSTEM_TEXT,
+)
+from .valkey_client import get_valkey
+
+
+class GeminiContextCache:
+    """スレッドの会話の先頭部分をGeminiのCachedContentとして保持する
+
+    システムプロンプトと保存済みのターンをキャッシュし、以降のリクエストでは
+    キャッシュされていないターンだけを送る。キャッシュは使うたびに延長され、
+    スレッドが使われなくなるとCONTEXT_CACHE_TTLで期限切れになる。
+    """
+
+    def __init__(self, gemini: Client, valkey: Valkey | None = None):
+        self.gemini = gemini
+        self._valkey = valkey if valkey is not None else get_valkey()
+
+    @staticmethod
+    def _key(channel: str, thread_ts: str) -> str:
+        return f"cc:{channel}-{thread_ts}"
+
+    @staticmethod
+    def _hash(contents: List[Content]) -> str:
+        # システムプロンプトはテンプレートから作られるため、テンプレートで比較する
+        digest = hashlib.sha256(f"{GEMINI_MODEL}\n{SYSTEM_TEXT}".encode("utf-8"))
+        for content in contents:
+            digest.update(content.model_dump_json(exclude_none=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def _load(self, key: str) -> dict | None:
+        value = self._valkey.get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def _save(self, key: str, entry: dict):
+        self._valkey.set(key, json.dumps(entry), ex=CONTEXT_CACHE_TTL)
+
+    def _delete(self, name: str):
+        try:
+            self.gemini.caches.delete(name=name)
+        except Exception as e:
+            logging.warning(f"Failed to delete cached content {name}: {e}")
+
+    def get(
+        self,
+        channel: str,
+        thread_ts: str,
+        contents: List[Content],
+        stable_count: int,
+        system_instruction: Content,
+        tools: List[Tool],
+    ) -> Tuple[str | None, List[Content]]:
+        """キャッシュの名前と、キャッシュに含まれない残りのContentを返す
+
+        contentsの先頭stable_count個は以降のターンでも変わらないものとして扱う。
+        system_instructionは使い回されるため、現在時刻のように変わる内容を含めないこと。
+        キャッシュを使わない場合はNoneとcontentsをそのまま返す。
+        """
+        if CONTEXT_CACHE_MIN_TOKENS <= 0 or stable_count <= 0:
+            return (None, contents)
+
+        try:
+            return self._get(
+                channel, thread_ts, contents, stable_count, system_instruction, tools
+            )
+        except Exception as e:
+            logging.error(f"Failed to use cached content: {e}")
+            return (None, contents)
+
+    def _get(
+        self,
+        channel: str,
+        thread_ts: str,
+        contents: List[Content],
+        stable_count: int,
+        system_instruction: Content,
+        tools: List[Tool],
+    ) -> Tuple[str | None, List[Content]]:
+        key = self._key(channel, thread_ts)
+        entry = self._load(key)
+
+        if entry is not None:
+            count = entry["count"]
+            reusable = count <= stable_count and entry["hash"] == self._hash(
+                contents[:count]
+            )
+            # キャッシュ後のターンが増えるまでは作り直さない
+            if reusable and stable_count - count < CONTEXT_CACHE_REBUILD_TURNS:
+                if entry["name"] is None:
+                    return (None, contents)
+
+                try:
+                    self.gemini.caches.update(
+                        name=entry["name"],
+                        config=UpdateCachedContentConfig(ttl=f"{CONTEXT_CACHE_TTL}s"),
+                    )
+                except Exception as e:
+                    # 期限切れなどで使えなくなっていれば作り直す
+                    logging.warning(f"Failed to extend {entry['name']}: {e}")
+                else:
+                    self._save(key, entry)
+                    return (entry["name"], contents[count:])
+
+            elif entry["name"] is not None:
+                self._delete(entry["name"])
+
+        prefix = contents[:stable_count]
+        entry = {"hash": self._hash(prefix), "count": stable_count, "name": None}
+
+        # 最小トークン数に満たない場合はキャッシュできないため、そのことを記録する
+        tokens = self.gemini.models.count_tokens(
+            model=GEMINI_MODEL, contents=prefix
+        ).total_tokens
+        if tokens is None or tokens < CONTEXT_CACHE_MIN_TOKENS:
+            self._save(key, entry)
+            return (None, contents)
+
+        started_at = time.monotonic()
+        cached = self.gemini.caches.create(
+            model=GEMINI_MODEL,
+            config=CreateCachedContentConfig(
+                contents=prefix,
+                system_instruction=system_instruction,
+                tools=tools,
+                ttl=f"{CONTEXT_CACHE_TTL}s",
+                display_name=key,
+            ),
+        )
+        logging.info(
+            f"Created cached content {cached.name} with {tokens} tokens "
+            f"in {time.monotonic() - started_at:.2f}s"
+        )
+
+        entry["name"] = cached.name
+        self._save(key, entry)
+        return (cached.name, contents[stable_count:])
@@ -1,17 +1,190 @@
-from typing import List
+import json
+import logging
+from typing import List, Tuple
 from valkey import Valkey
 from google.genai.types import Content
 import pickle
 
-from .env import VALKEY_DB, VALKEY_HOST, VALKEY_PORT
+try:
+    import zstandard
+except ImportError:
+    # 依存関係に含まれているが、入っていなくても圧縮せずに保存できる
+    zstandard = None
+    logging.warning("zstandard is not installed, conversations are stored uncompressed")
+
+from .env import (
+    CONVERSATION_COMPRESS_MIN_SIZE,
+    CONVERSATION_MAX_TURNS,
+    CONVERSATION_TTL,
+)
+from .llm_utils import estimate_content_tokens, merge_model_contents
+from .valkey_client import get_valkey
+
+# 1ターンごとのエントリの形式
+# b"1j:" + JSON または b"1z:" + zstdで圧縮したJSON
+SCHEMA_VERSION = b"1"
+CODEC_JSON = b"j"
+CODEC_ZSTD = b"z"
+
+
+def encode_content(content: Content) -> bytes:
+    data = content.model_dump_json(exclude_none=True).encode("utf-8")
+
+    if zstandard is not None and len(data) >= CONVERSATION_COMPRESS_MIN_SIZE:
+        compressed = zstandard.ZstdCompressor().compress(data)
+        return SCHEMA_VERSION + CODEC_ZSTD + b":" + compressed
+
+    return SCHEMA_VERSION + CODEC_JSON + b":" + data
+
+
+def decode_content(value: bytes) -> Content:
+    version, codec, data = value[:1], value[1:2], value[3:]
+
+    if version != SCHEMA_VERSION or value[2:3] != b":":
+        raise ValueError(f"Unknown schema version: {value[:3]}")
+
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("zstandard is required to decode this conversation")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif codec != CODEC_JSON:
+        raise ValueError(f"Unknown codec: {codec}")
+
+    return Content.model_validate_json(data)
 
 
 class ConversationStore:
-    def __init__(self):
-        self._valkey = Valkey(host=VALKEY_HOST, port=VALKEY_PORT, db=VALKEY_DB)
+    def __init__(self, valkey: Valkey | None = None):
+        self._valkey = valkey if valkey is not None else get_valkey()
+
+    @staticmethod
+    def _key(channel: str, thread_ts: str) -> str:
+        return f"cv:v{SCHEMA_VERSION.decode()}:{channel}-{thread_ts}"
+
+    @staticmethod
+    def _last_ts_key(channel: str, thread_ts: str) -> str:
+        return f"{ConversationStore._key(channel, thread_ts)}:ts"
+
+    @staticmethod
+    def _tokens_key(channel: str, thread_ts: str) -> str:
+        return f"{ConversationStore._key(channel, thread_ts)}:tok"
+
+    @staticmethod
+    def _count_key(channel: str, thread_ts: str) -> str:
+        return f"{ConversationStore._key(channel, thread_ts)}:n"
+
+    @staticmethod
+    def _summary_key(channel: str, thread_ts: str) -> str:
+        return f"{ConversationStore._key(channel, thread_ts)}:summary"
+
+    @staticmethod
+    def _legacy_key(channel: str, thread_ts: str) -> str:
+        return f"cv:{channel}-{thread_ts}"
+
+    def get(
+        self, channel: str, thread_ts: str, last: int | None = None
+    ) -> List[Content] | None:
+        """保存されている会話を取得する。lastを指定すると最後のlastターンのみを返す"""
+        turns = self.get_turns(channel, thread_ts, last)
+        return turns[0] if turns is not None else None
+
+    def get_turns(
+        self, channel: str, thread_ts: str, last: int | None = None
+    ) -> Tuple[List[Content], List[int], int] | None:
+        """保存されている会話と、ターンごとのトークン数、最初のターンの通し番号を返す
+
+        通し番号は保存上限で古いターンが削除されても変わらない。
+        """
+        start = -last if last is not None and last > 0 else 0
+        with self._valkey.pipeline(transaction=False) as pipe:
+            pipe.lrange(self._key(channel, thread_ts), start, -1)
+            pipe.lrange(self._tokens_key(channel, thread_ts), start, -1)
+            pipe.llen(self._key(channel, thread_ts))
+            pipe.get(self._count_key(channel, thread_ts))
+            values, tokens, length, count = pipe.execute()
+
+        if len(values) == 0:
+            migrated = self._migrate(channel, thread_ts)
+            if migrated is None:
+                return None
+            contents = migrated[start:]
+            tokens = [estimate_content_tokens(content) for content in contents]
+            return (contents, tokens, len(migrated) - len(contents))
+
+        contents = [decode_content(value) for value in values]
+        tokens = [int(value) for value in tokens]
+
+        # トークン数を記録する前に保存されたターンは見積もり直す
+        missing = len(contents) - len(tokens)
+        if missing > 0:
+            tokens = [
+                estimate_content_tokens(content) for content in contents[:missing]
+            ] + tokens
+
+        # 通し番号を記録する前から保存されていた会話は、現在の長さを使う
+        total = max(int(count), length) if count is not None else length
+        return (contents, tokens, total - len(contents))
+
+    def get_summary(self, channel: str, thread_ts: str) -> dict | None:
+        """古いターンの要約。coveredは要約に含まれるターンの数、tokensは要約のトークン数"""
+        value = self._valkey.get(self._summary_key(channel, thread_ts))
+        return json.loads(value) if value is not None else None
+
+    def set_summary(
+        self, channel: str, thread_ts: str, covered: int, text: str, tokens: int
+    ):
+        key = self._summary_key(channel, thread_ts)
+        value = json.dumps({"covered": covered, "text": text, "tokens": tokens})
+        if CONVERSATION_TTL > 0:
+            self._valkey.set(key, value, ex=CONVERSATION_TTL)
+        else:
+            self._valkey.set(key, value)
+
+    def get_last_ts(self, channel: str, thread_ts: str) -> str | None:
+        """保存済みの会話に含まれる最後のSlackのメッセージのts"""
+        value = self._valkey.get(self._last_ts_key(channel, thread_ts))
+        return value.decode() if value is not None else None
+
+    def append(
+        self,
+        channel: str,
+        thread_ts: str,
+        messages: List[Content],
+        last_ts: str | None = None,
+        tokens: List[int] | None = None,
+    ):
+        """会話の末尾にターンを追加する
+
+        tokensはターンごとのトークン数。省略した場合は文字数から見積もる。
+        """
+        if len(messages) == 0:
+            return
+
+        key = self._key(channel, thread_ts)
+        tokens_key = self._tokens_key(channel, thread_ts)
+        count_key = self._count_key(channel, thread_ts)
+        last_ts_key = self._last_ts_key(channel, thread_ts)
+        if tokens is None:
+            tokens = [estimate_content_tokens(message) for message in messages]
+
+        with self._valkey.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *[encode_content(message) for message in messages])
+            pipe.rpush(tokens_key, *tokens)
+            pipe.incrby(count_key, len(messages))
+            if CONVERSATION_MAX_TURNS > 0:
+                pipe.ltrim(key, -CONVERSATION_MAX_TURNS, -1)
+                pipe.ltrim(tokens_key, -CONVERSATION_MAX_TURNS, -1)
+            if last_ts is not None:
+                pipe.set(last_ts_key, last_ts)
+            if CONVERSATION_TTL > 0:
+                for ttl_key in [key, tokens_key, count_key, last_ts_key]:
+                    pipe.expire(ttl_key, CONVERSATION_TTL)
+            pipe.execute()
 
-    def get(self, channel: str, thread_ts: str) -> List[Content] | None:
-        value = self._valkey.get(f"cv:{channel}-{thread_ts}")
+    def _migrate(self, channel: str, thread_ts: str) -> List[Content] | None:
+        # pickleで会話全体を保存していた古い形式を変換する
+        legacy_key = self._legacy_key(channel, thread_ts)
+        value = self._valkey.get(legacy_key)
 
         if value is None:
             return None
@@ -23,7 +196,9 @@ class ConversationStore:
         ):
             raise ValueError(f"Stored value is not valid")
 
-        return decoded
+        # ストリームの差分ごとに保存されていた形式も詰めて保存し直す
+        compacted = merge_model_contents(decoded)
+        self.append(channel, thread_ts, compacted)
+        self._valkey.delete(legacy_key)
 
-    def set(self, channel: str, thread_ts: str, messages: List[Content]):
-        self._valkey.set(f"cv:{channel}-{thread_ts}", pickle.dumps(messages))
+        return compacted
@@ -29,3 +29,118 @@ SLACK_APP_TOKEN = os.environ.get("SLACK_APP_TOKEN")
 VALKEY_HOST = os.environ.get("VALKEY_HOST", "valkey")
 VALKEY_PORT = int(os.environ.get("VALKEY_PORT", "6379"))
 VALKEY_DB = int(os.environ.get("VALKEY_DB", "0"))
+
+# 同一チャンネルへの投稿レート (件/秒) とバースト数
+SLACK_POST_RATE = float(os.environ.get("SLACK_POST_RATE", "1"))
+SLACK_POST_BURST = int(os.environ.get("SLACK_POST_BURST", "1"))
+SLACK_POST_MAX_RETRY = int(os.environ.get("SLACK_POST_MAX_RETRY", "3"))
+
+# post: chunkごとに新しいメッセージを投稿する
+# update: 1つのメッセージをchat_updateで更新していく
+SLACK_STREAM_MODE = os.environ.get("SLACK_STREAM_MODE", "post")
+SLACK_UPDATE_RATE = float(os.environ.get("SLACK_UPDATE_RATE", "1"))
+SLACK_MESSAGE_MAX_BLOCKS = int(os.environ.get("SLACK_MESSAGE_MAX_BLOCKS", "50"))
+SLACK_MESSAGE_MAX_CHARS = int(os.environ.get("SLACK_MESSAGE_MAX_CHARS", "12000"))
+
+# 会話の保存期間 (秒) と保存するターン数の上限。0以下の場合は無制限
+CONVERSATION_TTL = int(os.environ.get("CONVERSATION_TTL", str(60 * 60 * 24 * 30)))
+CONVERSATION_MAX_TURNS = int(os.environ.get("CONVERSATION_MAX_TURNS", "500"))
+# LLMに渡す保存済みのターン数。0以下の場合は全て
+CONVERSATION_LOAD_TURNS = int(os.environ.get("CONVERSATION_LOAD_TURNS", "0"))
+# このサイズ以上のターンはzstandardで圧縮する
+CONVERSATION_COMPRESS_MIN_SIZE = int(
+    os.environ.get("CONVERSATION_COMPRESS_MIN_SIZE", "1024")
+)
+
+VALKEY_MAX_CONNECTIONS = int(os.environ.get("VALKEY_MAX_CONNECTIONS", "20"))
+# コネクションプールが空くまで待つ時間 (秒)
+VALKEY_POOL_TIMEOUT = float(os.environ.get("VALKEY_POOL_TIMEOUT", "5"))
+VALKEY_SOCKET_TIMEOUT = float(os.environ.get("VALKEY_SOCKET_TIMEOUT", "5"))
+VALKEY_CONNECT_TIMEOUT = float(os.environ.get("VALKEY_CONNECT_TIMEOUT", "2"))
+VALKEY_RETRIES = int(os.environ.get("VALKEY_RETRIES", "3"))
+VALKEY_HEALTH_CHECK_INTERVAL = int(os.environ.get("VALKEY_HEALTH_CHECK_INTERVAL", "30"))
+# RESP3のclient trackingを使ったクライアント側キャッシュ
+VALKEY_CLIENT_CACHE = os.environ.get("VALKEY_CLIENT_CACHE", "false").lower() == "true"
+VALKEY_CLIENT_CACHE_SIZE = int(os.environ.get("VALKEY_CLIENT_CACHE_SIZE", "1000"))
+VALKEY_CLIENT_CACHE_TTL = int(os.environ.get("VALKEY_CLIENT_CACHE_TTL", "300"))
+
+# スレッドごとの生成ロックの有効期限 (秒)
+THREAD_LOCK_TIMEOUT = int(os.environ.get("THREAD_LOCK_TIMEOUT", "600"))
+
+# users_infoのキャッシュの件数と有効期限 (秒)
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "1000"))
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", "3600"))
+
+# スレッドの履歴をLLMに渡す際のトークン数の上限。0以下の場合は無制限
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "200000"))
+
+# Slackからファイルをダウンロードする際のタイムアウト (秒) と並列数
+SLACK_DOWNLOAD_TIMEOUT = float(os.environ.get("SLACK_DOWNLOAD_TIMEOUT", "30"))
+SLACK_DOWNLOAD_CONCURRENCY = int(os.environ.get("SLACK_DOWNLOAD_CONCURRENCY", "4"))
+
+# 画像の画素数の上限。超える画像は縮小する。0以下の場合は縮小しない
+MEDIA_MAX_PIXELS = int(os.environ.get("MEDIA_MAX_PIXELS", str(1568 * 1568)))
+# 画像を再エンコードする形式 (webp / jpeg) と品質
+MEDIA_IMAGE_FORMAT = os.environ.get("MEDIA_IMAGE_FORMAT", "webp").lower()
+MEDIA_IMAGE_QUALITY = int(os.environ.get("MEDIA_IMAGE_QUALITY", "85"))
+# PDFのページ数の上限。0以下の場合は無制限
+MEDIA_PDF_MAX_PAGES = int(os.environ.get("MEDIA_PDF_MAX_PAGES", "0"))
+# 前処理を行うスレッド数。0以下の場合は呼び出し元のスレッドで行う
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", "2"))
+# 前処理を待つ秒数。超えた場合は元のデータを送る
+MEDIA_TIMEOUT_SECONDS = float(os.environ.get("MEDIA_TIMEOUT_SECONDS", "30"))
+
+# sync: スレッドで動かす / async: asyncioで動かす (aiohttpが必要)
+SLACK_APP_MODE = os.environ.get("SLACK_APP_MODE", "sync")
+# asyncモードで、Valkeyへのアクセスやファイルの前処理などブロックする処理を行うスレッド数
+ASYNC_BLOCKING_WORKERS = int(os.environ.get("ASYNC_BLOCKING_WORKERS", "64"))
+
+# 同時に行う生成の数の上限。全体・ユーザー・チャンネルごとのいずれも0以下の場合は無制限
+GENERATION_MAX_CONCURRENCY = int(os.environ.get("GENERATION_MAX_CONCURRENCY", "8"))
+GENERATION_MAX_PER_USER = int(os.environ.get("GENERATION_MAX_PER_USER", "2"))
+GENERATION_MAX_PER_CHANNEL = int(os.environ.get("GENERATION_MAX_PER_CHANNEL", "4"))
+# 待たせる生成の数の上限。超えた場合は受け付けず、スレッドで再送を促す。0以下の場合は無制限
+GENERATION_MAX_QUEUE = int(os.environ.get("GENERATION_MAX_QUEUE", "0"))
+# 待たせる・受け付けない場合にトリガーのメッセージに付けるリアクション
+GENERATION_QUEUED_REACTION = os.environ.get(
+    "GENERATION_QUEUED_REACTION", "hourglass_flowing_sand"
+)
+GENERATION_REJECTED_REACTION = os.environ.get(
+    "GENERATION_REJECTED_REACTION", "no_entry_sign"
+)
+
+# all: 受信と生成を同じプロセスで行う / receiver: 受信してキューに積む / worker: キューから生成する
+SLACK_APP_ROLE = os.environ.get("SLACK_APP_ROLE", "all")
+# workerが同時に処理するジョブの数
+JOB_WORKER_CONCURRENCY = int(os.environ.get("JOB_WORKER_CONCURRENCY", "4"))
+# この時間 (秒) 以上処理が進んでいないジョブは他のworkerが引き継ぐ
+JOB_CLAIM_IDLE_SECONDS = int(os.environ.get("JOB_CLAIM_IDLE_SECONDS", "60"))
+# キューを待つ時間 (ミリ秒)。VALKEY_SOCKET_TIMEOUTより短くする
+JOB_READ_BLOCK_MS = int(os.environ.get("JOB_READ_BLOCK_MS", "2000"))
+JOB_STREAM_MAX_LEN = int(os.environ.get("JOB_STREAM_MAX_LEN", "10000"))
+
+# 同じイベントを重複して処理しないよう記録する期間 (秒)
+EVENT_DEDUP_TTL = int(os.environ.get("EVENT_DEDUP_TTL", str(60 * 60 * 24)))
+
+# 会話の先頭部分をCachedContentにする最小のトークン数。0以下の場合はキャッシュしない
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("CONTEXT_CACHE_MIN_TOKENS", "4096"))
+# CachedContentの有効期限 (秒)。使うたびに延長する
+CONTEXT_CACHE_TTL = int(os.environ.get("CONTEXT_CACHE_TTL", "600"))
+# キャッシュ後にこのターン数が追加されたらキャッシュを作り直す
+CONTEXT_CACHE_REBUILD_TURNS = int(os.environ.get("CONTEXT_CACHE_REBUILD_TURNS", "10"))
+
+# 保存済みの会話がHISTORY_TOKEN_BUDGETを超えた場合に残す割合
+HISTORY_KEEP_RATIO = float(os.environ.get("HISTORY_KEEP_RATIO", "0.5"))
+# 古いターンの要約に使うモデル
+HISTORY_SUMMARY_MODEL = os.environ.get("HISTORY_SUMMARY_MODEL", GEMINI_MODEL)
+
+# 1回の返信で関数を呼び出す回数の上限
+TOOL_MAX_STEPS = int(os.environ.get("TOOL_MAX_STEPS", "5"))
+# 関数を並列に実行する数と、1回の呼び出しのタイムアウト (秒)
+TOOL_CONCURRENCY = int(os.environ.get("TOOL_CONCURRENCY", "4"))
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", "30"))
+# 関数の結果のトークン数の上限。1文字を1トークンとして切り詰める
+TOOL_RESULT_MAX_TOKENS = int(os.environ.get("TOOL_RESULT_MAX_TOKENS", "20000"))
+# 同じ引数の呼び出しの結果を使い回す件数と期間 (秒)
+TOOL_CACHE_SIZE = int(os.environ.get("TOOL_CACHE_SIZE", "256"))
+TOOL_CACHE_TTL = int(os.environ.get("TOOL_CACHE_TTL", "300"))
@@ -0,0 +1,32 @@
+from valkey import Valkey
+
+from .env import EVENT_DEDUP_TTL
+from .valkey_client import get_valkey
+
+
+class EventDeduplicator:
+    """Slackのイベントの重複を除く
+
+    Slackは応答が遅いとイベントを再送し、1つのメンションはapp_mentionとmessageの
+    両方で届く。プロセスやレプリカをまたいで最初の1回だけを処理するために使う。
+    """
+
+    def __init__(self, valkey: Valkey | None = None, ttl: int = EVENT_DEDUP_TTL):
+        self._valkey = valkey if valkey is not None else get_valkey()
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(channel: str, ts: str, kind: str) -> str:
+        return f"ev:{channel}-{ts}-{kind}"
+
+    def claim(self, channel: str, ts: str, kind: str, owner: str | None = None) -> bool:
+        """初めての場合はTrueを返す。既に処理されていればFalseを返す
+
+        ownerを指定すると、同じownerによる再試行 (引き継いだジョブなど) はTrueを返す。
+        """
+        key = self._key(channel, ts, kind)
+        value = owner if owner is not None else "1"
+        if self._valkey.set(key, value, nx=True, ex=self.ttl):
+            return True
+
+        return owner is not None and self._valkey.get(key) == owner.encode()
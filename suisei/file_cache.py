@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import time
+from io import BytesIO
+from typing import List
+
+from google.genai import Client
+from google.genai.types import (
+    Blob,
+    Content,
+    FileData,
+    FileState,
+    Part,
+    UploadFileConfig,
+)
+from valkey import Valkey
+
+from .env import CONVERSATION_TTL
+from .slack_utils import download_slack_image_content, process_media
+from .valkey_client import get_valkey
+
+# 期限切れ直前のファイルは使わずにアップロードし直す
+EXPIRATION_MARGIN_SECONDS = 60 * 60
+# アップロードしたファイルが使えるようになるまで待つ時間
+UPLOAD_ACTIVE_TIMEOUT_SECONDS = 60
+
+
+class GeminiFileCache:
+    """SlackのファイルをGemini Files APIにアップロードし、そのURIをキャッシュする
+
+    Slackのファイルidと内容のハッシュの両方をキーにするため、同じファイルを
+    何度もダウンロード・アップロードしない。アップロードできない場合はinline_dataで送る。
+    """
+
+    def __init__(self, gemini: Client, valkey: Valkey | None = None):
+        self.gemini = gemini
+        self._valkey = valkey if valkey is not None else get_valkey()
+
+    @staticmethod
+    def _file_key(file_id: str) -> str:
+        return f"gf:{file_id}"
+
+    @staticmethod
+    def _hash_key(sha256: str) -> str:
+        return f"gfh:{sha256}"
+
+    @staticmethod
+    def _uri_key(uri: str) -> str:
+        return f"gfu:{uri}"
+
+    def _load(self, key: str) -> dict | None:
+        value = self._valkey.get(key)
+        if value is None:
+            return None
+
+        entry = json.loads(value)
+        if entry.get("expires_at", 0) - EXPIRATION_MARGIN_SECONDS < time.time():
+            return None
+
+        return entry
+
+    def _save(self, key: str, entry: dict, ttl: int):
+        self._valkey.set(key, json.dumps(entry), ex=max(ttl, 1))
+
+    @staticmethod
+    def _part(entry: dict) -> Part:
+        return Part(
+            file_data=FileData(file_uri=entry["uri"], mime_type=entry["mime_type"])
+        )
+
+    def get_part(self, file: dict) -> Part:
+        file_id: str = file["id"]
+        url: str = file["url_private"]
+
+        entry = self._load(self._file_key(file_id))
+        if entry is not None:
+            return self._part(entry)
+
+        mime_type, data = download_slack_image_content(url)
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        entry = self._load(self._hash_key(sha256))
+
+        if entry is None:
+            mime_type, data = process_media(mime_type, data)
+            try:
+                entry = self._upload(data, mime_type, file_id)
+            except Exception as e:
+                logging.error(f"Failed to upload file {file_id}: {e}")
+                return Part(inline_data=Blob(data=data, mime_type=mime_type))
+
+            entry["sha256"] = sha256
+            ttl = int(entry["expires_at"] - time.time())
+            self._save(self._hash_key(sha256), entry, ttl)
+
+        # 期限が切れても取得し直せるよう、SlackのURLは会話と同じ期間保持する
+        entry = dict(entry, url=url)
+        self._save(self._file_key(file_id), entry, CONVERSATION_TTL)
+        self._valkey.set(self._uri_key(entry["uri"]), file_id, ex=CONVERSATION_TTL)
+
+        return self._part(entry)
+
+    def _upload(self, data: bytes, mime_type: str, file_id: str) -> dict:
+        uploaded = self.gemini.files.upload(
+            file=BytesIO(data),
+            config=UploadFileConfig(mime_type=mime_type, display_name=file_id),
+        )
+
+        deadline = time.monotonic() + UPLOAD_ACTIVE_TIMEOUT_SECONDS
+        while uploaded.state == FileState.PROCESSING:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"File {uploaded.name} is still processing")
+            time.sleep(1)
+            uploaded = self.gemini.files.get(name=uploaded.name)
+
+        if uploaded.state == FileState.FAILED:
+            raise ValueError(f"File {uploaded.name} failed to process")
+
+        expires_at = (
+            uploaded.expiration_time.timestamp()
+            if uploaded.expiration_time is not None
+            else time.time() + 60 * 60 * 24 * 2
+        )
+
+        return {
+            "uri": uploaded.uri,
+            "mime_type": uploaded.mime_type or mime_type,
+            "expires_at": expires_at,
+        }
+
+    def refresh(self, contents: List[Content]):
+        """保存済みの会話のうち、期限切れのファイルをアップロードし直す"""
+        for content in contents:
+            for i, part in enumerate(content.parts or []):
+                file_data = part.file_data
+                if file_data is None:
+                    continue
+
+                file_id = self._valkey.get(self._uri_key(file_data.file_uri))
+                if file_id is None:
+                    logging.warning(f"Unknown file {file_data.file_uri}")
+                    continue
+
+                file_id = file_id.decode()
+                entry = self._load(self._file_key(file_id))
+                if entry is not None and entry["uri"] == file_data.file_uri:
+                    continue
+
+                value = self._valkey.get(self._file_key(file_id))
+                if value is None:
+                    logging.warning(f"Unknown file {file_id}")
+                    continue
+
+                url = json.loads(value)["url"]
+                content.parts[i] = self.get_part({"id": file_id, "url_private": url})
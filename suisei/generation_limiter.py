@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter
+from typing import Callable, List, Literal, Tuple, Union
+
+AdmissionStatus = Union[Literal["started"], Literal["queued"], Literal["rejected"]]
+
+
+class GenerationLimiter:
+    """生成の同時実行数を制限し、溢れた生成を優先度順に待たせる
+
+    実行方法には関与せず、開始できるようになった生成のstartを呼ぶだけなので、
+    スレッドでもasyncioでも使える。生成が終わったら必ずdoneを呼ぶこと。
+    上限に0以下を指定するとその上限は無効になる。
+    """
+
+    STARTED = "started"
+    QUEUED = "queued"
+    REJECTED = "rejected"
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_per_user: int = 0,
+        max_per_channel: int = 0,
+        max_queue: int = 0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.max_per_channel = max_per_channel
+        self.max_queue = max_queue
+
+        self._lock = threading.Lock()
+        # (priority, seq, enqueued_at, user, channel, start)
+        self._queue: List[Tuple[int, int, float, str, str, Callable[[], None]]] = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._users: Counter[str] = Counter()
+        self._channels: Counter[str] = Counter()
+
+        self.started = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def _can_start(self, user: str, channel: str) -> bool:
+        if self.max_concurrency > 0 and self._running >= self.max_concurrency:
+            return False
+        if self.max_per_user > 0 and self._users[user] >= self.max_per_user:
+            return False
+        if self.max_per_channel > 0 and self._channels[channel] >= self.max_per_channel:
+            return False
+        return True
+
+    def _start(self, user: str, channel: str, waited: float):
+        self._running += 1
+        self._users[user] += 1
+        self._channels[channel] += 1
+
+        self.started += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def submit(
+        self,
+        priority: int,
+        user: str,
+        channel: str,
+        start: Callable[[], None],
+    ) -> AdmissionStatus:
+        """生成を登録する。priorityが小さいほど先に開始される"""
+        with self._lock:
+            # 待っている生成は自身の上限で止まっているため、追い越しても問題ない
+            if self._can_start(user, channel):
+                self._start(user, channel, 0.0)
+                status = self.STARTED
+            elif self.max_queue > 0 and len(self._queue) >= self.max_queue:
+                self.rejected += 1
+                return self.REJECTED
+            else:
+                entry = (
+                    priority,
+                    next(self._seq),
+                    time.monotonic(),
+                    user,
+                    channel,
+                    start,
+                )
+                heapq.heappush(self._queue, entry)
+                return self.QUEUED
+
+        start()
+        return status
+
+    def done(self, user: str, channel: str):
+        with self._lock:
+            self._running -= 1
+            self._users[user] -= 1
+            self._channels[channel] -= 1
+            if self._users[user] <= 0:
+                del self._users[user]
+            if self._channels[channel] <= 0:
+                del self._channels[channel]
+
+            starts = self._pop_startable()
+
+        for start in starts:
+            start()
+
+    def _pop_startable(self) -> List[Callable[[], None]]:
+        now = time.monotonic()
+        starts: List[Callable[[], None]] = []
+        waiting = []
+
+        for entry in sorted(self._queue):
+            _, _, enqueued_at, user, channel, start = entry
+            if self._can_start(user, channel):
+                self._start(user, channel, now - enqueued_at)
+                starts.append(start)
+            else:
+                waiting.append(entry)
+
+        if len(starts) > 0:
+            self._queue = waiting
+            heapq.heapify(self._queue)
+
+        return starts
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._running,
+                "queued": len(self._queue),
+                "started": self.started,
+                "rejected": self.rejected,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+            }
@@ -0,0 +1,277 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from google.genai import Client
+from google.genai.types import Content, GenerateContentResponseUsageMetadata, Part
+from valkey import Valkey
+
+from .conversation_store import ConversationStore
+from .env import (
+    GEMINI_MODEL,
+    HISTORY_KEEP_RATIO,
+    HISTORY_SUMMARY_MODEL,
+    HISTORY_TOKEN_BUDGET,
+)
+from .llm_utils import estimate_content_tokens
+from .valkey_client import get_valkey
+
+SUMMARY_PROMPT = (
+    "ここまでの会話を、この後も会話を続けるために必要な情報を落とさずに要約してください。"
+    "要約のみを出力してください。"
+)
+SUMMARY_PREFIX = "これまでの会話の要約:\n"
+# 要約の生成が終わらないまま残ったロックの有効期限 (秒)
+SUMMARY_LOCK_TIMEOUT = 300
+
+
+def _starts_turn(content: Content) -> bool:
+    # 関数の実行結果もuserのContentだが、直前の関数呼び出しなしでは送れない
+    return content.role == "user" and not any(
+        part.function_response is not None for part in content.parts or []
+    )
+
+
+class HistoryPlanner:
+    """保存済みの会話をトークン数の上限に収め、古いターンを要約に置き換える
+
+    上限を超えた場合は古いターンから落とし、落としたターンの要約をバックグラウンドで
+    生成して会話と一緒に保存する。窓が毎ターンずれるとCachedContentを作り直すことに
+    なるため、一度に上限のHISTORY_KEEP_RATIOまで落とす。
+    """
+
+    def __init__(
+        self,
+        gemini: Client,
+        store: ConversationStore,
+        valkey: Valkey | None = None,
+        budget: int = HISTORY_TOKEN_BUDGET,
+        keep_ratio: float = HISTORY_KEEP_RATIO,
+    ):
+        self.gemini = gemini
+        self.store = store
+        self._valkey = valkey if valkey is not None else get_valkey()
+        self.budget = budget
+        self.keep_ratio = keep_ratio
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="history-summary"
+        )
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.planned_tokens = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.dropped_turns = 0
+        self.summaries = 0
+
+    @staticmethod
+    def _lock_key(channel: str, thread_ts: str) -> str:
+        return f"cs:lock:{channel}-{thread_ts}"
+
+    def plan(
+        self,
+        channel: str,
+        thread_ts: str,
+        turns: List[Content],
+        tokens: List[int],
+        base: int,
+        reserved: int = 0,
+    ) -> List[Content]:
+        """LLMに渡す保存済みのターンを選ぶ
+
+        baseはturnsの最初のターンの通し番号、reservedは新しいターンのトークン数。
+        """
+        summary = self.store.get_summary(channel, thread_ts)
+        covered = summary["covered"] if summary is not None else 0
+        summary_tokens = (
+            summary.get("tokens", len(summary["text"])) if summary is not None else 0
+        )
+
+        start = min(max(covered - base, 0), len(turns))
+        window_tokens = sum(tokens[start:])
+        budget = self.budget - reserved - summary_tokens
+        over_budget = self.budget > 0 and window_tokens > budget
+        target = budget * self.keep_ratio
+
+        # 窓はユーザーの発言から始める。上限を超えていれば目標まで古いターンを落とす
+        dropped_from = start
+        while start < len(turns) and (
+            (over_budget and window_tokens > target) or not _starts_turn(turns[start])
+        ):
+            window_tokens -= tokens[start]
+            start += 1
+
+        if start > dropped_from:
+            with self._lock:
+                self.dropped_turns += start - dropped_from
+
+            self._executor.submit(
+                self._summarize,
+                channel,
+                thread_ts,
+                summary,
+                turns[dropped_from:start],
+                base + start,
+            )
+
+        contents = turns[start:]
+        if summary is not None:
+            contents = [
+                Content(
+                    role="user", parts=[Part(text=SUMMARY_PREFIX + summary["text"])]
+                )
+            ] + contents
+
+        with self._lock:
+            self.requests += 1
+            self.planned_tokens += window_tokens + summary_tokens + reserved
+
+        return contents
+
+    def _summarize(
+        self,
+        channel: str,
+        thread_ts: str,
+        summary: dict | None,
+        turns: List[Content],
+        covered: int,
+    ):
+        # 同じスレッドの要約を複数のプロセスで同時に作らない
+        lock_key = self._lock_key(channel, thread_ts)
+        if not self._valkey.set(lock_key, 1, nx=True, ex=SUMMARY_LOCK_TIMEOUT):
+            return
+
+        try:
+            current = self.store.get_summary(channel, thread_ts)
+            if current is not None and current["covered"] >= covered:
+                return
+
+            contents: List[Content] = []
+            if summary is not None:
+                contents.append(
+                    Content(
+                        role="user",
+                        parts=[Part(text=SUMMARY_PREFIX + summary["text"])],
+                    )
+                )
+            contents.extend(turns)
+            contents.append(Content(role="user", parts=[Part(text=SUMMARY_PROMPT)]))
+
+            response = self.gemini.models.generate_content(
+                model=HISTORY_SUMMARY_MODEL, contents=contents
+            )
+            if response.text is None:
+                logging.warning(f"Empty summary for {channel} {thread_ts}")
+                return
+
+            # 先に新しい要約が保存されていれば上書きしない
+            current = self.store.get_summary(channel, thread_ts)
+            if current is not None and current["covered"] >= covered:
+                return
+
+            usage = response.usage_metadata
+            tokens = usage.candidates_token_count if usage is not None else None
+            self.store.set_summary(
+                channel,
+                thread_ts,
+                covered,
+                response.text,
+                tokens if tokens is not None else len(response.text),
+            )
+            with self._lock:
+                self.summaries += 1
+            logging.info(
+                f"Summarized {len(turns)} turns of {channel} {thread_ts} "
+                f"into {len(response.text)} chars"
+            )
+        except Exception as e:
+            logging.error(f"Failed to summarize {channel} {thread_ts}: {e}")
+        finally:
+            self._valkey.delete(lock_key)
+
+    @staticmethod
+    def split_tokens(contents: List[Content], total: int | None) -> List[int]:
+        """合計のトークン数を、文字数からの見積もりの比でContentごとに分ける
+
+        totalがなければ見積もりをそのまま返す。
+        """
+        estimates = [estimate_content_tokens(content) for content in contents]
+        estimated = sum(estimates)
+        if total is None or total <= 0 or estimated == 0:
+            return estimates
+
+        counts = [total * estimate // estimated for estimate in estimates]
+        # 切り捨てた分は最後のContentに足して、合計を合わせる
+        counts[-1] += total - sum(counts)
+        return counts
+
+    def count_tokens(self, contents: List[Content]) -> List[int]:
+        """Contentごとのトークン数を数える。数えられなければ文字数から見積もる
+
+        長いスレッドでも往復が増えないよう、まとめて1回で数えて分ける。
+        """
+        if len(contents) == 0:
+            return []
+
+        try:
+            total = self.gemini.models.count_tokens(
+                model=GEMINI_MODEL, contents=contents
+            ).total_tokens
+        except Exception as e:
+            logging.warning(f"Failed to count tokens: {e}")
+            total = None
+        return self.split_tokens(contents, total)
+
+    def reply_tokens(
+        self,
+        turn: List[Content],
+        usage: GenerateContentResponseUsageMetadata | None,
+    ) -> List[int]:
+        """生成したターンのトークン数。ストリームのusage_metadataから求める"""
+        total = usage.candidates_token_count if usage is not None else None
+        return self.split_tokens(turn, total)
+
+    def function_response_tokens(
+        self,
+        content: Content,
+        previous: GenerateContentResponseUsageMetadata | None,
+        usage: GenerateContentResponseUsageMetadata | None,
+    ) -> int:
+        """関数の実行結果のトークン数。前後のリクエストのプロンプトの差から求める"""
+        total = None
+        if previous is not None and usage is not None:
+            total = (
+                (usage.prompt_token_count or 0)
+                - (previous.prompt_token_count or 0)
+                - (previous.candidates_token_count or 0)
+            )
+        return self.split_tokens([content], total)[0]
+
+    def record_usage(
+        self,
+        usage: GenerateContentResponseUsageMetadata | None,
+        logger: logging.Logger,
+    ):
+        if usage is None:
+            return
+
+        prompt_tokens = usage.prompt_token_count or 0
+        cached_tokens = usage.cached_content_token_count or 0
+        logger.info(f"Prompt tokens: {prompt_tokens} (cached {cached_tokens})")
+
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "planned_tokens": self.planned_tokens,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "dropped_turns": self.dropped_turns,
+                "summaries": self.summaries,
+            }
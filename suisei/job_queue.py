@@ -0,0 +1,85 @@
+import json
+from typing import Tuple
+
+from valkey import Valkey
+from valkey.exceptions import ResponseError
+
+from .env import JOB_CLAIM_IDLE_SECONDS, JOB_STREAM_MAX_LEN
+from .valkey_client import get_valkey
+
+
+class JobQueue:
+    """receiverが受け取ったイベントをworkerに渡すValkeyのstream
+
+    workerはconsumer groupで読み込み、処理が終わったらackする。
+    ackされずに止まったジョブは他のworkerが引き継ぐ。
+    """
+
+    STREAM_KEY = "jq:events"
+    GROUP = "workers"
+
+    def __init__(self, valkey: Valkey | None = None):
+        self._valkey = valkey if valkey is not None else get_valkey()
+
+    def push(self, event: dict):
+        self._valkey.xadd(
+            self.STREAM_KEY,
+            {"event": json.dumps(event)},
+            maxlen=JOB_STREAM_MAX_LEN,
+        )
+
+    def ensure_group(self):
+        try:
+            self._valkey.xgroup_create(
+                self.STREAM_KEY, self.GROUP, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, consumer: str, block_ms: int) -> Tuple[str, dict] | None:
+        """ジョブを1つ取り出す。止まっているジョブがあれば先に引き継ぐ"""
+        entries = self._valkey.xautoclaim(
+            self.STREAM_KEY,
+            self.GROUP,
+            consumer,
+            min_idle_time=JOB_CLAIM_IDLE_SECONDS * 1000,
+            count=1,
+        )[1]
+
+        if len(entries) == 0:
+            response = self._valkey.xreadgroup(
+                self.GROUP,
+                consumer,
+                {self.STREAM_KEY: ">"},
+                count=1,
+                block=block_ms,
+            )
+            if not response:
+                return None
+            entries = response[0][1]
+
+        entry_id, fields = entries[0]
+        if fields is None:
+            # 引き継ぐ前にストリームから削除されていた
+            self.ack(entry_id)
+            return None
+
+        return (entry_id.decode(), json.loads(fields[b"event"]))
+
+    def heartbeat(self, consumer: str, entry_id: str):
+        # 処理中のジョブが他のworkerに引き継がれないよう、アイドル時間をリセットする
+        self._valkey.xclaim(
+            self.STREAM_KEY,
+            self.GROUP,
+            consumer,
+            min_idle_time=0,
+            message_ids=[entry_id],
+            justid=True,
+        )
+
+    def ack(self, entry_id: str | bytes):
+        with self._valkey.pipeline(transaction=False) as pipe:
+            pipe.xack(self.STREAM_KEY, self.GROUP, entry_id)
+            pipe.xdel(self.STREAM_KEY, entry_id)
+            pipe.execute()
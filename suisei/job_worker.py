@@ -0,0 +1,159 @@
+import logging
+import os
+import socket
+import threading
+import time
+from functools import partial
+
+from slack_bolt import BoltContext
+from slack_sdk import WebClient
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+
+from .env import (
+    JOB_CLAIM_IDLE_SECONDS,
+    JOB_READ_BLOCK_MS,
+    JOB_WORKER_CONCURRENCY,
+    SLACK_BOT_TOKEN,
+)
+from .generation_limiter import GenerationLimiter
+from .listener_utils import (
+    collect_messages,
+    generation_priority,
+    load_locale,
+    notify_admission,
+    report_error,
+    user_cache,
+)
+from .llm_slack_executor import generation_limiter, job_queue, start_model_streamer
+from .slack_utils import fetch_thread_replies
+
+logger = logging.getLogger(__name__)
+
+# Valkeyに接続できない間は、間隔を空けて読み込み直す
+READ_RETRY_MIN_SECONDS = 1
+READ_RETRY_MAX_SECONDS = 30
+
+client = WebClient(token=SLACK_BOT_TOKEN)
+client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=2))
+
+
+def process_event(entry_id: str, event: dict):
+    payload: dict = event["payload"]
+    context = BoltContext(
+        bot_user_id=event["bot_user_id"],
+        channel_id=payload["channel"],
+        user_id=payload.get("user"),
+    )
+    # workerではミドルウェアを通らないため、set_localeと同じく必要な時に取得する
+    context["get_locale"] = lambda: user_cache.get_locale(client, payload["user"])
+
+    try:
+        # 引き継いだジョブでも返信できるよう、ジョブのidで返信の重複を確認する
+        messages = collect_messages(
+            context,
+            payload,
+            partial(fetch_thread_replies, client),
+            logger,
+            event["type"],
+            owner=entry_id,
+        )
+        if messages is None:
+            return
+
+        load_locale(context, logger)
+    except Exception as e:
+        report_error(client, logger, payload, e)
+        return
+
+    channel: str = payload["channel"]
+    user: str = payload["user"]
+
+    # receiverと同じく同時実行数を制限する。ジョブは開始できるまでこのスレッドで待つ
+    started = threading.Event()
+    status = generation_limiter.submit(
+        generation_priority(event["type"]), user, channel, started.set
+    )
+    notify_admission(client, logger, payload, status)
+    if status == GenerationLimiter.REJECTED:
+        return
+
+    started.wait()
+    try:
+        start_model_streamer(
+            context=context,
+            client=client,
+            logger=logger,
+            channel=channel,
+            thread_ts=payload.get("thread_ts") or payload["ts"],
+            messages=messages,
+        )
+    except Exception as e:
+        report_error(client, logger, payload, e)
+    finally:
+        generation_limiter.done(user, channel)
+
+
+def _process_job(consumer: str, entry_id: str, event: dict):
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(JOB_CLAIM_IDLE_SECONDS / 3):
+            try:
+                job_queue.heartbeat(consumer, entry_id)
+            except Exception as e:
+                logger.error(f"Failed to extend job {entry_id}: {e}")
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        process_event(entry_id, event)
+    finally:
+        stop.set()
+        thread.join()
+
+    # ackできなければ、他のworkerが引き継いで重複を確認する
+    try:
+        job_queue.ack(entry_id)
+    except Exception as e:
+        logger.error(f"Failed to ack job {entry_id}: {e}")
+
+
+def _worker_loop(consumer: str):
+    retry_seconds = READ_RETRY_MIN_SECONDS
+    while True:
+        try:
+            job = job_queue.read(consumer, JOB_READ_BLOCK_MS)
+        except Exception as e:
+            logger.error(f"Failed to read job, retry in {retry_seconds}s: {e}")
+            time.sleep(retry_seconds)
+            retry_seconds = min(retry_seconds * 2, READ_RETRY_MAX_SECONDS)
+            continue
+
+        retry_seconds = READ_RETRY_MIN_SECONDS
+        if job is None:
+            continue
+
+        entry_id, event = job
+        logger.info(f"Start job {entry_id}")
+        try:
+            _process_job(consumer, entry_id, event)
+        except Exception as e:
+            # 1つのジョブの失敗でworkerのスレッドを止めない
+            logger.error(f"Failed to process job {entry_id}: {e}")
+
+
+def run_worker():
+    """キューに積まれたイベントを処理し続ける"""
+    job_queue.ensure_group()
+
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    threads = [
+        threading.Thread(target=_worker_loop, args=(consumer,), name=f"job-worker-{i}")
+        for i in range(JOB_WORKER_CONCURRENCY)
+    ]
+    for thread in threads:
+        thread.start()
+
+    logger.info(f"Worker {consumer} started with {len(threads)} threads")
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,232 @@
+import logging
+import traceback
+from typing import Callable, List, Literal, Union
+
+from slack_bolt import BoltContext
+from slack_sdk import WebClient
+
+from .env import (
+    GENERATION_QUEUED_REACTION,
+    GENERATION_REJECTED_REACTION,
+    HISTORY_TOKEN_BUDGET,
+)
+from .generation_limiter import AdmissionStatus, GenerationLimiter
+from .llm_slack_executor import (
+    event_dedup,
+    generation_limiter,
+    store,
+    thread_registry,
+)
+from .slack_utils import (
+    estimate_tokens,
+    is_this_app_mentioned,
+    remove_unused_element,
+    window_messages,
+)
+from .user_cache import UserInfoCache
+
+# リスナーとworkerで共有する
+user_cache = UserInfoCache()
+
+REJECTED_TEXT = "混み合っているため受け付けられませんでした。しばらくしてからもう一度送ってください"
+
+
+def is_ignored(
+    context: BoltContext,
+    payload: dict,
+    type: Union[Literal["mention"], Literal["message"]],
+) -> bool:
+    text: str = payload["text"]
+    cleaned_text = remove_unused_element(context, text)
+
+    # 自分は無視
+    if payload["user"] == context.bot_user_id:
+        return True
+
+    # メンションで内容がない場合は無視
+    if type == "mention" and cleaned_text == "":
+        return True
+
+    # メンションでない場合で、自分が言及されていたらメンションのハンドラーと重複するため無視
+    if type != "mention" and is_this_app_mentioned(context, text):
+        return True
+
+    if type == "message" and payload.get("thread_ts") is None:
+        # メッセージの場合、メンションがなければ無視
+        if not is_this_app_mentioned(context, text):
+            return True
+
+    return False
+
+
+def _has_joined(context: BoltContext, history: List[dict]) -> bool:
+    # 過去に自分がメンションされている・自分が発言しているメッセージを確認する
+    return any(
+        is_this_app_mentioned(context, message["text"]) for message in history
+    ) or any(message["user"] == context.bot_user_id for message in history)
+
+
+def _has_abort(context: BoltContext, history: List[dict]) -> bool:
+    return any(
+        message["user"] != context.bot_user_id and message["text"].strip() == "abort"
+        for message in history
+    ) or any(
+        message["user"] == context.bot_user_id
+        and message.get("meta", {}).get("suichan_type") == "abort"
+        for message in history
+    )
+
+
+def _build_messages(payload: dict, history: List[dict]) -> List[dict]:
+    # 過去のメッセージを投入する。ただしトリガーのメッセージは無視
+    messages = [message for message in history if message["ts"] != payload["ts"]]
+
+    # 長いスレッドは新しいメッセージからトークン数の上限までに絞る
+    if HISTORY_TOKEN_BUDGET > 0:
+        messages = window_messages(
+            messages, HISTORY_TOKEN_BUDGET - estimate_tokens(payload)
+        )
+
+    messages.append(payload)
+    return messages
+
+
+def generation_priority(type: Union[Literal["mention"], Literal["message"]]) -> int:
+    # メンションをスレッド内の続きのメッセージより先に処理する
+    return 0 if type == "mention" else 1
+
+
+def admission_reaction(status: AdmissionStatus) -> str | None:
+    if status == GenerationLimiter.QUEUED:
+        return GENERATION_QUEUED_REACTION
+    if status == GenerationLimiter.REJECTED:
+        return GENERATION_REJECTED_REACTION
+    return None
+
+
+def notify_admission(
+    client: WebClient,
+    logger: logging.Logger,
+    payload: dict,
+    status: AdmissionStatus,
+):
+    reaction = admission_reaction(status)
+    if reaction is None:
+        return
+
+    logger.info(f"Generation {status}: {generation_limiter.stats()}")
+
+    # 待たせている・受け付けなかったことをすぐに伝える
+    try:
+        client.reactions_add(
+            channel=payload["channel"], timestamp=payload["ts"], name=reaction
+        )
+        if status == GenerationLimiter.REJECTED:
+            client.chat_postMessage(
+                channel=payload["channel"],
+                text=REJECTED_TEXT,
+                thread_ts=payload.get("thread_ts") or payload["ts"],
+            )
+    except Exception as e:
+        logger.error(f"Failed to notify admission: {e}")
+
+
+def load_locale(context: BoltContext, logger: logging.Logger):
+    # set_localeミドルウェアは取得を遅らせているため、返信すると決まってから取得する
+    get_locale = context.get("get_locale")
+    if get_locale is None:
+        return
+
+    try:
+        context["locale"] = get_locale()
+    except Exception as e:
+        logger.error(f"Failed to get locale: {e}")
+
+
+def report_error(
+    client: WebClient,
+    logger: logging.Logger,
+    payload: dict,
+    e: Exception,
+):
+    ex = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+    logger.error(ex)
+    client.chat_postMessage(
+        channel=payload["channel"],
+        text=f"エラーが発生しました\n{ex}",
+        thread_ts=payload["ts"],
+    )
+
+
+def is_duplicated_event(
+    payload: dict,
+    logger: logging.Logger,
+    type: Union[Literal["mention"], Literal["message"]],
+) -> bool:
+    # Slackの再送やレプリカで同じイベントを複数回受け取った場合は最初の1回だけ処理する
+    if event_dedup.claim(payload["channel"], payload["ts"], type):
+        return False
+
+    logger.info(f"Skip duplicated {type} event {payload['channel']} {payload['ts']}")
+    return True
+
+
+def collect_messages(
+    context: BoltContext,
+    payload: dict,
+    fetch_replies: Callable[..., List[dict]],
+    logger: logging.Logger,
+    type: Union[Literal["mention"], Literal["message"]],
+    owner: str | None = None,
+) -> List[dict] | None:
+    """LLMに渡すメッセージを集める。反応しないイベントの場合はNoneを返す
+
+    _is_ignoredとis_duplicated_eventによる除外は呼び出し元で行う。
+    fetch_repliesはfetch_thread_repliesからclientを除いた形で、スレッドの返信を返す。
+    ownerは返信の重複を確認する際に、同じ処理の再試行を区別するために使う。
+    """
+    thread_ts: str | None = payload.get("thread_ts")
+    text: str = payload["text"]
+    channel: str = payload["channel"]
+
+    status = None
+    if type == "message" and thread_ts is not None:
+        # Slack APIを呼ぶ前に、abortされたスレッドを除外する
+        status = thread_registry.get(channel, thread_ts)
+        if status == thread_registry.ABORTED:
+            return None
+
+        if status == thread_registry.JOINED and text.strip() == "abort":
+            thread_registry.abort(channel, thread_ts)
+            return None
+
+    history = []
+
+    # スレッド内であれば過去の履歴を取得してLLMに渡す
+    if thread_ts is not None:
+        # 会話が保存済みであれば、保存後の返信だけを取得する
+        last_ts = store.get_last_ts(channel, thread_ts)
+        history = fetch_replies(channel, thread_ts, oldest=last_ts)
+
+        # 記録がないスレッドは、履歴から参加しているかを確認する
+        # 保存済みの会話があれば参加済みなので確認しない
+        if type == "message" and status is None and last_ts is None:
+            if not _has_joined(context, history):
+                return None
+            thread_registry.join(channel, thread_ts)
+
+        # abortがあれば無視
+        if type == "message" and _has_abort(context, history):
+            thread_registry.abort(channel, thread_ts)
+            return None
+
+    # app_mentionとmessageの両方が通った場合も、1つのメッセージには1回だけ返信する
+    if not event_dedup.claim(channel, payload["ts"], "reply", owner):
+        logger.info(f"Already replied to {channel} {payload['ts']}")
+        return None
+
+    messages = _build_messages(payload, history)
+
+    logger.info(f"Input {len(messages)} messages")
+
+    return messages
@@ -1,15 +1,34 @@
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 from slack_bolt import BoltContext
 from google.genai.types import Content, Part, Blob
 
-from .env import GEMINI_FILE_MAX_SIZE
+from .env import GEMINI_FILE_MAX_SIZE, SLACK_DOWNLOAD_CONCURRENCY
+from .file_cache import GeminiFileCache
 from .llm_utils import datetime_to_string
-from .slack_utils import download_slack_image_content, parse_ts, remove_unused_element
+from .slack_utils import (
+    download_executor,
+    download_slack_image_content,
+    parse_ts,
+    process_media,
+    remove_unused_element,
+)
+
+# ダウンロードを待つため、download_executorとは別に用意する
+chat_executor = ThreadPoolExecutor(
+    max_workers=SLACK_DOWNLOAD_CONCURRENCY, thread_name_prefix="create-chat"
+)
 
 
 # SlackのmessageをLLM向けのdictに変換する
-def create_chat(context: BoltContext, message: dict) -> Content | None:
+# file_cacheを指定するとファイルはGemini Files APIのURIで参照する
+def create_chat(
+    context: BoltContext,
+    message: dict,
+    file_cache: GeminiFileCache | None = None,
+) -> Content | None:
     user_id: str = message["user"]
     text: str = message["text"]
     ts = parse_ts(message["ts"])
@@ -40,20 +59,43 @@ def create_chat(context: BoltContext, message: dict) -> Content | None:
         if text != "":
             content.parts.append(Part(text=f"<@{user_id}> {dt} {text}"))
 
-        if len(files) > 0:
-            for file in files:
-                type, file = download_slack_image_content(file["url_private"])
+        # ファイルは並列にダウンロードする
+        futures = [
+            download_executor.submit(_create_file_part, file, file_cache)
+            for file in files
+        ]
+        content.parts.extend(future.result() for future in futures)
+
+        return content
 
-                if len(file) > GEMINI_FILE_MAX_SIZE and GEMINI_FILE_MAX_SIZE != -1:
-                    raise ValueError(f"File size is too large: {len(file)}")
 
-                content.parts.append(
-                    Part(
-                        inline_data=Blob(
-                            data=file,
-                            mime_type=type,
-                        )
-                    )
-                )
+def _create_file_part(file: dict, file_cache: GeminiFileCache | None) -> Part:
+    # Slackが返すサイズで、ダウンロードする前に弾く
+    size = file.get("size")
+    if size is not None and size > GEMINI_FILE_MAX_SIZE and GEMINI_FILE_MAX_SIZE != -1:
+        raise ValueError(f"File size is too large: {size}")
 
-        return content
+    if file_cache is not None:
+        return file_cache.get_part(file)
+
+    type, data = download_slack_image_content(file["url_private"])
+    type, data = process_media(type, data)
+    return Part(
+        inline_data=Blob(
+            data=data,
+            mime_type=type,
+        )
+    )
+
+
+# 複数のメッセージを並列に変換する
+def create_chats(
+    context: BoltContext,
+    messages: List[dict],
+    file_cache: GeminiFileCache | None = None,
+) -> List[Content | None]:
+    futures = [
+        chat_executor.submit(create_chat, context, message, file_cache)
+        for message in messages
+    ]
+    return [future.result() for future in futures]
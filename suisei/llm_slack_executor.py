@@ -1,112 +1,255 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
 from json import loads
 import logging
 import re
-import time
-from typing import List
+import threading
+from typing import Callable, List, Tuple
 
 from slack_bolt import BoltContext
 from slack_sdk import WebClient
 from google.genai import Client
 from google.genai.types import (
     GenerateContentConfig,
+    GenerateContentResponse,
     Content,
     Tool,
     GoogleSearch,
     GroundingChunk,
+    FunctionCall,
 )
 
-from .slack_markdown.chunker import SlackChunker
+from .slack_markdown.chunker import SlackChunker, SlackUpdatingChunker
 from .env import (
+    CONVERSATION_LOAD_TURNS,
     GEMINI_API_KEY,
     GEMINI_MODEL,
     GEMINI_MAX_TOKENS,
     GEMINI_TEMPERATURE,
+    GENERATION_MAX_CONCURRENCY,
+    GENERATION_MAX_PER_CHANNEL,
+    GENERATION_MAX_PER_USER,
+    GENERATION_MAX_QUEUE,
+    SLACK_MESSAGE_MAX_BLOCKS,
+    SLACK_MESSAGE_MAX_CHARS,
+    SLACK_POST_BURST,
+    SLACK_POST_MAX_RETRY,
+    SLACK_POST_RATE,
+    SLACK_STREAM_MODE,
+    SLACK_UPDATE_RATE,
+    TOOL_CACHE_SIZE,
+    TOOL_CACHE_TTL,
+    TOOL_CONCURRENCY,
+    TOOL_MAX_STEPS,
+    TOOL_RESULT_MAX_TOKENS,
+    TOOL_TIMEOUT,
 )
-from .llm_slack import create_chat
-from .llm_utils import build_system_prompt
+from .llm_slack import create_chats
+from .llm_utils import (
+    build_system_prompt,
+    build_time_content,
+    drop_function_calls,
+    merge_model_contents,
+)
+from .context_cache import GeminiContextCache
 from .conversation_store import ConversationStore
+from .event_dedup import EventDeduplicator
+from .file_cache import GeminiFileCache
+from .generation_limiter import GenerationLimiter
+from .history_planner import HistoryPlanner
+from .job_queue import JobQueue
+from .slack_post_queue import SlackPostQueue
+from .thread_queue import ThreadQueue
+from .thread_registry import ThreadRegistry
+from .tool_runner import ToolRunner
+from .tools.github import GitHubTools
 
 gemini = Client(api_key=GEMINI_API_KEY)
 store = ConversationStore()
+file_cache = GeminiFileCache(gemini)
+context_cache = GeminiContextCache(gemini)
+history_planner = HistoryPlanner(gemini, store)
+github_tools = GitHubTools.create()
+tool_runner = (
+    ToolRunner(
+        github_tools.function_dict(),
+        max_workers=TOOL_CONCURRENCY,
+        timeout=TOOL_TIMEOUT,
+        max_result_chars=TOOL_RESULT_MAX_TOKENS,
+        cache_size=TOOL_CACHE_SIZE,
+        cache_ttl=TOOL_CACHE_TTL,
+    )
+    if github_tools is not None
+    else None
+)
+thread_queue = ThreadQueue()
+thread_registry = ThreadRegistry()
+job_queue = JobQueue()
+event_dedup = EventDeduplicator()
+post_queue = SlackPostQueue(
+    rate=SLACK_POST_RATE,
+    burst=SLACK_POST_BURST,
+    max_retry=SLACK_POST_MAX_RETRY,
+)
+generation_limiter = GenerationLimiter(
+    max_concurrency=GENERATION_MAX_CONCURRENCY,
+    max_per_user=GENERATION_MAX_PER_USER,
+    max_per_channel=GENERATION_MAX_PER_CHANNEL,
+    max_queue=GENERATION_MAX_QUEUE,
+)
+# 同時実行数はgeneration_limiterで制限されるため、executorで待つことはない
+# 上限がない場合は、生成ごとにスレッドを起動する
+generation_executor = (
+    ThreadPoolExecutor(
+        max_workers=GENERATION_MAX_CONCURRENCY, thread_name_prefix="generation"
+    )
+    if GENERATION_MAX_CONCURRENCY > 0
+    else None
+)
 
 
-# ツール等に対応するため再帰できるように関数を切り出す
-def _model_streamer(
-    context: BoltContext,
-    client: WebClient,
-    logger: logging.Logger,
-    channel: str,
-    thread_ts: str,
-    messages: List[Content],
-):
-    response = gemini.models.generate_content_stream(
-        model=GEMINI_MODEL,
-        contents=messages,
-        config=GenerateContentConfig(
+def submit_generation(run: Callable[[], None]):
+    if generation_executor is None:
+        threading.Thread(target=run, name="generation", daemon=True).start()
+    else:
+        generation_executor.submit(run)
+
+
+@functools.cache
+def _tools() -> List[Tool]:
+    # 関数の定義は変わらないため、リクエストごとに作り直さない
+    # 検索と関数呼び出しは同じリクエストで使えないため、関数がある場合は検索を使わない
+    if github_tools is not None:
+        return [
+            Tool(function_declarations=github_tools.function_declarations(gemini))
+        ]
+
+    return [
+        Tool(
+            google_search=GoogleSearch(),
+        ),
+    ]
+
+
+def _generate_config(
+    context: BoltContext, cached_content: str | None = None
+) -> GenerateContentConfig:
+    if cached_content is not None:
+        # システムプロンプトとツールはキャッシュに含まれている
+        return GenerateContentConfig(
             temperature=GEMINI_TEMPERATURE,
             max_output_tokens=GEMINI_MAX_TOKENS,
-            system_instruction=build_system_prompt(context),
-            tools=[
-                Tool(
-                    google_search=GoogleSearch(),
-                ),
-            ],
-        ),
+            cached_content=cached_content,
+        )
+
+    return GenerateContentConfig(
+        temperature=GEMINI_TEMPERATURE,
+        max_output_tokens=GEMINI_MAX_TOKENS,
+        system_instruction=build_system_prompt(context),
+        tools=_tools(),
     )
 
+
+def _create_chunker(client: WebClient, channel: str, thread_ts: str) -> SlackChunker:
     # 長過ぎるメッセージはSlackが受け付けないため、分割して投稿する
     # streamなので、だんだん投稿される感じになる
-    grounding_chunks: List[GroundingChunk] = []
-    chunker = SlackChunker(
+    if SLACK_STREAM_MODE == "update":
+        return SlackUpdatingChunker(
+            client=client,
+            channel=channel,
+            thread_ts=thread_ts,
+            post_queue=post_queue,
+            updates_per_second=SLACK_UPDATE_RATE,
+            max_blocks=SLACK_MESSAGE_MAX_BLOCKS,
+            max_chars=SLACK_MESSAGE_MAX_CHARS,
+        )
+
+    return SlackChunker(
         client=client,
         channel=channel,
         thread_ts=thread_ts,
+        post_queue=post_queue,
     )
 
-    def flush():
-        nonlocal chunker
 
-        while True:
-            result = chunker.consume()
-            if result is None:
-                break
+def _flush(chunker: SlackChunker):
+    # 投稿はキューに積まれ、レート制限に従って順番に行われる
+    while True:
+        result = chunker.consume()
+        if result is None:
+            break
 
-            time.sleep(1)  # 連続投稿を避けるために1秒待つ
 
-    for chunk in response:
-        messages.append(chunk.candidates[0].content)
+def _handle_chunk(
+    chunk: GenerateContentResponse,
+    chunker: SlackChunker,
+    logger: logging.Logger,
+    deltas: List[Content],
+    function_calls: List[FunctionCall],
+    grounding_chunks: List[GroundingChunk],
+) -> bool:
+    """ストリームの1チャンクを処理する。メッセージが終了していればTrueを返す"""
+    if not chunk.candidates:
+        return False
 
-        item = chunk.candidates[0].content.parts[0]
+    candidate = chunk.candidates[0]
 
-        if (
-            chunk.candidates[0].grounding_metadata is not None
-            and chunk.candidates[0].grounding_metadata.grounding_chunks is not None
-        ):
-            grounding_chunks.extend(
-                chunk.candidates[0].grounding_metadata.grounding_chunks
-            )
+    if (
+        candidate.grounding_metadata is not None
+        and candidate.grounding_metadata.grounding_chunks is not None
+    ):
+        grounding_chunks.extend(candidate.grounding_metadata.grounding_chunks)
 
-        delta_content: str | None = item.text
-        if delta_content is not None:
-            chunker.feed(delta_content)
-            flush()
+    if candidate.content is not None and candidate.content.parts:
+        # ストリームの差分は最後に1つのContentにまとめて保存する
+        deltas.append(candidate.content)
 
-        delta_tool = item.function_call
-        if delta_tool is not None:
-            for tool in delta_tool:
-                print(tool)
+        for part in candidate.content.parts:
+            if part.text is not None:
+                chunker.feed(part.text)
 
-        # メッセージが終了している場合は終了
-        finish_reason = chunk.candidates[0].finish_reason
-        is_finished = finish_reason is not None
+            # 関数呼び出しはターンの最後にまとめて実行する
+            if part.function_call is not None:
+                function_calls.append(part.function_call)
 
-        if is_finished:
-            logger.info(f"Finish reason: {finish_reason}")
-            break
+        _flush(chunker)
+
+    # メッセージが終了している場合は終了
+    finish_reason = candidate.finish_reason
+    if finish_reason is not None:
+        logger.info(f"Finish reason: {finish_reason}")
+        return True
+
+    return False
+
+
+def _should_call_tools(
+    function_calls: List[FunctionCall], step: int, logger: logging.Logger
+) -> bool:
+    if len(function_calls) == 0 or tool_runner is None:
+        return False
 
+    if step >= TOOL_MAX_STEPS:
+        logger.warning(f"Too many tool steps, ignored {len(function_calls)} calls")
+        return False
+
+    names = ", ".join(call.name for call in function_calls)
+    logger.info(f"Calling {len(function_calls)} tools: {names}")
+    return True
+
+
+def _finish_stream(
+    chunker: SlackChunker,
+    logger: logging.Logger,
+    grounding_chunks: List[GroundingChunk],
+):
     # 最後のメッセージを投稿
     print(chunker.finish())
-    flush()
+    _flush(chunker)
+    logger.info(
+        f"Parsed {chunker.parsed_bytes} bytes of markdown into "
+        f"{chunker.rendered_blocks} blocks ({chunker.rendered_chars} chars)"
+    )
 
     try:
         grounding_urls = []
@@ -115,51 +258,261 @@ def _model_streamer(
                 f"<{grounding_chunk.web.uri}|{grounding_chunk.web.title}>"
             )
         if len(grounding_urls) > 0:
-            client.chat_postMessage(
-                channel=channel,
-                text=f"Grounding: {' '.join(grounding_urls)}",
-                thread_ts=thread_ts,
-            )
+            text = f"Grounding: {' '.join(grounding_urls)}"
+            chunker.submit(lambda: chunker._post_text(text))
     except Exception as e:
         logger.error(f"Failed to get grounding: {e}")
 
-    store.set(channel, thread_ts, messages)
 
-
-def start_model_streamer(
+def _model_streamer(
     context: BoltContext,
     client: WebClient,
     logger: logging.Logger,
     channel: str,
     thread_ts: str,
-    messages: List[dict],
-):
-    stored_messages = store.get(channel, thread_ts)
-    if stored_messages is None:
-        llm_messages = [create_chat(context, message) for message in messages]
+    messages: List[Content],
+    cached_content: str | None = None,
+) -> Tuple[List[Content], List[int]]:
+    """生成したContentと、そのトークン数を返す"""
+    chunker = _create_chunker(client, channel, thread_ts)
+    grounding_chunks: List[GroundingChunk] = []
+    replies: List[Content] = []
+    # repliesのContentごとのトークン数
+    reply_tokens: List[int] = []
+    previous_usage = None
+    contents = list(messages)
+
+    # 関数呼び出しがあれば、その結果を渡して生成を続ける
+    for step in range(TOOL_MAX_STEPS + 1):
+        response = gemini.models.generate_content_stream(
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=_generate_config(context, cached_content),
+        )
+
+        deltas: List[Content] = []
+        function_calls: List[FunctionCall] = []
+        usage = None
+        for chunk in response:
+            usage = chunk.usage_metadata or usage
+            if _handle_chunk(
+                chunk, chunker, logger, deltas, function_calls, grounding_chunks
+            ):
+                break
+
+        history_planner.record_usage(usage, logger)
+        if step > 0:
+            # 関数の実行結果のトークン数は、プロンプトが増えた分から求める
+            reply_tokens.append(
+                history_planner.function_response_tokens(
+                    replies[-1], previous_usage, usage
+                )
+            )
+
+        turn = merge_model_contents(deltas)
+        call_tools = _should_call_tools(function_calls, step, logger)
+        if not call_tools:
+            # 実行しない関数呼び出しは応答がなく、履歴に残すとGeminiが受け付けない
+            turn = drop_function_calls(turn)
+
+        replies.extend(turn)
+        reply_tokens.extend(history_planner.reply_tokens(turn, usage))
+        if not call_tools:
+            break
+
+        tool_response = tool_runner.run(function_calls)
+        replies.append(tool_response)
+        contents = contents + turn + [tool_response]
+        previous_usage = usage
+
+    _finish_stream(chunker, logger, grounding_chunks)
+    chunker.wait()
+
+    return (replies, reply_tokens)
 
+
+def _prepare_turn(
+    context: BoltContext,
+    channel: str,
+    thread_ts: str,
+    history: List[dict],
+    pending: List[dict],
+) -> Tuple[List[Content], int, List[int]] | None:
+    """LLMに渡すメッセージと、そのうち保存済みのターン数、未保存のContentのトークン数を返す"""
+    stored = store.get_turns(
+        channel,
+        thread_ts,
+        last=CONVERSATION_LOAD_TURNS if CONVERSATION_LOAD_TURNS > 0 else None,
+    )
+    if stored is None:
+        # キューに積まれたメッセージはSlackの履歴と重複させない
+        pending_ts = set(message["ts"] for message in pending)
+        history = [message for message in history if message["ts"] not in pending_ts]
     else:
-        llm_messages = stored_messages
-        llm_messages.append(
-            create_chat(context, messages[-1])
-        )  # 最後のメッセージを追加
+        history = []
+
+    # 履歴とキューのメッセージのファイルをまとめて並列にダウンロードする
+    contents = create_chats(context, history + pending, file_cache)
+    pending_contents = contents[len(history) :]
 
-    if llm_messages[-1] is None:
+    if all(content is None for content in pending_contents):
         # メッセージが取得できなかった場合は反応しない
-        return
+        return None
+
+    # まだ保存していないContentはまとめて1回で数え、生成後の保存にも使う
+    new_contents: List[Content] = [
+        content for content in contents if content is not None
+    ]
+    new_tokens = history_planner.count_tokens(new_contents)
+
+    if stored is None:
+        llm_messages: List[Content] = []
+        stored_count = 0
+
+    else:
+        stored_messages, tokens, base = stored
+        # トークン数の上限を超える古いターンは要約に置き換える
+        llm_messages = history_planner.plan(
+            channel, thread_ts, stored_messages, tokens, base, sum(new_tokens)
+        )
+        # 期限切れのファイルはアップロードし直す
+        file_cache.refresh(llm_messages)
+        stored_count = len(llm_messages)
 
-    llm_messages: List[Content] = list(filter(lambda x: x is not None, llm_messages))
+    llm_messages.extend(new_contents)
 
     print(llm_messages)
 
     if len(llm_messages) == 0:
         raise ValueError("No messages to send to LLM")
 
-    _model_streamer(
+    return (llm_messages, stored_count, new_tokens)
+
+
+def _use_context_cache(
+    context: BoltContext,
+    channel: str,
+    thread_ts: str,
+    llm_messages: List[Content],
+    stored_count: int,
+) -> Tuple[str | None, List[Content]]:
+    # 保存済みのターンは変わらないため、システムプロンプトと合わせてキャッシュする
+    cached_content, uncached_messages = context_cache.get(
+        channel,
+        thread_ts,
+        llm_messages,
+        stored_count,
+        system_instruction=build_system_prompt(context, cached=True),
+        tools=_tools(),
+    )
+    if cached_content is None:
+        return (cached_content, uncached_messages)
+
+    # キャッシュは長時間使い回されるため、現在時刻は最新のメッセージの直前に送る
+    return (
+        cached_content,
+        uncached_messages[:-1] + [build_time_content()] + uncached_messages[-1:],
+    )
+
+
+def _save_turn(
+    channel: str,
+    thread_ts: str,
+    llm_messages: List[Content],
+    stored_count: int,
+    reply: List[Content],
+    tokens: List[int],
+    pending: List[dict],
+):
+    """保存済みのターンより後ろだけを追記する。tokensは追記するContentごとのトークン数"""
+    store.append(
+        channel,
+        thread_ts,
+        llm_messages[stored_count:] + reply,
+        last_ts=max((message["ts"] for message in pending), key=float),
+        tokens=tokens,
+    )
+
+
+def _run_turn(
+    context: BoltContext,
+    client: WebClient,
+    logger: logging.Logger,
+    channel: str,
+    thread_ts: str,
+    history: List[dict],
+    pending: List[dict],
+):
+    prepared = _prepare_turn(context, channel, thread_ts, history, pending)
+    if prepared is None:
+        return
+
+    llm_messages, stored_count, tokens = prepared
+    cached_content, uncached_messages = _use_context_cache(
+        context, channel, thread_ts, llm_messages, stored_count
+    )
+    reply, reply_tokens = _model_streamer(
         client=client,
         context=context,
         logger=logger,
         channel=channel,
         thread_ts=thread_ts,
-        messages=llm_messages,
+        messages=uncached_messages,
+        cached_content=cached_content,
     )
+    _save_turn(
+        channel,
+        thread_ts,
+        llm_messages,
+        stored_count,
+        reply,
+        tokens + reply_tokens,
+        pending,
+    )
+
+
+def start_model_streamer(
+    context: BoltContext,
+    client: WebClient,
+    logger: logging.Logger,
+    channel: str,
+    thread_ts: str,
+    messages: List[dict],
+):
+    history, trigger = messages[:-1], messages[-1]
+
+    # 以降のスレッド内のメッセージに反応するために記録する
+    thread_registry.join(channel, thread_ts)
+
+    # 同じスレッドで生成中であれば、そちらで次のターンとしてまとめて処理される
+    thread_queue.push(channel, thread_ts, trigger)
+
+    while True:
+        lock = thread_queue.acquire(channel, thread_ts)
+        if lock is None:
+            logger.info(f"Generation in progress, queued {trigger['ts']}")
+            return
+
+        try:
+            while True:
+                pending = thread_queue.pop_all(channel, thread_ts)
+                if len(pending) == 0:
+                    break
+
+                logger.info(f"Start turn with {len(pending)} messages")
+                _run_turn(
+                    context=context,
+                    client=client,
+                    logger=logger,
+                    channel=channel,
+                    thread_ts=thread_ts,
+                    history=history,
+                    pending=pending,
+                )
+                lock.reacquire()
+        finally:
+            lock.release()
+
+        # ロックを解放する直前に積まれたメッセージを取りこぼさない
+        if not thread_queue.has_pending(channel, thread_ts):
+            return
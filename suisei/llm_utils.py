@@ -1,20 +1,101 @@
 from datetime import datetime
+from typing import List
 
 from pytz import timezone
 from slack_bolt import BoltContext
 from google.genai.types import Content, Part
 
 from .env import SYSTEM_TEXT
+from .slack_utils import FILE_TOKENS
 
 
-def build_system_prompt(context: BoltContext) -> Content:
-    ts = timezone("Asia/Tokyo").localize(datetime.now())
+# キャッシュするシステムプロンプトでは、現在時刻の代わりにこの文言を使う
+CACHED_CURRENT_TIME = "最新のメッセージの直前に「現在時刻」として示します"
+
+
+def _current_time() -> str:
+    return datetime_to_string(timezone("Asia/Tokyo").localize(datetime.now()))
+
+
+def build_system_prompt(context: BoltContext, cached: bool = False) -> Content:
+    """システムプロンプトを作る
+
+    cachedがTrueの場合は使い回されるため、現在時刻を含めない。
+    その場合はbuild_time_contentをリクエストごとに送ること。
+    """
+    current_time = CACHED_CURRENT_TIME if cached else _current_time()
     text = SYSTEM_TEXT.format(
-        bot_user_id=context.bot_user_id, current_time=datetime_to_string(ts)
+        bot_user_id=context.bot_user_id, current_time=current_time
     )
 
     return Content(role="user", parts=[Part(text=text)])
 
 
+def build_time_content() -> Content:
+    return Content(role="user", parts=[Part(text=f"現在時刻: {_current_time()}")])
+
+
 def datetime_to_string(dt: datetime) -> str:
     return datetime.strftime(dt, "%Y/%m/%d %H:%M:%S")
+
+
+def _is_text_part(part: Part) -> bool:
+    return part.text is not None and set(part.model_dump(exclude_none=True)) <= {
+        "text",
+        "thought",
+    }
+
+
+# ストリームの差分などで連続しているmodelのContentを1つにまとめる
+def drop_function_calls(contents: List[Content]) -> List[Content]:
+    """関数呼び出しのパートを取り除く。パートがなくなったContentは除く"""
+    dropped: List[Content] = []
+    for content in contents:
+        parts = [part for part in content.parts or [] if part.function_call is None]
+        if len(parts) > 0:
+            dropped.append(Content(role=content.role, parts=parts))
+    return dropped
+
+
+def merge_model_contents(contents: List[Content]) -> List[Content]:
+    merged: List[Content] = []
+    for content in contents:
+        if content.role == "model" and len(merged) > 0 and merged[-1].role == "model":
+            target = merged[-1]
+        elif content.role == "model":
+            target = Content(role="model", parts=[])
+            merged.append(target)
+        else:
+            merged.append(content)
+            continue
+
+        for part in content.parts or []:
+            last = target.parts[-1] if len(target.parts) > 0 else None
+            if (
+                last is not None
+                and _is_text_part(last)
+                and _is_text_part(part)
+                and last.thought == part.thought
+            ):
+                target.parts[-1] = Part(
+                    text=last.text + part.text, thought=last.thought
+                )
+            else:
+                target.parts.append(part)
+
+    return [
+        content
+        for content in merged
+        if content.role != "model" or len(content.parts) > 0
+    ]
+
+
+def estimate_content_tokens(content: Content) -> int:
+    # slack_utils.estimate_tokensと同じく、文字数とファイル数から見積もる
+    tokens = 0
+    for part in content.parts or []:
+        if part.text is not None:
+            tokens += len(part.text)
+        elif part.file_data is not None or part.inline_data is not None:
+            tokens += FILE_TOKENS
+    return tokens
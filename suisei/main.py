@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from typing import Callable
 
@@ -6,8 +7,20 @@ from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_sdk import WebClient
 from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
 
-from .bolt_listeners import respond_to_app_mention, respond_to_message
-from .env import SLACK_APP_LOG_LEVEL, SLACK_APP_TOKEN, SLACK_BOT_TOKEN
+from .bolt_listeners import (
+    enqueue_app_mention,
+    enqueue_message,
+    respond_to_app_mention,
+    respond_to_message,
+)
+from .env import (
+    SLACK_APP_LOG_LEVEL,
+    SLACK_APP_MODE,
+    SLACK_APP_ROLE,
+    SLACK_APP_TOKEN,
+    SLACK_BOT_TOKEN,
+)
+from .listener_utils import user_cache
 
 
 def set_locale(
@@ -16,8 +29,14 @@ def set_locale(
     next_: Callable,
 ):
     user_id = context.actor_user_id or context.user_id
-    user_info = client.users_info(user=user_id, include_locale=True)
-    context["locale"] = user_info.get("user", {}).get("locale")
+
+    # 無視するイベントでusers_infoを呼ばないよう、context["locale"]は返信する時に設定する
+    def get_locale() -> str | None:
+        if user_id is None:
+            return None
+        return user_cache.get_locale(client, user_id)
+
+    context["get_locale"] = get_locale
     next_()
 
 
@@ -28,16 +47,35 @@ def just_ack(ack: Ack):
 def main():
     logging.basicConfig(level=SLACK_APP_LOG_LEVEL)
 
+    if SLACK_APP_ROLE == "worker":
+        # Slackには接続せず、receiverが積んだイベントを処理する
+        from .job_worker import run_worker
+
+        run_worker()
+        return
+
+    if SLACK_APP_MODE == "async":
+        # 生成ごとにスレッドを使わず、1つのイベントループで多数の会話を扱う
+        from .async_main import async_main
+
+        asyncio.run(async_main())
+        return
+
     app = App(
         token=SLACK_BOT_TOKEN,
         process_before_response=False,
     )
 
     app.client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=2))
-    app.middleware(set_locale)
 
-    app.event("app_mention")(ack=just_ack, lazy=[respond_to_app_mention])
-    app.event("message")(ack=just_ack, lazy=[respond_to_message])
+    if SLACK_APP_ROLE == "receiver":
+        # 受け取ったイベントはキューに積むだけで、生成はworkerで行う
+        app.event("app_mention")(enqueue_app_mention)
+        app.event("message")(enqueue_message)
+    else:
+        app.middleware(set_locale)
+        app.event("app_mention")(ack=just_ack, lazy=[respond_to_app_mention])
+        app.event("message")(ack=just_ack, lazy=[respond_to_message])
 
     handler = SocketModeHandler(app, SLACK_APP_TOKEN)
     handler.start()
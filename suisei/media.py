@@ -0,0 +1,95 @@
+from io import BytesIO
+from typing import Tuple
+
+from PIL import Image, ImageOps
+
+try:
+    import pypdf
+except ImportError:
+    # 依存関係に含まれているが、入っていなければPDFはそのまま送る
+    pypdf = None
+
+IMAGE_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+
+def is_preprocessable(mime_type: str) -> bool:
+    return mime_type.startswith("image/") or mime_type.startswith("application/pdf")
+
+
+def preprocess_image(
+    mime_type: str,
+    data: bytes,
+    max_pixels: int,
+    image_format: str = "webp",
+    quality: int = 85,
+) -> Tuple[str, bytes]:
+    """max_pixelsを超える画像を縮小し、EXIFを取り除いて再エンコードする"""
+    with Image.open(BytesIO(data)) as image:
+        # アニメーションはフレームが失われるためそのまま送る
+        if getattr(image, "n_frames", 1) > 1:
+            return (mime_type, data)
+
+        pixels = image.width * image.height
+        too_large = max_pixels > 0 and pixels > max_pixels
+        has_exif = len(image.getexif()) > 0
+
+        if not too_large and not has_exif:
+            return (mime_type, data)
+
+        # EXIFの向きを反映してから、EXIFを含めずに書き出す
+        image = ImageOps.exif_transpose(image)
+
+        if too_large:
+            scale = (max_pixels / pixels) ** 0.5
+            size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+            image = image.resize(size, Image.Resampling.LANCZOS)
+
+        format, output_type = IMAGE_FORMATS.get(image_format, IMAGE_FORMATS["webp"])
+        if format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+
+        output = BytesIO()
+        image.save(output, format=format, quality=quality)
+        return (output_type, output.getvalue())
+
+
+def can_trim_pdf() -> bool:
+    return pypdf is not None
+
+
+def trim_pdf(mime_type: str, data: bytes, max_pages: int) -> Tuple[str, bytes]:
+    """PDFを先頭からmax_pagesページまでにする。pypdfがない場合はそのまま返す"""
+    if pypdf is None or max_pages <= 0:
+        return (mime_type, data)
+
+    reader = pypdf.PdfReader(BytesIO(data))
+    if len(reader.pages) <= max_pages:
+        return (mime_type, data)
+
+    writer = pypdf.PdfWriter()
+    for page in reader.pages[:max_pages]:
+        writer.add_page(page)
+
+    output = BytesIO()
+    writer.write(output)
+    return (mime_type, output.getvalue())
+
+
+def preprocess_media(
+    mime_type: str,
+    data: bytes,
+    max_pixels: int,
+    image_format: str = "webp",
+    quality: int = 85,
+    pdf_max_pages: int = 0,
+) -> Tuple[str, bytes]:
+    if mime_type.startswith("image/"):
+        return preprocess_image(mime_type, data, max_pixels, image_format, quality)
+    if mime_type.startswith("application/pdf"):
+        return trim_pdf(mime_type, data, pdf_max_pages)
+    return (mime_type, data)
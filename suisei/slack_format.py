@@ -1,41 +1,103 @@
 import re
+from typing import List, Tuple
+
+LEADING_NEWLINES_RE = re.compile("^\n+")
+# Remove prepended Slack user ID
+LEADING_MENTION_RE = re.compile("^<@U.*?>\\s?:\\s?")
+
+# Remove code block tags since Slack doesn't render them in a message
+# 以前は1言語ずつre.subしていたため、その順序で適用した場合と同じ結果になるようにする
+FENCE_LANGUAGES = [
+    "[Rr]ust",
+    "[Rr]uby",
+    "[Ss]cala",
+    "[Kk]otlin",
+    "[Jj]ava",
+    "[Gg]o",
+    "[Ss]wift",
+    "[Oo]objective[Cc]",
+    "[Cc]",
+    "[Cc][+][+]",
+    "[Cc][Pp][Pp]",
+    "[Cc]sharp",
+    "[Mm][Aa][Tt][Ll][Aa][Bb]",
+    "[Jj][Ss][Oo][Nn]",
+    "[Ll]a[Tt]e[Xx]",
+    "[Ll][Uu][Aa]",
+    "[Cc][Mm][Aa][Kk][Ee]",
+    "bash",
+    "zsh",
+    "sh",
+    "[Ss][Qq][Ll]",
+    "[Pp][Hh][Pp]",
+    "[Pp][Ee][Rr][Ll]",
+    "[Jj]ava[Ss]cript",
+    "[Ty]ype[Ss]cript",
+    "[Pp]ython",
+]
+# グループの番号が何番目の言語にマッチしたかを表す
+FENCE_RE = re.compile(
+    "```(?:" + "|".join(f"(\\s*{language}\n)" for language in FENCE_LANGUAGES) + ")"
+)
+FENCE_CONTINUATION_RES = [
+    re.compile(f"\\s*{language}\n") for language in FENCE_LANGUAGES
+]
+# 末尾の```の後に言語名の行が続くかもしれない
+FENCE_TAIL_RE = re.compile("```(?:\\s*(?:" + "|".join(FENCE_LANGUAGES) + ")\n)*\\s*\\Z")
+
+CODE_RE = re.compile(r"(?s)```.+?```|`[^`\n]+?`")
+# 閉じていないリンク
+LINK_TAIL_RE = re.compile(r"\[[^\]]*\Z|\[[^\]]+?\]\([^)]*\Z")
+
+# 前の置換の結果に次の置換がかかることがあるため、この順に適用する
+# 置換の対象になる文字を含まない場合は飛ばす
+MRKDWN_RULES = [
+    # ***bold italic*** to *_bold italic_*
+    ("*", re.compile(r"\*\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*\*"), r"_*\1*_"),
+    # *italic* to _italic_
+    ("*", re.compile(r"(?<![\*_])\*(?!\s)([^\*\n]+?)(?<!\s)\*(?![\*_])"), r"_\1_"),
+    # **bold** to *bold*
+    ("*", re.compile(r"\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*"), r"*\1*"),
+    # __bold__ to *bold*
+    ("_", re.compile(r"__(?!\s)([^_\n]+?)(?<!\s)__"), r"*\1*"),
+    # ~~strike~~ to ~strike~
+    ("~", re.compile(r"~~(?!\s)([^~\n]+?)(?<!\s)~~"), r"~\1~"),
+    # [text](url) to <url|text>
+    ("[", re.compile(r"\[([^\]]+?)\]\(([^)]+?)\)"), r"<\2|\1>"),
+]
+
+
+def _strip_fence_languages(content: str) -> str:
+    if "```" not in content:
+        return content
+
+    result: List[str] = []
+    last = 0
+    while True:
+        match = FENCE_RE.search(content, last)
+        if match is None:
+            break
+
+        # 後の言語の置換は、置換後の```\nに続けてもう一度マッチする
+        end = match.end()
+        for pattern in FENCE_CONTINUATION_RES[match.lastindex :]:
+            continued = pattern.match(content, end)
+            if continued is not None:
+                end = continued.end()
+
+        result.append(content[last : match.start()])
+        result.append("```\n")
+        last = end
+
+    result.append(content[last:])
+    return "".join(result)
 
 
 def format_assistant_reply(content: str) -> str:
-    for o, n in [
-        # Remove leading newlines
-        ("^\n+", ""),
-        # Remove prepended Slack user ID
-        ("^<@U.*?>\\s?:\\s?", ""),
-        # Remove code block tags since Slack doesn't render them in a message
-        ("```\\s*[Rr]ust\n", "```\n"),
-        ("```\\s*[Rr]uby\n", "```\n"),
-        ("```\\s*[Ss]cala\n", "```\n"),
-        ("```\\s*[Kk]otlin\n", "```\n"),
-        ("```\\s*[Jj]ava\n", "```\n"),
-        ("```\\s*[Gg]o\n", "```\n"),
-        ("```\\s*[Ss]wift\n", "```\n"),
-        ("```\\s*[Oo]objective[Cc]\n", "```\n"),
-        ("```\\s*[Cc]\n", "```\n"),
-        ("```\\s*[Cc][+][+]\n", "```\n"),
-        ("```\\s*[Cc][Pp][Pp]\n", "```\n"),
-        ("```\\s*[Cc]sharp\n", "```\n"),
-        ("```\\s*[Mm][Aa][Tt][Ll][Aa][Bb]\n", "```\n"),
-        ("```\\s*[Jj][Ss][Oo][Nn]\n", "```\n"),
-        ("```\\s*[Ll]a[Tt]e[Xx]\n", "```\n"),
-        ("```\\s*[Ll][Uu][Aa]\n", "```\n"),
-        ("```\\s*[Cc][Mm][Aa][Kk][Ee]\n", "```\n"),
-        ("```\\s*bash\n", "```\n"),
-        ("```\\s*zsh\n", "```\n"),
-        ("```\\s*sh\n", "```\n"),
-        ("```\\s*[Ss][Qq][Ll]\n", "```\n"),
-        ("```\\s*[Pp][Hh][Pp]\n", "```\n"),
-        ("```\\s*[Pp][Ee][Rr][Ll]\n", "```\n"),
-        ("```\\s*[Jj]ava[Ss]cript\n", "```\n"),
-        ("```\\s*[Ty]ype[Ss]cript\n", "```\n"),
-        ("```\\s*[Pp]ython\n", "```\n"),
-    ]:
-        content = re.sub(o, n, content)
+    # Remove leading newlines
+    content = LEADING_NEWLINES_RE.sub("", content)
+    content = LEADING_MENTION_RE.sub("", content)
+    content = _strip_fence_languages(content)
 
     # Convert from Markdown to Slack mrkdwn format
     content = markdown_to_slack(content)
@@ -43,32 +105,106 @@ def format_assistant_reply(content: str) -> str:
     return content
 
 
+def _text_to_slack(text: str, code: bool) -> str:
+    if code:
+        return text
+
+    for trigger, pattern, replacement in MRKDWN_RULES:
+        if trigger in text:
+            text = pattern.sub(replacement, text)
+    return text
+
+
 # Conversion from Markdown to Slack mrkdwn
 # See also: https://api.slack.com/reference/surfaces/formatting#basics
 def markdown_to_slack(content: str) -> str:
-    # Split the input string into parts based on code blocks and inline code
-    parts = re.split(r"(?s)(```.+?```|`[^`\n]+?`)", content)
+    return _markdown_to_slack(content)[0]
+
+
+def _markdown_to_slack(
+    content: str, code: bool | None = None
+) -> Tuple[str, bool | None]:
+    """codeは前の差分から続くテキストをコードとして扱うか。Noneなら続いていない
 
+    末尾のテキストが次の差分に続く場合、そのcodeも返す。
+    """
     # Apply the bold, italic, and strikethrough formatting to text not within code
-    result = ""
-    for part in parts:
-        if part.startswith("```") or part.startswith("`"):
-            result += part
-        else:
-            for o, n in [
-                (
-                    r"\*\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*\*",
-                    r"_*\1*_",
-                ),  # ***bold italic*** to *_bold italic_*
-                (
-                    r"(?<![\*_])\*(?!\s)([^\*\n]+?)(?<!\s)\*(?![\*_])",
-                    r"_\1_",
-                ),  # *italic* to _italic_
-                (r"\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*", r"*\1*"),  # **bold** to *bold*
-                (r"__(?!\s)([^_\n]+?)(?<!\s)__", r"*\1*"),  # __bold__ to *bold*
-                (r"~~(?!\s)([^~\n]+?)(?<!\s)~~", r"~\1~"),  # ~~strike~~ to ~strike~
-                (r"\[([^\]]+?)\]\(([^)]+?)\)", r"<\2|\1>"),  # [text](url) to <url|text>
-            ]:
-                part = re.sub(o, n, part)
-            result += part
-    return result
+    result: List[str] = []
+    last = 0
+    for match in CODE_RE.finditer(content):
+        text = content[last : match.start()]
+        # 以前の実装と同じく、`で始まる部分はコードとして扱う
+        if code is None:
+            code = text.startswith("`")
+        result.append(_text_to_slack(text, code))
+        result.append(match.group())
+        last = match.end()
+        code = None
+
+    text = content[last:]
+    if code is None and text != "":
+        code = text.startswith("`")
+    result.append(_text_to_slack(text, bool(code)))
+    return ("".join(result), code)
+
+
+class SlackFormatStream:
+    """ストリームの差分をformat_assistant_replyで変換する
+
+    後から届く文字で結果が変わらない行までを変換して返すため、
+    返した文字列を全て繋げると全体をformat_assistant_replyで変換した結果と一致する。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        # 最後に変換したテキストの続きをコードとして扱うか
+        self.code: bool | None = None
+
+    def feed(self, delta: str) -> str:
+        self.buffer += delta
+
+        if not self.started:
+            # 先頭のメンションの削除は、メンションの後の2行目までかかる
+            content = LEADING_NEWLINES_RE.sub("", self.buffer)
+            if content.count("\n") < 2:
+                return ""
+            self.buffer = LEADING_MENTION_RE.sub("", content)
+            self.started = True
+
+        # 最後の改行まで変換できるかを確かめ、できなければ次の差分を待つ
+        cut = self.buffer.rfind("\n") + 1
+        if cut == 0 or FENCE_TAIL_RE.search(self.buffer, 0, cut) is not None:
+            return ""
+
+        content = _strip_fence_languages(self.buffer[:cut])
+        if not self._is_closed(content):
+            return ""
+
+        self.buffer = self.buffer[cut:]
+        return self._convert(content)
+
+    def finish(self) -> str:
+        content, self.buffer = self.buffer, ""
+        if not self.started:
+            self.started = True
+            return format_assistant_reply(content)
+
+        return self._convert(_strip_fence_languages(content))
+
+    def _convert(self, content: str) -> str:
+        converted, self.code = _markdown_to_slack(content, self.code)
+        return converted
+
+    @staticmethod
+    def _is_closed(content: str) -> bool:
+        # コードブロックやリンクが閉じていなければ、続きで結果が変わる
+        last = 0
+        for match in CODE_RE.finditer(content):
+            # 一部がコードになった```も、続きでコードブロックの開始になりうる
+            if "```" in content[last : match.start() + 2]:
+                return False
+            last = match.end()
+
+        text = content[last:]
+        return "```" not in text and LINK_TAIL_RE.search(text) is None
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from json import dumps
+from typing import List
+
+from slack_sdk.errors import SlackApiError
+
+from .chunker import SlackChunker, SlackUpdatingChunker
+
+
+async def _wait_all(chunker: SlackChunker) -> List[Exception]:
+    # 投稿が全て終わるまで待つ。失敗しても履歴は保存したいため、例外は記録して返す
+    futures, chunker.futures = chunker.futures, []
+    errors: List[Exception] = []
+    for future in futures:
+        try:
+            await future
+        except Exception as e:
+            logging.error(f"Failed to post to {chunker.channel}: {e}")
+            errors.append(e)
+    return errors
+
+
+async def _post_text(chunker: SlackChunker, text: str):
+    try:
+        await chunker.client.chat_postMessage(
+            channel=chunker.channel,
+            thread_ts=chunker.thread_ts,
+            text=text,
+        )
+    except Exception as e:
+        logging.error(f"Failed to post text: {e}")
+
+
+class AsyncSlackChunker(SlackChunker):
+    """SlackChunkerのasyncio版
+
+    clientにはAsyncWebClientを、post_queueにはAsyncSlackPostQueueを渡す。
+    """
+
+    async def wait(self) -> List[Exception]:
+        return await _wait_all(self)
+
+    async def _post_text(self, text: str):
+        await _post_text(self, text)
+
+    async def _post(self, blocks: List[dict], reference_md: str):
+        try:
+            await self.client.chat_postMessage(
+                channel=self.channel,
+                thread_ts=self.thread_ts,
+                metadata={
+                    "event_type": "suisei_blocks",
+                    "event_payload": {
+                        "raw_text": reference_md,
+                    },
+                },
+                blocks=blocks,
+            )
+
+            logging.debug(reference_md)
+        except Exception as e:
+            if isinstance(e, SlackApiError) and e.response.status_code == 429:
+                # レート制限の場合はキューで待ってから再試行する
+                raise
+
+            logging.error(f"Failed to post message: {e} {dumps(blocks)}")
+
+            await self.client.chat_postMessage(
+                channel=self.channel,
+                thread_ts=self.thread_ts,
+                text=reference_md,
+            )
+
+
+class AsyncSlackUpdatingChunker(SlackUpdatingChunker):
+    """SlackUpdatingChunkerのasyncio版
+
+    clientにはAsyncWebClientを、post_queueにはAsyncSlackPostQueueを渡す。
+    """
+
+    async def _sync(self):
+        wait = self.synced_at + self.update_interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        with self.lock:
+            self.sync_pending = False
+            changed = [
+                (message, message["version"], list(message["blocks"]))
+                for message in self.messages
+                if message["version"] != message["synced_version"]
+            ]
+            markdowns = ["".join(message["markdown"]) for message, _, _ in changed]
+
+        for (message, version, blocks), markdown in zip(changed, markdowns):
+            await self._sync_message(message, blocks, markdown)
+            message["synced_version"] = version
+
+        self.synced_at = time.monotonic()
+
+    async def _sync_message(
+        self, message: dict, blocks: List[dict], reference_md: str
+    ):
+        if len(blocks) == 0:
+            if message["ts"] is None:
+                response = await self.client.chat_postMessage(
+                    channel=self.channel,
+                    thread_ts=self.thread_ts,
+                    text=self.PLACEHOLDER_TEXT,
+                )
+                message["ts"] = response["ts"]
+            return
+
+        metadata = {
+            "event_type": "suisei_blocks",
+            "event_payload": {
+                "raw_text": reference_md,
+            },
+        }
+
+        try:
+            if message["ts"] is None:
+                response = await self.client.chat_postMessage(
+                    channel=self.channel,
+                    thread_ts=self.thread_ts,
+                    metadata=metadata,
+                    blocks=blocks,
+                )
+                message["ts"] = response["ts"]
+            else:
+                await self.client.chat_update(
+                    channel=self.channel,
+                    ts=message["ts"],
+                    metadata=metadata,
+                    blocks=blocks,
+                )
+        except Exception as e:
+            if isinstance(e, SlackApiError) and e.response.status_code == 429:
+                # レート制限の場合はキューで待ってから再試行する
+                raise
+
+            logging.error(f"Failed to update message: {e} {dumps(blocks)}")
+
+            if message["ts"] is None:
+                response = await self.client.chat_postMessage(
+                    channel=self.channel,
+                    thread_ts=self.thread_ts,
+                    text=reference_md,
+                )
+                message["ts"] = response["ts"]
+            else:
+                await self.client.chat_update(
+                    channel=self.channel,
+                    ts=message["ts"],
+                    text=reference_md,
+                    blocks=[],
+                )
+
+    async def _post_text(self, text: str):
+        await _post_text(self, text)
+
+    async def _delete_placeholder(self):
+        # 何も生成されなかった場合はプレースホルダーを消す
+        message = self.messages[0]
+        if len(message["blocks"]) == 0 and message["ts"] is not None:
+            await self.client.chat_delete(channel=self.channel, ts=message["ts"])
+
+    async def wait(self) -> List[Exception]:
+        self._schedule_sync()
+        self.submit(self._delete_placeholder)
+        return await _wait_all(self)
@@ -1,49 +1,75 @@
 import logging
 import re
 from typing import List, Tuple
+from weakref import WeakKeyDictionary
 from marko import Markdown
 from marko.element import Element
 from marko.block import Document
 from marko.md_renderer import MarkdownRenderer
+from marko.parser import Parser
 from .extensions import SLACK_EXTENSION
 from suisei.slack_markdown.renderer import SlackRenderer
 
 INLINE_CODEBLOCK_RE = re.compile(r"(.+)```")
 
 
+class BlockBoundaryParser(Parser):
+    """トップレベルのブロックの終了位置を ``Document.block_ends`` に記録するParser"""
+
+    def parse(self, text: str) -> Document:
+        doc = super().parse(text)
+        # marko が各ブロックに付与する source_span の終端をそのまま使う
+        doc.block_ends = [child.source_span[1] for child in doc.children]
+        return doc
+
+
 class Chunker:
     def __init__(self, max_chunk_size: int = 1024):
         # Markdownになるかもしれないリスト
         self.lines = []
         # 未だ続く可能性のあるMarkdownの断片
         self.buffer = ""
-        # Markdown中のindex
-        self.index = 0
+        # 確定済みのブロックを除いた、未確定部分の先頭の行番号
+        self.line_index = 0
+        # 確定済みのブロックが空行で終わっているか
+        self.after_blank_line = False
+        # self.linesを結合した場合の長さ
+        self.length = -1
+        # パースしたバイト数の累計
+        self.parsed_bytes = 0
+        # 前回consumeで何も返せなかった時の状態
+        self.idle_state = None
+        # これまでに出力したブロック数とテキストの文字数
+        self.rendered_blocks = 0
+        self.rendered_chars = 0
 
         self.max_chunk_size = max_chunk_size
 
-        self.md = Markdown(renderer=SlackRenderer)
+        self.md = Markdown(parser=BlockBoundaryParser, renderer=SlackRenderer)
         self.md.use(SLACK_EXTENSION)
 
         self.md_ref = Markdown(renderer=MarkdownRenderer)
         self.md_ref.use(SLACK_EXTENSION)
+        # 要素ごとのMarkdownとしての長さ
+        self.md_length_cache: WeakKeyDictionary[Element, int] = WeakKeyDictionary()
 
         self.finished = False
 
     @staticmethod
     def _fix_line(line: str) -> List[str]:
         line = line.rstrip("\n ")
-        lines = [line]
 
-        def _fix_inline_codeblock(line: str) -> List[str]:
-            # 行末に来てるコードブロック
-            match = INLINE_CODEBLOCK_RE.match(line)
-            if match:
-                return [match.group(1), "```"]
-            return [line]
+        # 行末に来てるコードブロック
+        match = INLINE_CODEBLOCK_RE.match(line)
+        if match:
+            return [match.group(1), "```"]
+        return [line]
 
-        lines = sum([_fix_inline_codeblock(line) for line in lines], [])
-        return lines
+    def _extend_lines(self, lines: List[str]):
+        for line in lines:
+            for fixed in Chunker._fix_line(line):
+                self.lines.append(fixed)
+                self.length += len(fixed) + 1
 
     def feed(self, chunk: str):
         self.buffer += chunk
@@ -51,14 +77,14 @@ class Chunker:
 
         if last_line >= 0:
             lines = self.buffer[:last_line].split("\n")
-            self.lines.extend(sum([Chunker._fix_line(line) for line in lines], []))
+            self._extend_lines(lines)
             self.buffer = self.buffer[last_line + 1 :]
 
     def finish(self):
         self.finished = True
         if len(self.buffer) > 0:
             lines = self.buffer.split("\n")
-            self.lines.extend(sum([Chunker._fix_line(line) for line in lines], []))
+            self._extend_lines(lines)
 
         return self.lines
 
@@ -79,6 +105,9 @@ class Chunker:
     def _split_markdown(self, elements: List[Element]) -> List[List[Element]]:
         result: List[List[Element]] = []
         chunk: List[Element] = []
+        # chunkをMarkdownとして出力した場合の長さ
+        # トップレベルの要素は独立して出力されるため、要素ごとの長さの和になる
+        chunk_length = 0
         for element in elements:
             type = element.get_type(snake_case=True)
             if type == "table":
@@ -86,18 +115,21 @@ class Chunker:
                 result.append(chunk)
                 result.append([element])
                 chunk = []
+                chunk_length = 0
             elif type == "thematic_break":
                 # --- が来たら区切る
                 result.append(chunk)
                 chunk = [element]
+                chunk_length = self._md_length(element)
             else:
                 chunk.append(element)
+                chunk_length += self._md_length(element)
 
-            ref_md = self._render_md(chunk)
-            if len(ref_md) > self.max_chunk_size * 2:
+            if chunk_length > self.max_chunk_size * 2:
                 # 2倍以上になったら区切る
                 result.append(chunk)
                 chunk = []
+                chunk_length = 0
 
         if len(chunk) > 0:
             result.append(chunk)
@@ -123,24 +155,65 @@ class Chunker:
         doc.children = elements
         return self.md_ref.render(doc)
 
+    def _md_length(self, element: Element) -> int:
+        length = self.md_length_cache.get(element)
+        if length is None:
+            length = len(self._render_md([element]))
+            self.md_length_cache[element] = length
+        return length
+
+    def _parse_tail(self) -> Tuple[Document, str]:
+        # 確定済みの空行に続く空行は、その空行の一部として扱う
+        while self.after_blank_line and self.line_index < len(self.lines):
+            if self.lines[self.line_index].strip() != "":
+                self.after_blank_line = False
+                break
+            self.line_index += 1
+
+        # 確定済みのブロックは再パースしない
+        markdown = "\n".join(self.lines[self.line_index :])
+        self.parsed_bytes += len(markdown.encode("utf-8"))
+        return (self.md.parse(markdown), markdown)
+
+    def _advance(self, doc: Document, markdown: str, count: int):
+        # 確定したブロックの分だけ未確定部分の先頭を進める
+        end = doc.block_ends[count - 1]
+        last = doc.children[count - 1]
+        self.after_blank_line = last.get_type(snake_case=True) == "blank_line"
+        self.line_index += markdown.count("\n", 0, end)
+        if end >= len(markdown) and not markdown.endswith("\n"):
+            # 改行で終わっていない最終行も確定済み
+            self.line_index += 1
+
+    def _state(self) -> Tuple[int, int, bool]:
+        return (self.line_index, len(self.lines), self.finished)
+
+    def _idle(self) -> None:
+        self.idle_state = self._state()
+        return None
+
     def consume(self) -> Tuple[dict, str] | None:
-        markdown = "\n".join(self.lines)
-        parsed = self.md.parse(markdown).children
-        chunks = self._split_markdown(parsed[self.index :])
+        # 前回から行が増えていなければ結果は変わらない
+        if self._state() == self.idle_state:
+            return None
+
+        parsed_doc, markdown = self._parse_tail()
+        parsed = parsed_doc.children
+        chunks = self._split_markdown(parsed)
 
         if len(chunks) == 0:
-            return None
+            return self._idle()
 
         consumable = chunks if self._is_markdown_end(chunks[-1]) else chunks[:-1]
 
         if len(consumable) == 0:
-            return None
+            return self._idle()
 
         first = consumable[0]
 
         # 空の場合は無視
         if self._is_empty(first):
-            self.index += len(first)
+            self._advance(parsed_doc, markdown, len(first))
             return None
 
         doc = Document()
@@ -150,26 +223,41 @@ class Chunker:
 
         if len(consumable) == 1 and not self.finished:
             # これが途中のchunkの最後の場合、短すぎると分かれすぎるため待つ
-            if len(markdown) < self.max_chunk_size:
-                return None
+            if self.length < self.max_chunk_size:
+                return self._idle()
 
-        self.index += len(first)
+        self._advance(parsed_doc, markdown, len(first))
 
         try:
             raw_rendered = self.md.render(doc)
         except Exception as e:
             logging.error(f"Failed to render markdown: {e} {reference_md}")
-        if not SlackRenderer.validate(raw_rendered):
+
+        # 検証とブロックへのまとめは1回の走査で行う
+        stats = {}
+        try:
+            rendered = SlackRenderer.postprocess(raw_rendered, stats)
+        except ValueError:
             raw_rendered = self._fix_rendered(raw_rendered)
-            if not SlackRenderer.validate(raw_rendered):
-                raise ValueError(f"Invalid rendered markdown {raw_rendered} {first}")
+            try:
+                rendered = SlackRenderer.postprocess(raw_rendered, stats)
+            except ValueError as e:
+                raise ValueError(
+                    f"Invalid rendered markdown {raw_rendered} {first}"
+                ) from e
 
-        rendered = SlackRenderer.postprocess(raw_rendered)
+        self.rendered_blocks += stats["blocks"]
+        self.rendered_chars += stats["chars"]
 
         return (rendered, reference_md)
 
 
+import threading
+import time
+from concurrent.futures import Future
+from slack_sdk.errors import SlackApiError
 from slack_sdk.web import WebClient
+from suisei.slack_post_queue import SlackPostQueue
 
 
 class SlackChunker(Chunker):
@@ -178,12 +266,33 @@ class SlackChunker(Chunker):
         client: WebClient,
         channel: str,
         thread_ts: str,
+        post_queue: SlackPostQueue,
         max_chunk_size: int = 1024,
     ):
         super().__init__(max_chunk_size)
         self.client = client
         self.channel = channel
         self.thread_ts = thread_ts
+        self.post_queue = post_queue
+        self.futures: List[Future] = []
+
+    def submit(self, func) -> Future:
+        # 投稿はキューのワーカーで行い、ストリームの読み込みを止めない
+        future = self.post_queue.submit(self.channel, func)
+        self.futures.append(future)
+        return future
+
+    def wait(self) -> List[Exception]:
+        # 投稿が全て終わるまで待つ。失敗しても履歴は保存したいため、例外は記録して返す
+        futures, self.futures = self.futures, []
+        errors: List[Exception] = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Failed to post to {self.channel}: {e}")
+                errors.append(e)
+        return errors
 
     def _fix_rendered(self, elements):
         if len(elements) == 1 and elements[0]["type"] == "_embed_file":
@@ -194,11 +303,13 @@ class SlackChunker(Chunker):
             from io import BytesIO
 
             file_bytes = BytesIO(file.encode("utf-8"))
-            self.client.files_upload_v2(
-                channels=self.channel,
-                thread_ts=self.thread_ts,
-                filename=name,
-                file=file_bytes,
+            self.submit(
+                lambda: self.client.files_upload_v2(
+                    channels=self.channel,
+                    thread_ts=self.thread_ts,
+                    filename=name,
+                    file=file_bytes,
+                )
             )
             return [
                 {
@@ -213,12 +324,7 @@ class SlackChunker(Chunker):
             ]
         return super()._fix_rendered(elements)
 
-    def consume(self):
-        result = super().consume()
-        if result is None:
-            return None
-
-        blocks, reference_md = result
+    def _post(self, blocks: List[dict], reference_md: str):
         try:
             self.client.chat_postMessage(
                 channel=self.channel,
@@ -234,6 +340,10 @@ class SlackChunker(Chunker):
 
             print(reference_md)
         except Exception as e:
+            if isinstance(e, SlackApiError) and e.response.status_code == 429:
+                # レート制限の場合はキューで待ってから再試行する
+                raise
+
             from json import dumps
 
             logging.error(f"Failed to post message: {e} {dumps(blocks)}")
@@ -244,4 +354,186 @@ class SlackChunker(Chunker):
                 text=reference_md,
             )
 
+    def _post_text(self, text: str):
+        try:
+            self.client.chat_postMessage(
+                channel=self.channel,
+                thread_ts=self.thread_ts,
+                text=text,
+            )
+        except Exception as e:
+            logging.error(f"Failed to post text: {e}")
+
+    def consume(self):
+        result = super().consume()
+        if result is None:
+            return None
+
+        blocks, reference_md = result
+        self._publish(blocks, reference_md)
+
         return result
+
+    def _publish(self, blocks: List[dict], reference_md: str):
+        self.submit(lambda: self._post(blocks, reference_md))
+
+
+class SlackUpdatingChunker(SlackChunker):
+    """1つのメッセージをchat_updateで更新していくChunker
+
+    最初にプレースホルダーを投稿し、以降のchunkはそのメッセージに追記する。
+    ブロック数か文字数の上限を超える場合のみ新しいメッセージを投稿する。
+    """
+
+    PLACEHOLDER_TEXT = "生成中..."
+
+    def __init__(
+        self,
+        client: WebClient,
+        channel: str,
+        thread_ts: str,
+        post_queue: SlackPostQueue,
+        max_chunk_size: int = 256,
+        updates_per_second: float = 1,
+        max_blocks: int = 50,
+        max_chars: int = 12000,
+    ):
+        super().__init__(client, channel, thread_ts, post_queue, max_chunk_size)
+        self.update_interval = 1 / updates_per_second
+        self.max_blocks = max_blocks
+        self.max_chars = max_chars
+
+        self.lock = threading.Lock()
+        self.messages: List[dict] = []
+        self.sync_pending = False
+        self.synced_at = 0.0
+
+        # すぐにプレースホルダーを投稿する
+        self._new_message()
+        self._schedule_sync()
+
+    def _new_message(self) -> dict:
+        message = {
+            "ts": None,
+            "blocks": [],
+            "markdown": [],
+            "chars": 0,
+            "version": 0,
+            "synced_version": -1,
+        }
+        self.messages.append(message)
+        return message
+
+    def _publish(self, blocks: List[dict], reference_md: str):
+        with self.lock:
+            message = self.messages[-1]
+            if len(message["blocks"]) > 0 and (
+                len(message["blocks"]) + len(blocks) > self.max_blocks
+                or message["chars"] + len(reference_md) > self.max_chars
+            ):
+                message = self._new_message()
+
+            message["blocks"].extend(blocks)
+            message["markdown"].append(reference_md)
+            message["chars"] += len(reference_md)
+            message["version"] += 1
+
+        self._schedule_sync()
+
+    def _schedule_sync(self):
+        # 反映待ちの更新があれば、そちらにまとめる
+        with self.lock:
+            if self.sync_pending:
+                return
+            self.sync_pending = True
+
+        self.submit(self._sync)
+
+    def _sync(self):
+        wait = self.synced_at + self.update_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        with self.lock:
+            self.sync_pending = False
+            changed = [
+                (message, message["version"], list(message["blocks"]))
+                for message in self.messages
+                if message["version"] != message["synced_version"]
+            ]
+            markdowns = ["".join(message["markdown"]) for message, _, _ in changed]
+
+        for (message, version, blocks), markdown in zip(changed, markdowns):
+            self._sync_message(message, blocks, markdown)
+            message["synced_version"] = version
+
+        self.synced_at = time.monotonic()
+
+    def _sync_message(self, message: dict, blocks: List[dict], reference_md: str):
+        if len(blocks) == 0:
+            if message["ts"] is None:
+                response = self.client.chat_postMessage(
+                    channel=self.channel,
+                    thread_ts=self.thread_ts,
+                    text=self.PLACEHOLDER_TEXT,
+                )
+                message["ts"] = response["ts"]
+            return
+
+        metadata = {
+            "event_type": "suisei_blocks",
+            "event_payload": {
+                "raw_text": reference_md,
+            },
+        }
+
+        try:
+            if message["ts"] is None:
+                response = self.client.chat_postMessage(
+                    channel=self.channel,
+                    thread_ts=self.thread_ts,
+                    metadata=metadata,
+                    blocks=blocks,
+                )
+                message["ts"] = response["ts"]
+            else:
+                self.client.chat_update(
+                    channel=self.channel,
+                    ts=message["ts"],
+                    metadata=metadata,
+                    blocks=blocks,
+                )
+        except Exception as e:
+            if isinstance(e, SlackApiError) and e.response.status_code == 429:
+                # レート制限の場合はキューで待ってから再試行する
+                raise
+
+            from json import dumps
+
+            logging.error(f"Failed to update message: {e} {dumps(blocks)}")
+
+            if message["ts"] is None:
+                response = self.client.chat_postMessage(
+                    channel=self.channel,
+                    thread_ts=self.thread_ts,
+                    text=reference_md,
+                )
+                message["ts"] = response["ts"]
+            else:
+                self.client.chat_update(
+                    channel=self.channel,
+                    ts=message["ts"],
+                    text=reference_md,
+                    blocks=[],
+                )
+
+    def _delete_placeholder(self):
+        # 何も生成されなかった場合はプレースホルダーを消す
+        message = self.messages[0]
+        if len(message["blocks"]) == 0 and message["ts"] is not None:
+            self.client.chat_delete(channel=self.channel, ts=message["ts"])
+
+    def wait(self):
+        self._schedule_sync()
+        self.submit(self._delete_placeholder)
+        return super().wait()
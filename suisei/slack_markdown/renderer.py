@@ -12,6 +12,18 @@ from marko.ext.gfm.elements import Table
 
 TEXT_TYPES = ["text", "emoji", "link", "user", "channel"]
 
+# 要素のクラスごとの描画メソッドの名前
+RENDER_FUNC_NAMES: dict[type, str] = {}
+# 結果を引数のoutに追記する描画メソッド
+OUT_RENDER_FUNC_NAMES = {
+    "render_heading",
+    "render_setext_heading",
+    "render_plain_text",
+    "render_raw_text",
+    "render_literal",
+    "render_line_break",
+}
+
 
 class SlackRenderer(Renderer):
     def __init__(self) -> None:
@@ -21,12 +33,19 @@ class SlackRenderer(Renderer):
         self.list_indent = 0
 
     @staticmethod
-    def postprocess(children: list) -> Any:
+    def postprocess(children: list, stats: dict | None = None) -> Any:
+        """トップレベルの要素を検証しながらrich_textのブロックにまとめる
+
+        statsを渡すと、ブロック数と文字数を "blocks" と "chars" に記録する。
+        不正な要素があればValueErrorを送出する。
+        """
         rendered = []
         rich_text_children = []
+        chars = 0
 
         for child in children:
-            if isinstance(child, dict) and child["type"] == "rich_text":
+            chars += SlackRenderer._check(child)
+            if child["type"] == "rich_text":
                 if len(rich_text_children) > 0:
                     rendered.append(
                         {
@@ -36,7 +55,7 @@ class SlackRenderer(Renderer):
                     )
                 rendered.append(child)
                 rich_text_children = []
-            elif isinstance(child, dict) and not child["type"].startswith("rich_text"):
+            elif not child["type"].startswith("rich_text"):
                 rich_text_children.append(
                     {"type": "rich_text_section", "elements": [child]}
                 )
@@ -51,29 +70,83 @@ class SlackRenderer(Renderer):
                 }
             )
 
+        if stats is not None:
+            stats["blocks"] = len(rendered)
+            stats["chars"] = chars
+
         return rendered
 
     @staticmethod
-    def validate(element: dict) -> bool:
-        if isinstance(element, list):
-            return all(SlackRenderer.validate(child) for child in element)
-        if not isinstance(element, dict):
-            return False
-        if "type" not in element:
-            return False
+    def _check(element: Any) -> int:
+        # 不正な要素ならValueErrorを送出し、正しければテキストの文字数を返す
+        if not isinstance(element, dict) or "type" not in element:
+            raise ValueError(f"Invalid element: {element}")
         if element["type"].startswith("_"):
-            return False
+            raise ValueError(f"Unresolved element: {element['type']}")
         if "elements" in element and element["type"].startswith("rich_text"):
-            return all(SlackRenderer.validate(child) for child in element["elements"])
+            return sum(SlackRenderer._check(child) for child in element["elements"])
+        return len(element.get("text", ""))
+
+    @staticmethod
+    def validate(element: dict) -> bool:
+        try:
+            if isinstance(element, list):
+                for child in element:
+                    SlackRenderer._check(child)
+            else:
+                SlackRenderer._check(element)
+        except ValueError:
+            return False
         return True
 
-    def render_children(self, element: Any) -> Any:
-        rendered = [self.render(child) for child in element.children]  # type: ignore
-        rendered = list(filter(None, rendered))
-        rendered = map(lambda x: x if isinstance(x, list) else [x], rendered)
-        rendered = sum(rendered, [])
+    def _func_name(self, element: Any) -> str:
+        # get_typeは毎回正規表現で型名を変換するため、クラスごとに覚えておく
+        func_name = RENDER_FUNC_NAMES.get(type(element))
+        if func_name is None:
+            func_name = "render_" + element.get_type(snake_case=True)
+            RENDER_FUNC_NAMES[type(element)] = func_name
+        return func_name
+
+    def render(self, element: Any) -> Any:
+        if not self.root_node or not hasattr(element, "get_type"):
+            return super().render(element)
+
+        render_func = getattr(self, self._func_name(element), None)
+        if render_func is not None and (
+            getattr(render_func, "_force_delegate", False) or self.delegate
+        ):
+            return render_func(element)
+        return self.render_children(element)
 
-        return rendered
+    def render_children(self, element: Any, out: list | None = None) -> Any:
+        """子要素の結果をoutに追記して返す
+
+        テキストや見出しのように結果をそのまま親に渡す要素は、
+        中間のリストを作らずに同じoutへ書き込む。
+        """
+        if out is None:
+            out = []
+        for child in element.children:  # type: ignore
+            func_name = self._func_name(child)
+            render_func = getattr(self, func_name, None)
+            if render_func is None or not (
+                getattr(render_func, "_force_delegate", False) or self.delegate
+            ):
+                self.render_children(child, out)
+                continue
+            if func_name in OUT_RENDER_FUNC_NAMES:
+                render_func(child, out)
+                continue
+
+            rendered = render_func(child)
+            if not rendered:
+                continue
+            if isinstance(rendered, list):
+                out.extend(rendered)
+            else:
+                out.append(rendered)
+
+        return out
 
     def render_paragraph(self, element: block.Paragraph) -> str:
         children = self.render_children(element)
@@ -113,10 +186,13 @@ class SlackRenderer(Renderer):
 
         all_section = all(child["type"] == "rich_text_section" for child in children)
         if all_section:
+            elements = []
+            for child in children:
+                elements.extend(child["elements"])
             rendered[0]["elements"] = [
                 {
                     "type": "rich_text_section",
-                    "elements": sum(list(map(lambda x: x["elements"], children)), []),
+                    "elements": elements,
                 }
             ]
         else:
@@ -193,11 +269,13 @@ class SlackRenderer(Renderer):
     def render_thematic_break(self, element: block.ThematicBreak) -> str:
         return []
 
-    def render_heading(self, element: block.Heading) -> str:
-        return self.render_children(element)
+    def render_heading(self, element: block.Heading, out: list | None = None) -> str:
+        return self.render_children(element, out)
 
-    def render_setext_heading(self, element: block.SetextHeading) -> str:
-        return self.render_heading(cast("block.Heading", element))
+    def render_setext_heading(
+        self, element: block.SetextHeading, out: list | None = None
+    ) -> str:
+        return self.render_heading(cast("block.Heading", element), out)
 
     def render_blank_line(self, element: block.BlankLine) -> str:
         return [
@@ -259,10 +337,10 @@ class SlackRenderer(Renderer):
     def render_code_span(self, element: inline.CodeSpan) -> str:
         return self._render_text_style(element, "code")
 
-    def render_plain_text(self, element: Any) -> str:
+    def render_plain_text(self, element: Any, out: list | None = None) -> str:
         if isinstance(element.children, str):
-            return self.render_raw_text(cast("inline.RawText", element))
-        return self.render_children(element)
+            return self.render_raw_text(cast("inline.RawText", element), out)
+        return self.render_children(element, out)
 
     def render_link(self, element: inline.Link) -> dict:
         url = self.escape_url(element.dest)
@@ -292,14 +370,22 @@ class SlackRenderer(Renderer):
             }
         ]
 
-    def render_literal(self, element: inline.Literal) -> str:
-        return self.render_raw_text(cast("inline.RawText", element))
+    def render_literal(self, element: inline.Literal, out: list | None = None) -> str:
+        return self.render_raw_text(cast("inline.RawText", element), out)
 
-    def render_raw_text(self, element: inline.RawText) -> str:
-        return [{"type": "text", "text": element.children}]
+    def render_raw_text(self, element: inline.RawText, out: list | None = None) -> str:
+        if out is None:
+            out = []
+        out.append({"type": "text", "text": element.children})
+        return out
 
-    def render_line_break(self, element: inline.LineBreak) -> str:
-        return [{"type": "text", "text": "\n"}]
+    def render_line_break(
+        self, element: inline.LineBreak, out: list | None = None
+    ) -> str:
+        if out is None:
+            out = []
+        out.append({"type": "text", "text": "\n"})
+        return out
 
     def render_table(self, element: Table) -> str:
         from io import StringIO
@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from slack_sdk.errors import SlackApiError
+
+# ワーカーが終了するまでの待機時間
+WORKER_IDLE_SECONDS = 30
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        # Retry-Afterで指定された再開時刻
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _try_acquire(self) -> float:
+        """トークンを取得できれば0を、できなければ待つべき秒数を返す"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while (wait := self._try_acquire()) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        while (wait := self._try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self._refill(now)
+        self.tokens = 0
+
+
+def _retry_after(error: SlackApiError) -> float | None:
+    response = error.response
+    if response is None or response.status_code != 429:
+        return None
+
+    for key, value in response.headers.items():
+        if key.lower() == "retry-after":
+            if isinstance(value, list):
+                value = value[0]
+            return float(value)
+
+    return 1.0
+
+
+class SlackPostQueue:
+    """チャンネルごとにSlackへの投稿を順番に行うキュー
+
+    投稿はチャンネルごとのワーカースレッドで実行されるため、呼び出し元を待たせない。
+    同じチャンネルへの投稿は投入された順に実行される。
+    """
+
+    def __init__(self, rate: float = 1, burst: int = 1, max_retry: int = 3):
+        self.rate = rate
+        self.burst = burst
+        self.max_retry = max_retry
+        self._lock = threading.Lock()
+        self._queues: Dict[str, Queue[Tuple[Callable[[], Any], Future]]] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def submit(self, channel: str, func: Callable[[], Any]) -> Future:
+        future = Future()
+
+        with self._lock:
+            queue = self._queues.get(channel)
+            if queue is None:
+                queue = Queue()
+                self._queues[channel] = queue
+                if channel not in self._buckets:
+                    self._buckets[channel] = TokenBucket(self.rate, self.burst)
+
+                threading.Thread(
+                    target=self._worker,
+                    args=(channel, queue, self._buckets[channel]),
+                    name=f"slack-post-{channel}",
+                    daemon=True,
+                ).start()
+
+            queue.put((func, future))
+
+        return future
+
+    def _worker(
+        self,
+        channel: str,
+        queue: Queue[Tuple[Callable[[], Any], Future]],
+        bucket: TokenBucket,
+    ):
+        while True:
+            try:
+                func, future = queue.get(timeout=WORKER_IDLE_SECONDS)
+            except Empty:
+                with self._lock:
+                    # submitと競合しないようにロック中に確認する
+                    if queue.empty():
+                        del self._queues[channel]
+                        # 待機中でなければ、次の投稿では満タンのバケットと変わらない
+                        if bucket.paused_until <= time.monotonic():
+                            del self._buckets[channel]
+                        return
+                continue
+
+            if future.set_running_or_notify_cancel():
+                self._execute(channel, bucket, func, future)
+
+    def _execute(
+        self,
+        channel: str,
+        bucket: TokenBucket,
+        func: Callable[[], Any],
+        future: Future,
+    ):
+        retry = 0
+        while True:
+            bucket.acquire()
+            try:
+                result = func()
+            except SlackApiError as e:
+                # RateLimitErrorRetryHandlerでも解消しなかった場合はRetry-Afterまで止める
+                retry_after = _retry_after(e)
+                if retry_after is not None and retry < self.max_retry:
+                    logging.warning(
+                        f"Rate limited on {channel}, retry after {retry_after}s"
+                    )
+                    bucket.pause(retry_after)
+                    retry += 1
+                    continue
+                future.set_exception(e)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            return
+
+
+class AsyncSlackPostQueue:
+    """SlackPostQueueのasyncio版
+
+    投稿はチャンネルごとのタスクで実行するため、投稿のためのスレッドを使わない。
+    投入する関数はawaitableを返す必要があり、イベントループのスレッドから呼び出す。
+    """
+
+    def __init__(self, rate: float = 1, burst: int = 1, max_retry: int = 3):
+        self.rate = rate
+        self.burst = burst
+        self.max_retry = max_retry
+        self._queues: Dict[
+            str, asyncio.Queue[Tuple[Callable[[], Awaitable[Any]], asyncio.Future]]
+        ] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._workers: set[asyncio.Task] = set()
+
+    def submit(self, channel: str, func: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = asyncio.Queue()
+            self._queues[channel] = queue
+            if channel not in self._buckets:
+                self._buckets[channel] = TokenBucket(self.rate, self.burst)
+
+            worker = asyncio.create_task(
+                self._worker(channel, queue, self._buckets[channel]),
+                name=f"slack-post-{channel}",
+            )
+            # タスクが途中で破棄されないよう参照を持っておく
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+
+        queue.put_nowait((func, future))
+
+        return future
+
+    async def _worker(
+        self,
+        channel: str,
+        queue: asyncio.Queue[Tuple[Callable[[], Awaitable[Any]], asyncio.Future]],
+        bucket: TokenBucket,
+    ):
+        while True:
+            try:
+                func, future = await asyncio.wait_for(
+                    queue.get(), timeout=WORKER_IDLE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                # 同じイベントループで動くため、submitと競合しない
+                if queue.empty():
+                    del self._queues[channel]
+                    if bucket.paused_until <= time.monotonic():
+                        del self._buckets[channel]
+                    return
+                continue
+
+            if not future.cancelled():
+                await self._execute(channel, bucket, func, future)
+
+    async def _execute(
+        self,
+        channel: str,
+        bucket: TokenBucket,
+        func: Callable[[], Awaitable[Any]],
+        future: asyncio.Future,
+    ):
+        retry = 0
+        while True:
+            await bucket.aacquire()
+            try:
+                result = await func()
+            except SlackApiError as e:
+                retry_after = _retry_after(e)
+                if retry_after is not None and retry < self.max_retry:
+                    logging.warning(
+                        f"Rate limited on {channel}, retry after {retry_after}s"
+                    )
+                    bucket.pause(retry_after)
+                    retry += 1
+                    continue
+                future.set_exception(e)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            return
@@ -1,15 +1,44 @@
+import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Tuple
+from typing import TYPE_CHECKING, List, Tuple
 
 import requests
 from pytz import timezone
+from requests.adapters import HTTPAdapter
 from slack_bolt import BoltContext
-
-from .env import SLACK_BOT_TOKEN
+from slack_sdk import WebClient
+
+if TYPE_CHECKING:
+    from slack_sdk.web.async_client import AsyncWebClient
+
+from .env import (
+    GEMINI_FILE_MAX_SIZE,
+    MEDIA_IMAGE_FORMAT,
+    MEDIA_IMAGE_QUALITY,
+    MEDIA_MAX_PIXELS,
+    MEDIA_PDF_MAX_PAGES,
+    MEDIA_TIMEOUT_SECONDS,
+    MEDIA_WORKERS,
+    SLACK_BOT_TOKEN,
+    SLACK_DOWNLOAD_CONCURRENCY,
+    SLACK_DOWNLOAD_TIMEOUT,
+)
+from .media import can_trim_pdf, is_preprocessable, preprocess_media
 
 EMOJI_PATTERN = re.compile(r":[\w_-]+:")
 
+if MEDIA_PDF_MAX_PAGES > 0 and not can_trim_pdf():
+    logging.warning("MEDIA_PDF_MAX_PAGES is ignored because pypdf is not installed")
+
+# ファイルのダウンロードはコネクションを使い回し、並列に行う
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=SLACK_DOWNLOAD_CONCURRENCY))
+download_executor = ThreadPoolExecutor(
+    max_workers=SLACK_DOWNLOAD_CONCURRENCY, thread_name_prefix="slack-download"
+)
+
 
 def remove_unused_element(context: BoltContext, text: str) -> str:
     text = text.replace(f"<@{context.bot_user_id}>", "")
@@ -21,37 +50,181 @@ def is_this_app_mentioned(context: BoltContext, text: str) -> bool:
     return f"<@{context.bot_user_id}>" in text
 
 
-def download_slack_image_content(image_url: str) -> Tuple[str, bytes]:
-    response = requests.get(
+def download_slack_image_content(
+    image_url: str, max_size: int = GEMINI_FILE_MAX_SIZE
+) -> Tuple[str, bytes]:
+    # 大きすぎるファイルはメモリに読み込む前に中断する
+    with session.get(
         image_url,
         headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
+        stream=True,
+        timeout=SLACK_DOWNLOAD_TIMEOUT,
+    ) as response:
+        if response.status_code != 200:
+            error = (
+                f"Request to {image_url} failed with status code {response.status_code}"
+            )
+            raise FileNotFoundError(error, response)
+
+        content_type = response.headers["content-type"]
+        if content_type.startswith("text/html"):
+            error = f"You don't have the permission to download this file: {image_url}"
+            raise FileNotFoundError(error, response)
+
+        if image_url.endswith(".pdf"):
+            content_type = "application/pdf"
+
+        if image_url.endswith(".csv"):
+            content_type = "text/plain"
+
+        if (
+            not content_type.startswith("image/")
+            and not content_type.startswith("application/pdf")
+            and not content_type.startswith("text/")
+        ):
+            error = f"The responded content-type is not for image data: {content_type}"
+            raise FileNotFoundError(error, response)
+
+        content_length = response.headers.get("content-length")
+        if (
+            max_size != -1
+            and content_length is not None
+            and int(content_length) > max_size
+        ):
+            raise ValueError(f"File size is too large: {content_length}")
+
+        content = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            content.extend(chunk)
+            if max_size != -1 and len(content) > max_size:
+                raise ValueError(f"File size is too large: over {max_size}")
+
+    return (content_type, bytes(content))
+
+
+# 画像の縮小はPillowがGILを解放するため、スレッドで並列に行う
+media_executor = (
+    ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+    if MEDIA_WORKERS > 0
+    else None
+)
+
+
+def process_media(mime_type: str, data: bytes) -> Tuple[str, bytes]:
+    """画像の縮小やPDFのページ数の制限を行う。失敗した場合は元のデータを返す"""
+    if not is_preprocessable(mime_type):
+        return (mime_type, data)
+
+    args = (
+        mime_type,
+        data,
+        MEDIA_MAX_PIXELS,
+        MEDIA_IMAGE_FORMAT,
+        MEDIA_IMAGE_QUALITY,
+        MEDIA_PDF_MAX_PAGES,
     )
-    if response.status_code != 200:
-        error = f"Request to {image_url} failed with status code {response.status_code}"
-        raise FileNotFoundError(error, response)
-
-    content_type = response.headers["content-type"]
-    if content_type.startswith("text/html"):
-        error = f"You don't have the permission to download this file: {image_url}"
-        raise FileNotFoundError(error, response)
-
-    if image_url.endswith(".pdf"):
-        content_type = "application/pdf"
-
-    if image_url.endswith(".csv"):
-        content_type = "text/plain"
-
-    if (
-        not content_type.startswith("image/")
-        and not content_type.startswith("application/pdf")
-        and not content_type.startswith("text/")
-    ):
-        error = f"The responded content-type is not for image data: {content_type}"
-        raise FileNotFoundError(error, response)
-
-    return (content_type, response.content)
+    try:
+        if media_executor is None:
+            return preprocess_media(*args)
+        # 時間がかかりすぎる場合は前処理を諦めて元のデータを使う
+        return media_executor.submit(preprocess_media, *args).result(
+            timeout=MEDIA_TIMEOUT_SECONDS
+        )
+    except Exception as e:
+        logging.warning(f"Failed to preprocess {mime_type}: {e}")
+        return (mime_type, data)
 
 
 def parse_ts(ts: str) -> datetime:
     unix = ts.split(".")[0]
     return timezone("Asia/Tokyo").localize(datetime.fromtimestamp(int(unix)))
+
+
+def fetch_thread_replies(
+    client: WebClient,
+    channel: str,
+    thread_ts: str,
+    oldest: str | None = None,
+) -> List[dict]:
+    """スレッドの返信を全て取得する。oldestを指定するとそれより新しい返信のみを返す"""
+    messages: List[dict] = []
+    cursor = None
+
+    while True:
+        response = client.conversations_replies(
+            channel=channel,
+            ts=thread_ts,
+            include_all_metadata=True,
+            cursor=cursor,
+            oldest=oldest,
+            limit=200,
+        )
+        messages.extend(response["messages"])
+
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not response.get("has_more") or not cursor:
+            break
+
+    return _drop_older_replies(messages, oldest)
+
+
+async def async_fetch_thread_replies(
+    client: "AsyncWebClient",
+    channel: str,
+    thread_ts: str,
+    oldest: str | None = None,
+) -> List[dict]:
+    """fetch_thread_repliesのAsyncWebClient版"""
+    messages: List[dict] = []
+    cursor = None
+
+    while True:
+        response = await client.conversations_replies(
+            channel=channel,
+            ts=thread_ts,
+            include_all_metadata=True,
+            cursor=cursor,
+            oldest=oldest,
+            limit=200,
+        )
+        messages.extend(response["messages"])
+
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not response.get("has_more") or not cursor:
+            break
+
+    return _drop_older_replies(messages, oldest)
+
+
+def _drop_older_replies(messages: List[dict], oldest: str | None) -> List[dict]:
+    if oldest is None:
+        return messages
+
+    # 親メッセージは常に含まれるため除外する
+    return [message for message in messages if float(message["ts"]) > float(oldest)]
+
+
+# Geminiが画像1枚に使うトークン数
+FILE_TOKENS = 258
+
+
+def estimate_tokens(message: dict) -> int:
+    # 日本語では1文字がおおよそ1トークンになるため、文字数をそのまま使う
+    return len(message.get("text", "")) + FILE_TOKENS * len(message.get("files", []))
+
+
+def window_messages(messages: List[dict], budget: int) -> List[dict]:
+    """新しいメッセージから順にbudgetトークンに収まるだけ残す"""
+    if budget <= 0:
+        return []
+
+    total = 0
+    start = len(messages)
+    while start > 0:
+        tokens = estimate_tokens(messages[start - 1])
+        if total + tokens > budget:
+            break
+        total += tokens
+        start -= 1
+
+    return messages[start:]
@@ -0,0 +1,59 @@
+import json
+from typing import List
+
+from valkey import Valkey
+from valkey.lock import Lock
+
+from .env import THREAD_LOCK_TIMEOUT
+from .valkey_client import get_valkey
+
+
+class ThreadQueue:
+    """スレッドごとの生成のロックと、生成中に届いたメッセージのキュー
+
+    同じスレッドで生成が同時に走らないようにし、生成中に届いたメッセージは
+    次のターンにまとめて渡す。
+    """
+
+    def __init__(self, valkey: Valkey | None = None):
+        self._valkey = valkey if valkey is not None else get_valkey()
+
+    @staticmethod
+    def _queue_key(channel: str, thread_ts: str) -> str:
+        return f"tq:{channel}-{thread_ts}"
+
+    @staticmethod
+    def _lock_key(channel: str, thread_ts: str) -> str:
+        return f"tl:{channel}-{thread_ts}"
+
+    def push(self, channel: str, thread_ts: str, message: dict):
+        key = self._queue_key(channel, thread_ts)
+        with self._valkey.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, json.dumps(message))
+            pipe.expire(key, THREAD_LOCK_TIMEOUT)
+            pipe.execute()
+
+    def pop_all(self, channel: str, thread_ts: str) -> List[dict]:
+        key = self._queue_key(channel, thread_ts)
+        with self._valkey.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            values, _ = pipe.execute()
+
+        return [json.loads(value) for value in values]
+
+    def has_pending(self, channel: str, thread_ts: str) -> bool:
+        return self._valkey.llen(self._queue_key(channel, thread_ts)) > 0
+
+    def acquire(self, channel: str, thread_ts: str) -> Lock | None:
+        """ロックを取得する。既に生成中の場合はNoneを返す"""
+        # asyncioのモードでは取得と解放が別のスレッドで行われることがある
+        lock = self._valkey.lock(
+            self._lock_key(channel, thread_ts),
+            timeout=THREAD_LOCK_TIMEOUT,
+            thread_local=False,
+        )
+        if not lock.acquire(blocking=False):
+            return None
+
+        return lock
@@ -0,0 +1,56 @@
+from typing import Literal, Union
+
+from valkey import Valkey
+
+from .conversation_store import ConversationStore
+from .env import CONVERSATION_TTL
+from .valkey_client import get_valkey
+
+ThreadStatus = Union[Literal["joined"], Literal["aborted"]]
+
+
+class ThreadRegistry:
+    """Botが参加している・abortされたスレッドの記録
+
+    abortされたスレッドのメッセージをSlack APIを呼ばずに除外するために使う。
+    記録がない場合は参加していないとは限らないため、呼び出し元で履歴を確認する。
+    """
+
+    JOINED = "joined"
+    ABORTED = "aborted"
+
+    def __init__(self, valkey: Valkey | None = None):
+        self._valkey = valkey if valkey is not None else get_valkey()
+
+    @staticmethod
+    def _key(channel: str, thread_ts: str) -> str:
+        return f"th:{channel}-{thread_ts}"
+
+    def get(self, channel: str, thread_ts: str) -> ThreadStatus | None:
+        # 記録より前から会話が保存されているスレッドも参加済みとして扱う
+        with self._valkey.pipeline(transaction=False) as pipe:
+            pipe.get(self._key(channel, thread_ts))
+            pipe.exists(ConversationStore._key(channel, thread_ts))
+            status, stored = pipe.execute()
+
+        if status is not None:
+            return status.decode()
+        if stored:
+            return self.JOINED
+        return None
+
+    def join(self, channel: str, thread_ts: str):
+        # abortされたスレッドはメンションされてもabortのまま
+        key = self._key(channel, thread_ts)
+        with self._valkey.pipeline(transaction=False) as pipe:
+            pipe.set(key, self.JOINED, nx=True)
+            if CONVERSATION_TTL > 0:
+                pipe.expire(key, CONVERSATION_TTL)
+            pipe.execute()
+
+    def abort(self, channel: str, thread_ts: str):
+        key = self._key(channel, thread_ts)
+        if CONVERSATION_TTL > 0:
+            self._valkey.set(key, self.ABORTED, ex=CONVERSATION_TTL)
+        else:
+            self._valkey.set(key, self.ABORTED)
@@ -0,0 +1,151 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, List
+
+from google.genai.types import Content, FunctionCall, Part
+
+TRUNCATED_MARKER = "\n...(truncated)"
+
+# 実行中の関数呼び出しの期限。ワーカーのスレッドごとに設定する
+_local = threading.local()
+
+
+class ToolTimeoutError(TimeoutError):
+    pass
+
+
+def remaining_time() -> float | None:
+    """実行中の関数呼び出しの残り時間。ToolRunnerの外で呼ばれた場合はNone"""
+    deadline = getattr(_local, "deadline", None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check_deadline():
+    """実行中の関数呼び出しが期限を過ぎていればToolTimeoutErrorを送出する
+
+    時間切れになった呼び出しのスレッドは止められないため、時間のかかる関数は
+    途中でこれを呼んで打ち切る。
+    """
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise ToolTimeoutError("Tool call exceeded its deadline")
+
+
+class ToolRunner:
+    """モデルが要求した関数呼び出しを実行し、function responseを返す
+
+    同じターンの呼び出しは互いに独立しているため、上限付きのプールで並列に実行する。
+    同じ引数の呼び出しの結果はcache_ttl秒の間使い回す。
+    """
+
+    def __init__(
+        self,
+        functions: Dict[str, Callable[..., Any]],
+        max_workers: int = 4,
+        timeout: float = 30,
+        max_result_chars: int = 20000,
+        cache_size: int = 256,
+        cache_ttl: float = 300,
+    ):
+        self.functions = functions
+        self.timeout = timeout
+        self.max_result_chars = max_result_chars
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tool"
+        )
+
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    @staticmethod
+    def _cache_key(call: FunctionCall) -> str:
+        return json.dumps([call.name, call.args or {}], sort_keys=True, default=str)
+
+    def _get_cache(self, key: str) -> str | None:
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is None:
+                return None
+
+            expires_at, result = cached
+            if expires_at < time.monotonic():
+                del self._cache[key]
+                return None
+
+            self._cache.move_to_end(key)
+            return result
+
+    def _set_cache(self, key: str, result: str):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _format(self, result: Any) -> str:
+        if isinstance(result, bytes):
+            result = result.decode("utf-8", errors="replace")
+        elif not isinstance(result, str):
+            result = json.dumps(result, ensure_ascii=False, default=str)
+
+        # 大きすぎる結果はコンテキストを圧迫するため切り詰める
+        if len(result) > self.max_result_chars:
+            result = result[: self.max_result_chars] + TRUNCATED_MARKER
+        return result
+
+    def _call(self, call: FunctionCall, deadline: float) -> str:
+        function = self.functions.get(call.name)
+        if function is None:
+            raise ValueError(f"Unknown function: {call.name}")
+
+        _local.deadline = deadline
+        try:
+            # プールで待っている間に期限を過ぎていれば実行しない
+            check_deadline()
+            return self._format(function(**(call.args or {})))
+        finally:
+            _local.deadline = None
+
+    def run(self, calls: List[FunctionCall]) -> Content:
+        futures = {}
+        results: Dict[int, dict] = {}
+
+        # タイムアウトは呼び出しごとに、呼び出しを投入し始めた時点から数える
+        deadline = time.monotonic() + self.timeout
+        for i, call in enumerate(calls):
+            cached = self._get_cache(self._cache_key(call))
+            if cached is not None:
+                results[i] = {"result": cached}
+            else:
+                futures[i] = self._executor.submit(self._call, call, deadline)
+
+        for i, future in futures.items():
+            call = calls[i]
+            try:
+                result = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except (FutureTimeoutError, ToolTimeoutError):
+                logging.warning(f"Tool {call.name} timed out")
+                results[i] = {"error": f"Timed out after {self.timeout} seconds"}
+            except Exception as e:
+                logging.warning(f"Tool {call.name} failed: {e}")
+                results[i] = {"error": str(e)}
+            else:
+                self._set_cache(self._cache_key(call), result)
+                results[i] = {"result": result}
+
+        return Content(
+            role="user",
+            parts=[
+                Part.from_function_response(name=call.name, response=results[i])
+                for i, call in enumerate(calls)
+            ],
+        )
@@ -1,10 +1,31 @@
+import logging
 import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Self
 from github import Github, GithubIntegration
 from github.Auth import AppAuth
+from github.Repository import Repository
 
 from google.genai.types import FunctionDeclaration
 from google.genai import Client
+from valkey import Valkey
+
+from ..tool_runner import ToolTimeoutError
+from ..valkey_client import get_valkey
+from .github_cache import (
+    CachedAppInstallationAuth,
+    CachingHTTPSConnection,
+    GitHubHTTPCache,
+    InstallationResolver,
+)
+from .repo_snapshot import RepositorySnapshotCache
+
+# デフォルトブランチの変更などを反映するため、リポジトリの情報は一定時間で取得し直す
+REPO_CACHE_TTL = 60 * 60
+REPO_CACHE_SIZE = 256
 
 
 class GitHubTools:
@@ -14,16 +35,108 @@ class GitHubTools:
         if GITHUB_APP_ID is None or GITHUB_APP_PRIVATE_KEY is None:
             return None
 
-        gh = GithubIntegration(auth=AppAuth(GITHUB_APP_ID, GITHUB_APP_PRIVATE_KEY))
-        gi = gh.get_installations().get_page(0)[0]
+        valkey = get_valkey()
+
+        GITHUB_HTTP_CACHE_TTL = int(
+            os.environ.get("GITHUB_HTTP_CACHE_TTL", 60 * 60 * 24)
+        )
+        http_cache = None
+        if GITHUB_HTTP_CACHE_TTL > 0:
+            http_cache = GitHubHTTPCache(valkey, GITHUB_HTTP_CACHE_TTL)
+
+        app_auth = AppAuth(GITHUB_APP_ID, GITHUB_APP_PRIVATE_KEY)
+        installations = InstallationResolver(
+            GithubIntegration(auth=app_auth),
+            GITHUB_APP_ID,
+            valkey,
+            ttl=int(os.environ.get("GITHUB_INSTALLATION_TTL", 60 * 60 * 24)),
+        )
+
+        # 0を指定するとスナップショットを使わずにREST APIで取得する
+        # 1つのリポジトリのダウンロードもこの大きさまでで打ち切る
+        GITHUB_SNAPSHOT_MAX_BYTES = int(
+            os.environ.get("GITHUB_SNAPSHOT_MAX_BYTES", 256 * 1024 * 1024)
+        )
+        snapshots = None
+        if GITHUB_SNAPSHOT_MAX_BYTES > 0:
+            snapshots = RepositorySnapshotCache(
+                os.environ.get(
+                    "GITHUB_SNAPSHOT_DIR",
+                    os.path.join(tempfile.gettempdir(), "suisei-snapshots"),
+                ),
+                max_bytes=GITHUB_SNAPSHOT_MAX_BYTES,
+                ref_ttl=float(os.environ.get("GITHUB_REF_TTL", 60)),
+            )
+
+        return GitHubTools(app_auth, installations, valkey, snapshots, http_cache)
+
+    def __init__(
+        self,
+        app_auth: AppAuth,
+        installations: InstallationResolver,
+        valkey: Valkey,
+        snapshots: RepositorySnapshotCache | None = None,
+        http_cache: GitHubHTTPCache | None = None,
+    ):
+        self.app_auth = app_auth
+        self.installations = installations
+        self.snapshots = snapshots
+        self.http_cache = http_cache
+        self._valkey = valkey
+        # ツールはプールのスレッドから並列に呼ばれる
+        self._lock = threading.Lock()
+        self._clients: dict[int, Github] = {}
+        self._repos: OrderedDict[str, tuple[float, Repository]] = OrderedDict()
 
-        return GitHubTools(gi.get_github_for_installation())
+    def _get_github(self, repo_name: str) -> Github:
+        # リポジトリのオーナーがインストールしたAppとして操作する
+        owner, _, repo = repo_name.partition("/")
+        installation_id = self.installations.get(owner, repo)
 
-    def __init__(self, gh: Github):
-        self.github = gh
+        with self._lock:
+            github = self._clients.get(installation_id)
+            if github is None:
+                auth = CachedAppInstallationAuth(
+                    self.installations.integration,
+                    self.app_auth.app_id,
+                    installation_id,
+                    self._valkey,
+                )
+                github = Github(auth=auth)
+                # このAppのクライアントだけで条件付きリクエストを使う
+                if self.http_cache is not None:
+                    CachingHTTPSConnection.install(github, self.http_cache)
+                self._clients[installation_id] = github
+        return github
 
-    def _get_repo(self, repo_name: str):
-        return self.github.get_repo(repo_name)
+    def _get_repo(self, repo_name: str) -> Repository:
+        # リポジトリの情報はほとんど変わらないため、一定時間使い回す
+        with self._lock:
+            cached = self._repos.get(repo_name)
+            if cached is not None and cached[0] > time.monotonic():
+                self._repos.move_to_end(repo_name)
+                return cached[1]
+
+        repo = self._get_github(repo_name).get_repo(repo_name)
+        with self._lock:
+            self._repos[repo_name] = (time.monotonic() + REPO_CACHE_TTL, repo)
+            self._repos.move_to_end(repo_name)
+            while len(self._repos) > REPO_CACHE_SIZE:
+                self._repos.popitem(last=False)
+        return repo
+
+    def _get_snapshot(self, repo: Repository, ref: str):
+        if self.snapshots is None:
+            return None
+
+        try:
+            return self.snapshots.get(repo, ref)
+        except ToolTimeoutError:
+            # 期限を過ぎていればREST APIでも取得しない
+            raise
+        except Exception as e:
+            logging.warning(f"Failed to get snapshot of {repo.full_name}@{ref}: {e}")
+            return None
 
     def get_github_files(self, repo: str, ref: str = "", path: str = "") -> list[str]:
         """Get file list from repository. Return file / directory list.
@@ -47,6 +160,13 @@ class GitHubTools:
         """
         repo = self._get_repo(repo)
         ref = ref if ref != "" else repo.default_branch
+
+        snapshot = self._get_snapshot(repo, ref)
+        if snapshot is not None:
+            with snapshot:
+                entries = snapshot.list(path)
+            return "\n".join([f"{type} {name} {size}" for type, name, size in entries])
+
         path = path if path != "" else "/"
         contents = repo.get_contents(path, ref)
         return "\n".join(
@@ -74,13 +194,23 @@ class GitHubTools:
         """
         repo = self._get_repo(repo)
         ref = ref if ref != "" else repo.default_branch
+
+        snapshot = self._get_snapshot(repo, ref)
+        if snapshot is not None:
+            with snapshot:
+                return snapshot.read(path)
+
         content = repo.get_contents(path, ref)
         return content.decoded_content
 
     def function_declarations(self, client: Client) -> List[FunctionDeclaration]:
         return [
-            FunctionDeclaration.from_function(client, self.get_github_files),
-            FunctionDeclaration.from_function(client, self.get_github_file_content),
+            FunctionDeclaration.from_callable(
+                client=client, callable=self.get_github_files
+            ),
+            FunctionDeclaration.from_callable(
+                client=client, callable=self.get_github_file_content
+            ),
         ]
 
     def function_dict(self) -> dict:
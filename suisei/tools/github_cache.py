@@ -0,0 +1,229 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from functools import partial
+
+from github import Github
+from github.Auth import Auth
+from github.GithubIntegration import GithubIntegration
+from github.Requester import HTTPSRequestsConnectionClass, RequestsResponse
+from valkey import Valkey
+
+# Requesterがコネクションを作る際に使うクラス。PyGithub 2.x の非公開の属性
+CONNECTION_CLASS_ATTRIBUTE = "_Requester__connectionClass"
+
+# 期限切れ直前のトークンは使わずに取得し直す
+TOKEN_EXPIRATION_MARGIN_SECONDS = 5 * 60
+
+
+class GitHubHTTPCache:
+    """GitHub APIのGETのレスポンスを、ETagやLast-Modifiedと一緒にValkeyに保存する"""
+
+    def __init__(self, valkey: Valkey, ttl: int, max_size: int = 1024 * 1024):
+        self._valkey = valkey
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # ツールのプールの複数のスレッドから数える
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def _key(host: str, url: str, accept: str) -> str:
+        # GitHub Enterpriseなど、別のホストの同じパスを区別する
+        digest = hashlib.sha256(f"{accept}\n{host}\n{url}".encode()).hexdigest()
+        return f"gh:http:{digest}"
+
+    def load(self, host: str, url: str, accept: str) -> dict | None:
+        try:
+            value = self._valkey.get(self._key(host, url, accept))
+        except Exception as e:
+            logging.warning(f"Failed to load GitHub response cache: {e}")
+            return None
+        return json.loads(value) if value is not None else None
+
+    def save(self, host: str, url: str, accept: str, headers: dict, body: str):
+        if len(body) > self.max_size:
+            return
+
+        value = json.dumps({"headers": headers, "body": body})
+        try:
+            self._valkey.set(self._key(host, url, accept), value, ex=self.ttl)
+        except Exception as e:
+            logging.warning(f"Failed to save GitHub response cache: {e}")
+
+
+class CachedResponse:
+    """304が返った場合に、保存していたレスポンスを返す"""
+
+    def __init__(self, headers: dict, body: str):
+        self.status = 200
+        self.headers = headers
+        self.text = body
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.text
+
+
+class CachingHTTPSConnection(HTTPSRequestsConnectionClass):
+    """条件付きリクエストを送るPyGithubのコネクション
+
+    304のレスポンスはレート制限に数えられないため、変わっていないリソースは
+    保存していた内容を返す。
+    """
+
+    def __init__(self, *args, cache: GitHubHTTPCache, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+
+    @classmethod
+    def install(cls, github: Github, cache: GitHubHTTPCache):
+        """指定したクライアントのリクエストだけでキャッシュを使う
+
+        PyGithubにはクライアントごとにコネクションを指定する公開APIがないため、
+        このクライアントのRequesterが作るコネクションだけを差し替える。
+        他のクライアントやRequester.withAuthで複製したものには影響しない。
+        Requesterの非公開の属性を使うため、pyproject.tomlでPyGithubの版を固定している。
+        """
+        requester = github.requester
+        # PyGithubの実装が変わった場合に、キャッシュが黙って無効にならないようにする
+        if not hasattr(requester, CONNECTION_CLASS_ATTRIBUTE):
+            raise RuntimeError(
+                f"Requester has no {CONNECTION_CLASS_ATTRIBUTE}, "
+                "this PyGithub version is not supported by the HTTP cache"
+            )
+        setattr(requester, CONNECTION_CLASS_ATTRIBUTE, partial(cls, cache=cache))
+
+    def getresponse(self) -> RequestsResponse | CachedResponse:
+        cache = self.cache
+        if self.verb != "GET" or self.stream:
+            return super().getresponse()
+
+        accept = self.headers.get("Accept", "")
+        entry = cache.load(self.host, self.url, accept)
+        if entry is not None:
+            headers = entry["headers"]
+            self.headers = dict(self.headers)
+            if "etag" in headers:
+                self.headers["If-None-Match"] = headers["etag"]
+            if "last-modified" in headers:
+                self.headers["If-Modified-Since"] = headers["last-modified"]
+
+        response = super().getresponse()
+
+        if response.status == 304 and entry is not None:
+            cache.count(hit=True)
+            # レート制限の残りなどは新しいレスポンスのものを使う
+            headers = dict(entry["headers"])
+            headers.update(
+                (k.lower(), v)
+                for k, v in response.getheaders()
+                if k.lower() != "content-length"
+            )
+            return CachedResponse(headers, entry["body"])
+
+        cache.count(hit=False)
+        if response.status == 200:
+            headers = {k.lower(): v for k, v in response.getheaders()}
+            if "etag" in headers or "last-modified" in headers:
+                cache.save(self.host, self.url, accept, headers, response.read())
+
+        return response
+
+
+class CachedAppInstallationAuth(Auth):
+    """インストールのアクセストークンを期限の少し前までValkeyに保存して使い回す
+
+    トークンはGithubIntegration.get_access_tokenで取得し、
+    PyGithubにはAuthの公開インターフェースであるtoken_typeとtokenで渡す。
+    """
+
+    def __init__(
+        self,
+        integration: GithubIntegration,
+        app_id: int | str,
+        installation_id: int,
+        valkey: Valkey,
+    ):
+        self.integration = integration
+        self.app_id = app_id
+        self.installation_id = installation_id
+        self._valkey = valkey
+        self._lock = threading.Lock()
+        self._token: str | None = None
+        self._expires_at = 0.0
+
+    @property
+    def token_type(self) -> str:
+        return "token"
+
+    @property
+    def token(self) -> str:
+        with self._lock:
+            if (
+                self._token is None
+                or self._expires_at - TOKEN_EXPIRATION_MARGIN_SECONDS < time.time()
+            ):
+                self._token, self._expires_at = self._get_token()
+            return self._token
+
+    @property
+    def _masked_token(self) -> str:
+        return "token (oauth token removed)"
+
+    def _get_token(self) -> tuple[str, float]:
+        key = f"gh:token:{self.app_id}:{self.installation_id}"
+
+        value = self._valkey.get(key)
+        if value is not None:
+            entry = json.loads(value)
+            return entry["token"], entry["expires_at"]
+
+        authorization = self.integration.get_access_token(self.installation_id)
+        expires_at = authorization.expires_at.timestamp()
+        ttl = int(expires_at - time.time()) - TOKEN_EXPIRATION_MARGIN_SECONDS
+        if ttl > 0:
+            entry = {"token": authorization.token, "expires_at": expires_at}
+            self._valkey.set(key, json.dumps(entry), ex=ttl)
+
+        return authorization.token, expires_at
+
+
+class InstallationResolver:
+    """リポジトリのオーナーごとにGitHub Appのインストールを探し、そのidを保存する"""
+
+    def __init__(
+        self,
+        integration: GithubIntegration,
+        app_id: int | str,
+        valkey: Valkey,
+        ttl: int,
+    ):
+        self.integration = integration
+        self.app_id = app_id
+        self._valkey = valkey
+        self.ttl = ttl
+
+    def get(self, owner: str, repo: str) -> int:
+        key = f"gh:inst:{self.app_id}:{owner.lower()}"
+
+        value = self._valkey.get(key)
+        if value is not None:
+            return int(value)
+
+        installation_id = self.integration.get_repo_installation(owner, repo).id
+        self._valkey.set(key, installation_id, ex=self.ttl)
+        return installation_id
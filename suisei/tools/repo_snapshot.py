@@ -0,0 +1,336 @@
+import json
+import logging
+import mmap
+import os
+import re
+import tarfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import requests
+from github.Repository import Repository
+
+from ..tool_runner import check_deadline, remaining_time
+
+SHA_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+DOWNLOAD_TIMEOUT = 60
+# 使ったスナップショットの最終使用時刻を更新する間隔 (秒)
+TOUCH_INTERVAL = 60
+
+
+class RepositorySnapshot:
+    """展開したリポジトリの1コミット分のファイル
+
+    ファイルの内容は1つのblobファイルに連結して保存し、mmapで読み込む。
+    RepositorySnapshotCache.getで取得したものはwith文で使い、使い終わったら解放する。
+    キャッシュから外されても、使用中であれば最後の利用者が解放した時に閉じる。
+    """
+
+    def __init__(self, blob_path: str, index: dict):
+        self._lock = threading.Lock()
+        self._refs = 0
+        self._retired = False
+
+        self.files: Dict[str, Tuple[int, int]] = {
+            path: (offset, size) for path, (offset, size) in index["files"].items()
+        }
+        self.dirs: Dict[str, List[str]] = index["dirs"]
+
+        self._file = open(blob_path, "rb")
+        # 空のファイルはmmapできない
+        self._mmap = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if os.path.getsize(blob_path) > 0
+            else None
+        )
+
+    def list(self, path: str) -> List[Tuple[str, str, int]]:
+        path = path.strip("/")
+        if path not in self.dirs:
+            raise FileNotFoundError(f"Directory not found: {path}")
+
+        entries = []
+        for name in self.dirs[path]:
+            child = f"{path}/{name}" if path != "" else name
+            if child in self.files:
+                entries.append(("file", name, self.files[child][1]))
+            else:
+                entries.append(("dir", name, 0))
+        return entries
+
+    def read(self, path: str) -> bytes:
+        path = path.strip("/")
+        if path not in self.files:
+            raise FileNotFoundError(f"File not found: {path}")
+
+        offset, size = self.files[path]
+        if self._mmap is None:
+            return b""
+        return self._mmap[offset : offset + size]
+
+    def acquire(self) -> "RepositorySnapshot":
+        with self._lock:
+            self._refs += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            close = self._retired and self._refs == 0
+        if close:
+            self._close()
+
+    def retire(self):
+        """キャッシュから外す。使用中であれば最後の利用者が解放した時に閉じる"""
+        with self._lock:
+            self._retired = True
+            close = self._refs == 0
+        if close:
+            self._close()
+
+    def __enter__(self) -> "RepositorySnapshot":
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+
+class RepositorySnapshotCache:
+    """リポジトリのtarballをコミットごとにローカルに保存し、一覧と内容をそこから返す
+
+    refは一定時間ごとにコミットに解決し直すため、ブランチが進めば新しい
+    スナップショットを取得する。ディスク上の合計サイズがmax_bytesを超えると
+    最近使われていないものから削除する。
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        ref_ttl: float = 60,
+        max_open: int = 16,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ref_ttl = ref_ttl
+        self.max_open = max_open
+
+        self._lock = threading.Lock()
+        self._download_locks: Dict[str, threading.Lock] = {}
+        self._refs: Dict[Tuple[str, str], Tuple[float, str]] = {}
+        self._snapshots: OrderedDict[str, RepositorySnapshot] = OrderedDict()
+        # スナップショットごとに最後にmtimeを更新した時刻
+        self._touched: Dict[str, float] = {}
+        # 大きすぎて保存できなかったスナップショットは再度ダウンロードしない
+        self._too_large: set[str] = set()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _resolve(self, repo: Repository, ref: str) -> str:
+        if SHA_PATTERN.match(ref):
+            return ref
+
+        key = (repo.full_name, ref)
+        with self._lock:
+            cached = self._refs.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+
+        sha = repo.get_commit(ref).sha
+        with self._lock:
+            self._refs[key] = (time.monotonic() + self.ref_ttl, sha)
+        return sha
+
+    def _name(self, repo: Repository, sha: str) -> str:
+        return f"{repo.full_name.replace('/', '__')}@{sha}"
+
+    def get(self, repo: Repository, ref: str) -> RepositorySnapshot:
+        """スナップショットを取得する。with文で使い、抜けると解放される"""
+        sha = self._resolve(repo, ref)
+        name = self._name(repo, sha)
+
+        if name in self._too_large:
+            raise ValueError(f"{repo.full_name}@{sha} is too large to snapshot")
+
+        snapshot = self._acquire(name)
+        if snapshot is not None:
+            return snapshot
+
+        with self._lock:
+            download_lock = self._download_locks.setdefault(name, threading.Lock())
+
+        # 同じスナップショットを同時にダウンロードしない
+        with download_lock:
+            # 待っている間に他のスレッドが開いていればそれを使う
+            snapshot = self._acquire(name)
+            if snapshot is not None:
+                return snapshot
+
+            blob_path = os.path.join(self.directory, f"{name}.blob")
+            index_path = os.path.join(self.directory, f"{name}.json")
+
+            if not os.path.exists(index_path):
+                try:
+                    self._download(repo, sha, name)
+                except Exception:
+                    for path in [f"{blob_path}.tmp", f"{index_path}.tmp"]:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    raise
+                self._evict(keep=name)
+
+            self._touch(name, force=True)
+            with open(index_path) as f:
+                snapshot = RepositorySnapshot(blob_path, json.load(f))
+
+            retired: List[RepositorySnapshot] = []
+            with self._lock:
+                self._snapshots[name] = snapshot
+                snapshot.acquire()
+                while len(self._snapshots) > self.max_open:
+                    _, evicted = self._snapshots.popitem(last=False)
+                    retired.append(evicted)
+                self._download_locks.pop(name, None)
+
+        # 他のスレッドが読み込み中のこともあるため、閉じるのは使い終わってから
+        for evicted in retired:
+            evicted.retire()
+
+        return snapshot
+
+    def _acquire(self, name: str) -> RepositorySnapshot | None:
+        with self._lock:
+            snapshot = self._snapshots.get(name)
+            if snapshot is None:
+                return None
+            self._snapshots.move_to_end(name)
+            snapshot.acquire()
+
+        self._touch(name)
+        return snapshot
+
+    def _touch(self, name: str, force: bool = False):
+        # ディスクのLRUのために最後に使った時刻を記録する。毎回は書き込まない
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._touched.get(name, 0) + TOUCH_INTERVAL > now:
+                return
+            self._touched[name] = now
+
+        try:
+            os.utime(os.path.join(self.directory, f"{name}.json"))
+        except FileNotFoundError:
+            pass
+
+    def _download(self, repo: Repository, sha: str, name: str):
+        blob_path = os.path.join(self.directory, f"{name}.blob")
+        index_path = os.path.join(self.directory, f"{name}.json")
+        url = repo.get_archive_link("tarball", ref=sha)
+        started_at = time.monotonic()
+
+        files: Dict[str, Tuple[int, int]] = {}
+        dirs: Dict[str, List[str]] = {"": []}
+
+        def add_dir(path: str):
+            while path not in dirs:
+                dirs[path] = []
+                parent, _, name = path.rpartition("/")
+                if parent not in dirs:
+                    add_dir(parent)
+                dirs[parent].append(name)
+
+        # 関数呼び出しの期限を過ぎてもダウンロードを続けないよう、残り時間で打ち切る
+        remaining = remaining_time()
+        timeout = (
+            DOWNLOAD_TIMEOUT
+            if remaining is None
+            else max(min(DOWNLOAD_TIMEOUT, remaining), 0.1)
+        )
+        with requests.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+
+            tmp_path = f"{blob_path}.tmp"
+            with (
+                tarfile.open(fileobj=response.raw, mode="r|gz") as tar,
+                open(tmp_path, "wb") as blob,
+            ):
+                offset = 0
+                for member in tar:
+                    check_deadline()
+
+                    # 先頭の "{owner}-{repo}-{sha}/" を取り除く
+                    _, _, path = member.name.partition("/")
+                    if path == "":
+                        continue
+
+                    if member.isdir():
+                        add_dir(path.rstrip("/"))
+                        continue
+                    if not member.isfile():
+                        continue
+
+                    parent, _, file_name = path.rpartition("/")
+                    add_dir(parent)
+                    dirs[parent].append(file_name)
+
+                    extracted = tar.extractfile(member)
+                    data = extracted.read() if extracted is not None else b""
+                    blob.write(data)
+                    files[path] = (offset, len(data))
+                    offset += len(data)
+
+                    if offset > self.max_bytes:
+                        self._too_large.add(name)
+                        raise ValueError(
+                            f"{repo.full_name} is larger than {self.max_bytes} bytes"
+                        )
+
+        os.replace(tmp_path, blob_path)
+        # インデックスがあればスナップショットが揃っているものとして扱う
+        with open(f"{index_path}.tmp", "w") as f:
+            json.dump({"files": files, "dirs": dirs}, f)
+        os.replace(f"{index_path}.tmp", index_path)
+
+        logging.info(
+            f"Downloaded {repo.full_name}@{sha}: {len(files)} files, {offset} bytes "
+            f"in {time.monotonic() - started_at:.2f}s"
+        )
+
+    def _evict(self, keep: str):
+        snapshots = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            name = entry.name[: -len(".json")]
+            blob_path = os.path.join(self.directory, f"{name}.blob")
+            size = os.path.getsize(blob_path) if os.path.exists(blob_path) else 0
+            snapshots.append((entry.stat().st_mtime, name, size))
+            total += size
+
+        for _, name, size in sorted(snapshots):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+
+            with self._lock:
+                snapshot = self._snapshots.pop(name, None)
+                self._touched.pop(name, None)
+            if snapshot is not None:
+                snapshot.retire()
+
+            for extension in [".json", ".blob"]:
+                try:
+                    os.remove(os.path.join(self.directory, f"{name}{extension}"))
+                except FileNotFoundError:
+                    pass
+            total -= size
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from slack_sdk import WebClient
+from valkey import Valkey
+
+from .env import USER_CACHE_SIZE, USER_CACHE_TTL
+from .valkey_client import get_valkey
+
+if TYPE_CHECKING:
+    from slack_sdk.web.async_client import AsyncWebClient
+
+
+class UserInfoCache:
+    """users_infoの結果のキャッシュ
+
+    プロセス内のLRUと、レプリカ間で共有するValkeyの2段で保持する。
+    """
+
+    def __init__(
+        self,
+        valkey: Valkey | None = None,
+        max_size: int = USER_CACHE_SIZE,
+        ttl: int = USER_CACHE_TTL,
+    ):
+        self._valkey = valkey if valkey is not None else get_valkey()
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._local: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(user_id: str) -> str:
+        return f"ui:{user_id}"
+
+    def _get_local(self, user_id: str) -> dict | None:
+        with self._lock:
+            cached = self._local.get(user_id)
+            if cached is None:
+                return None
+
+            expires_at, user = cached
+            if expires_at < time.monotonic():
+                del self._local[user_id]
+                return None
+
+            self._local.move_to_end(user_id)
+            self.local_hits += 1
+            return user
+
+    def _set_local(self, user_id: str, user: dict, ttl: float):
+        with self._lock:
+            self._local[user_id] = (time.monotonic() + ttl, user)
+            self._local.move_to_end(user_id)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def _get_cached(self, user_id: str) -> dict | None:
+        user = self._get_local(user_id)
+        if user is not None:
+            return user
+
+        key = self._key(user_id)
+        with self._valkey.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.ttl(key)
+            value, ttl = pipe.execute()
+
+        if value is not None:
+            with self._lock:
+                self.shared_hits += 1
+            user = json.loads(value)
+            self._set_local(user_id, user, ttl if ttl > 0 else self.ttl)
+            return user
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _set(self, user_id: str, user: dict):
+        self._valkey.set(self._key(user_id), json.dumps(user), ex=self.ttl)
+        self._set_local(user_id, user, self.ttl)
+
+    def get(self, client: WebClient, user_id: str) -> dict:
+        user = self._get_cached(user_id)
+        if user is not None:
+            return user
+
+        user_info = client.users_info(user=user_id, include_locale=True)
+        user = user_info.get("user", {})
+        self._set(user_id, user)
+        return user
+
+    def get_locale(self, client: WebClient, user_id: str) -> str | None:
+        return self.get(client, user_id).get("locale")
+
+    async def aget(self, client: "AsyncWebClient", user_id: str) -> dict:
+        user = await asyncio.to_thread(self._get_cached, user_id)
+        if user is not None:
+            return user
+
+        user_info = await client.users_info(user=user_id, include_locale=True)
+        user = user_info.get("user", {})
+        await asyncio.to_thread(self._set, user_id, user)
+        return user
+
+    async def aget_locale(self, client: "AsyncWebClient", user_id: str) -> str | None:
+        return (await self.aget(client, user_id)).get("locale")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "local_hits": self.local_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,60 @@
+import threading
+
+from valkey import BlockingConnectionPool, Valkey
+from valkey.backoff import ExponentialBackoff
+from valkey.retry import Retry
+
+from .env import (
+    VALKEY_CLIENT_CACHE,
+    VALKEY_CLIENT_CACHE_SIZE,
+    VALKEY_CLIENT_CACHE_TTL,
+    VALKEY_CONNECT_TIMEOUT,
+    VALKEY_DB,
+    VALKEY_HEALTH_CHECK_INTERVAL,
+    VALKEY_HOST,
+    VALKEY_MAX_CONNECTIONS,
+    VALKEY_POOL_TIMEOUT,
+    VALKEY_PORT,
+    VALKEY_RETRIES,
+    VALKEY_SOCKET_TIMEOUT,
+)
+
+_lock = threading.Lock()
+_valkey: Valkey | None = None
+
+
+def create_valkey() -> Valkey:
+    cache_options = {}
+    if VALKEY_CLIENT_CACHE:
+        # 読み込みの多いスレッドはサーバーからの無効化通知を受けつつローカルに保持する
+        cache_options = {
+            "protocol": 3,
+            "cache_enabled": True,
+            "cache_max_size": VALKEY_CLIENT_CACHE_SIZE,
+            "cache_ttl": VALKEY_CLIENT_CACHE_TTL,
+        }
+
+    pool = BlockingConnectionPool(
+        max_connections=VALKEY_MAX_CONNECTIONS,
+        timeout=VALKEY_POOL_TIMEOUT,
+        host=VALKEY_HOST,
+        port=VALKEY_PORT,
+        db=VALKEY_DB,
+        socket_timeout=VALKEY_SOCKET_TIMEOUT,
+        socket_connect_timeout=VALKEY_CONNECT_TIMEOUT,
+        retry=Retry(ExponentialBackoff(), VALKEY_RETRIES),
+        retry_on_timeout=True,
+        health_check_interval=VALKEY_HEALTH_CHECK_INTERVAL,
+        **cache_options,
+    )
+    return Valkey(connection_pool=pool)
+
+
+def get_valkey() -> Valkey:
+    """プロセス内で共有するValkeyクライアントを返す"""
+    global _valkey
+
+    with _lock:
+        if _valkey is None:
+            _valkey = create_valkey()
+        return _valkey
@@ -4,3 +4,250 @@ def test_chunker():
     chunker = Chunker()
     chunker.feed("Hello, world!\n")
     chunker.feed("This is a test.\n")
+
+
+def _stream(chunker, text: str, step: int = 7) -> list:
+    result = []
+
+    def flush():
+        while True:
+            consumed = chunker.consume()
+            if consumed is None:
+                break
+            result.append(consumed[1])
+
+    for i in range(0, len(text), step):
+        chunker.feed(text[i : i + step])
+        flush()
+
+    chunker.finish()
+    flush()
+    return result
+
+
+def test_chunker_incremental():
+    from suisei.slack_markdown.chunker import Chunker
+
+    paragraphs = [f"Paragraph {i} " + "lorem ipsum " * 20 for i in range(40)]
+    text = "\n\n".join(paragraphs)
+
+    chunker = Chunker(max_chunk_size=256)
+    result = _stream(chunker, text)
+
+    assert len(result) > 1
+    assert "".join(result).split() == text.split()
+
+    # 確定済みのブロックは再パースしない
+    assert chunker.parsed_bytes < len(text) * 4
+
+
+def test_chunker_keeps_continued_lines():
+    from suisei.slack_markdown.chunker import Chunker
+
+    text = "- item\n\n" + "a" * 300 + "\n\n> quote\n> more\n\nend"
+
+    chunker = Chunker(max_chunk_size=128)
+    result = _stream(chunker, text)
+
+    assert "more" in "".join(result)
+
+
+def _split_markdown_reference(chunker, elements: list) -> list:
+    # 要素を追加する度に全体を描画していた以前の実装
+    result = []
+    chunk = []
+    for element in elements:
+        type = element.get_type(snake_case=True)
+        if type == "table":
+            result.append(chunk)
+            result.append([element])
+            chunk = []
+        elif type == "thematic_break":
+            result.append(chunk)
+            chunk = [element]
+        else:
+            chunk.append(element)
+
+        if len(chunker._render_md(chunk)) > chunker.max_chunk_size * 2:
+            result.append(chunk)
+            chunk = []
+
+    if len(chunk) > 0:
+        result.append(chunk)
+
+    return list(filter(lambda x: len(x) > 0, result))
+
+
+def _generate_markdown(seed: int, blocks: int) -> str:
+    import random
+
+    rand = random.Random(seed)
+    words = ["foo", "**bar**", "*baz*", "`qux`", "日本語", "[link](https://e.com)"]
+    parts = []
+    for i in range(blocks):
+        kind = rand.choice(["paragraph", "list", "code", "break", "quote", "table"])
+        if kind == "paragraph":
+            parts.append(" ".join(rand.choices(words, k=rand.randint(1, 80))))
+        elif kind == "list":
+            parts.append("\n".join(f"- item {j}" for j in range(rand.randint(1, 8))))
+        elif kind == "code":
+            lines = [f"x = {j}" for j in range(rand.randint(1, 10))]
+            parts.append("```python\n" + "\n".join(lines) + "\n```")
+        elif kind == "break":
+            parts.append("---")
+        elif kind == "quote":
+            parts.append("> quoted\n> text")
+        else:
+            parts.append("| a | b |\n| - | - |\n| 1 | 2 |")
+    return "\n\n".join(parts)
+
+
+def test_split_markdown_same_as_reference():
+    from suisei.slack_markdown.chunker import Chunker
+    from test_renderer import MARKDOWN_TEXT
+
+    documents = [
+        "Hello, world!\nThis is a test.\n",
+        MARKDOWN_TEXT,
+        "<@U12345678> <#C12345678>\n\n" + MARKDOWN_TEXT,
+    ] + [_generate_markdown(seed, 200) for seed in range(5)]
+
+    for max_chunk_size in [16, 128, 1024]:
+        for document in documents:
+            chunker = Chunker(max_chunk_size=max_chunk_size)
+            elements = chunker.md.parse(document).children
+
+            expected = _split_markdown_reference(chunker, elements)
+            actual = chunker._split_markdown(elements)
+
+            assert [len(chunk) for chunk in actual] == [
+                len(chunk) for chunk in expected
+            ]
+            assert all(
+                a is e for ac, ec in zip(actual, expected) for a, e in zip(ac, ec)
+            )
+
+
+class _FakeSlackClient:
+    def __init__(self):
+        self.calls = []
+
+    def chat_postMessage(self, **kwargs):
+        self.calls.append(("post", kwargs))
+        return {"ts": f"1.{len(self.calls)}"}
+
+    def chat_update(self, **kwargs):
+        self.calls.append(("update", kwargs))
+        return {"ts": kwargs["ts"]}
+
+    def chat_delete(self, **kwargs):
+        self.calls.append(("delete", kwargs))
+
+
+def test_slack_updating_chunker():
+    from suisei.slack_markdown.chunker import SlackUpdatingChunker
+    from suisei.slack_post_queue import SlackPostQueue
+
+    client = _FakeSlackClient()
+    chunker = SlackUpdatingChunker(
+        client=client,
+        channel="C1",
+        thread_ts="0.1",
+        post_queue=SlackPostQueue(rate=1000, burst=1),
+        max_chunk_size=16,
+        updates_per_second=20,
+        max_blocks=4,
+    )
+
+    paragraphs = [f"Paragraph {i}" for i in range(20)]
+    _stream(chunker, "\n\n".join(paragraphs), step=64)
+    chunker.wait()
+
+    posts = [kwargs for name, kwargs in client.calls if name == "post"]
+    updates = [kwargs for name, kwargs in client.calls if name == "update"]
+
+    # ブロック数の上限を超えた場合のみ新しいメッセージになる
+    assert all(len(kwargs.get("blocks", [])) <= 4 for kwargs in posts + updates)
+    assert 1 < len(posts) < len(paragraphs)
+
+    last = client.calls[-1][1]
+    assert "Paragraph 19" in last["metadata"]["event_payload"]["raw_text"]
+
+
+def test_slack_updating_chunker_deletes_empty_placeholder():
+    from suisei.slack_markdown.chunker import SlackUpdatingChunker
+    from suisei.slack_post_queue import SlackPostQueue
+
+    client = _FakeSlackClient()
+    chunker = SlackUpdatingChunker(
+        client=client,
+        channel="C1",
+        thread_ts="0.1",
+        post_queue=SlackPostQueue(rate=1000, burst=1),
+    )
+    chunker.finish()
+    chunker.wait()
+
+    assert [name for name, _ in client.calls] == ["post", "delete"]
+
+
+def test_slack_chunker_wait_collects_failures():
+    from suisei.slack_markdown.chunker import SlackChunker
+    from suisei.slack_post_queue import SlackPostQueue
+
+    chunker = SlackChunker(
+        client=_FakeSlackClient(),
+        channel="C1",
+        thread_ts="0.1",
+        post_queue=SlackPostQueue(rate=1000, burst=1),
+    )
+
+    def fail():
+        raise RuntimeError("failed")
+
+    chunker.submit(fail)
+    chunker.submit(lambda: None)
+
+    # 投稿の失敗で呼び出し元の履歴保存を止めない
+    errors = chunker.wait()
+    assert [str(e) for e in errors] == ["failed"]
+
+
+class _FakeAsyncSlackClient(_FakeSlackClient):
+    async def chat_postMessage(self, **kwargs):
+        return super().chat_postMessage(**kwargs)
+
+    async def chat_update(self, **kwargs):
+        return super().chat_update(**kwargs)
+
+    async def chat_delete(self, **kwargs):
+        return super().chat_delete(**kwargs)
+
+
+def test_async_slack_updating_chunker():
+    import asyncio
+    from suisei.slack_markdown.async_chunker import AsyncSlackUpdatingChunker
+    from suisei.slack_post_queue import AsyncSlackPostQueue
+
+    client = _FakeAsyncSlackClient()
+
+    async def run():
+        chunker = AsyncSlackUpdatingChunker(
+            client=client,
+            channel="C1",
+            thread_ts="0.1",
+            post_queue=AsyncSlackPostQueue(rate=1000, burst=1),
+            max_chunk_size=16,
+            updates_per_second=20,
+            max_blocks=4,
+        )
+        _stream(chunker, "\n\n".join(f"Paragraph {i}" for i in range(20)), step=64)
+        return await chunker.wait()
+
+    assert asyncio.run(run()) == []
+
+    posts = [kwargs for name, kwargs in client.calls if name == "post"]
+    assert all(len(kwargs.get("blocks", [])) <= 4 for kwargs in posts)
+
+    last = client.calls[-1][1]
+    assert "Paragraph 19" in last["metadata"]["event_payload"]["raw_text"]
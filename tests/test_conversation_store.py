@@ -0,0 +1,22 @@
+import os
+
+from google.genai.types import Content, Part
+
+# suisei.envは読み込み時に必須の設定を確認するため、先に設定しておく
+os.environ.setdefault("GEMINI_SYSTEM_TEXT", "test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+
+def test_large_content_is_compressed():
+    from suisei.conversation_store import (
+        CODEC_ZSTD,
+        decode_content,
+        encode_content,
+    )
+
+    content = Content(role="user", parts=[Part(text="a" * 4096)])
+    encoded = encode_content(content)
+
+    assert encoded[1:2] == CODEC_ZSTD
+    assert len(encoded) < 4096
+    assert decode_content(encoded) == content
@@ -0,0 +1,52 @@
+from suisei.generation_limiter import GenerationLimiter
+
+
+def test_generation_limiter_caps():
+    limiter = GenerationLimiter(max_concurrency=2, max_per_user=1, max_queue=2)
+    started = []
+
+    assert limiter.submit(1, "U1", "C1", lambda: started.append(1)) == "started"
+    # 同じユーザーは上限に達しているので待つ
+    assert limiter.submit(1, "U1", "C1", lambda: started.append(2)) == "queued"
+    assert limiter.submit(1, "U2", "C1", lambda: started.append(3)) == "started"
+    assert limiter.submit(1, "U3", "C1", lambda: started.append(4)) == "queued"
+    assert limiter.submit(1, "U4", "C1", lambda: started.append(5)) == "rejected"
+    assert started == [1, 3]
+
+    limiter.done("U1", "C1")
+    assert started == [1, 3, 2]
+
+    limiter.done("U2", "C1")
+    assert started == [1, 3, 2, 4]
+
+    stats = limiter.stats()
+    assert stats["running"] == 2
+    assert stats["queued"] == 0
+    assert stats["rejected"] == 1
+
+
+def test_generation_limiter_priority():
+    limiter = GenerationLimiter(max_concurrency=1)
+    started = []
+
+    limiter.submit(1, "U1", "C1", lambda: started.append("first"))
+    limiter.submit(1, "U2", "C1", lambda: started.append("message"))
+    limiter.submit(0, "U3", "C1", lambda: started.append("mention"))
+
+    limiter.done("U1", "C1")
+    assert started == ["first", "mention"]
+
+    limiter.done("U3", "C1")
+    assert started == ["first", "mention", "message"]
+
+
+def test_generation_limiter_unlimited():
+    limiter = GenerationLimiter(max_concurrency=0)
+    started = []
+
+    # 0以下の上限は無効なので、全て開始される
+    for i in range(50):
+        assert limiter.submit(1, "U1", "C1", lambda i=i: started.append(i)) == "started"
+
+    assert started == list(range(50))
+    assert limiter.stats()["queued"] == 0
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta, timezone
+
+
+class FakeValkey(dict):
+    def get(self, key):
+        return dict.get(self, key)
+
+    def set(self, key, value, ex=None):
+        self[key] = value
+
+
+class FakeAuthorization:
+    def __init__(self, token: str):
+        self.token = token
+        self.expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+
+
+class FakeIntegration:
+    def __init__(self):
+        self.requests = 0
+
+    def get_access_token(self, installation_id: int) -> FakeAuthorization:
+        self.requests += 1
+        return FakeAuthorization(f"token-{installation_id}")
+
+
+def test_installation_token_is_shared_through_valkey():
+    from suisei.tools.github_cache import CachedAppInstallationAuth
+
+    valkey = FakeValkey()
+    integration = FakeIntegration()
+
+    auth = CachedAppInstallationAuth(integration, 1, 2, valkey)
+    assert auth.token == "token-2"
+    assert auth.token == "token-2"
+
+    # 別のプロセスのクライアントもValkeyに保存したトークンを使う
+    other = CachedAppInstallationAuth(integration, 1, 2, valkey)
+    assert other.token == "token-2"
+    assert integration.requests == 1
+
+
+def test_http_cache_is_scoped_to_client_and_host():
+    from github import Github
+
+    from suisei.tools.github_cache import (
+        CONNECTION_CLASS_ATTRIBUTE,
+        CachingHTTPSConnection,
+        GitHubHTTPCache,
+    )
+
+    cache = GitHubHTTPCache(FakeValkey(), ttl=60)
+    github = Github()
+    CachingHTTPSConnection.install(github, cache)
+
+    connection_class = getattr(github.requester, CONNECTION_CLASS_ATTRIBUTE)
+    connection = connection_class("api.github.com", None)
+    assert isinstance(connection, CachingHTTPSConnection)
+    assert connection.cache is cache
+
+    # 他のクライアントのコネクションは差し替えない
+    connection_class = getattr(Github().requester, CONNECTION_CLASS_ATTRIBUTE)
+    connection = connection_class("api.github.com", None)
+    assert not isinstance(connection, CachingHTTPSConnection)
+
+    cache.save("api.github.com", "/repos/a/b", "", {"etag": "x"}, "github")
+    assert cache.load("api.github.com", "/repos/a/b", "")["body"] == "github"
+    assert cache.load("ghe.example.com", "/repos/a/b", "") is None
+
+
+class FakeGithub:
+    requester = object()
+
+
+def test_http_cache_install_fails_on_unsupported_pygithub():
+    import pytest
+
+    from suisei.tools.github_cache import CachingHTTPSConnection, GitHubHTTPCache
+
+    cache = GitHubHTTPCache(FakeValkey(), ttl=60)
+    with pytest.raises(RuntimeError):
+        CachingHTTPSConnection.install(FakeGithub(), cache)
@@ -0,0 +1,113 @@
+import os
+
+from google.genai.types import Content, FunctionCall, FunctionResponse, Part
+
+# suisei.envは読み込み時に必須の設定を確認するため、先に設定しておく
+os.environ.setdefault("GEMINI_SYSTEM_TEXT", "test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+
+class _FakeStore:
+    def get_summary(self, channel, thread_ts):
+        return None
+
+
+class _FakeValkey:
+    def set(self, *args, **kwargs):
+        # 要約は作らない
+        return False
+
+
+def _text(role: str, text: str) -> Content:
+    return Content(role=role, parts=[Part(text=text)])
+
+
+def test_history_planner_skips_function_response():
+    from suisei.history_planner import HistoryPlanner
+
+    turns = [
+        _text("user", "a" * 10),
+        Content(
+            role="model",
+            parts=[Part(function_call=FunctionCall(name="get", args={}))],
+        ),
+        Content(
+            role="user",
+            parts=[
+                Part(function_response=FunctionResponse(name="get", response={}))
+            ],
+        ),
+        _text("model", "b" * 10),
+        _text("user", "c" * 10),
+        _text("model", "d" * 10),
+    ]
+    tokens = [10] * len(turns)
+
+    planner = HistoryPlanner(
+        gemini=None,
+        store=_FakeStore(),
+        valkey=_FakeValkey(),
+        budget=55,
+        keep_ratio=0.75,
+    )
+    # 目標まで落とすと関数の実行結果から始まるため、次のユーザーの発言まで落とす
+    contents = planner.plan("C1", "0.1", turns, tokens, base=0, reserved=0)
+
+    assert contents == turns[4:]
+    assert planner.stats()["dropped_turns"] == 4
+
+
+def test_history_planner_keeps_window_within_budget():
+    from suisei.history_planner import HistoryPlanner
+
+    turns = [_text("user", "a"), _text("model", "b")]
+    planner = HistoryPlanner(
+        gemini=None, store=_FakeStore(), valkey=_FakeValkey(), budget=100
+    )
+
+    assert planner.plan("C1", "0.1", turns, [10, 10], base=0) == turns
+    assert planner.stats()["dropped_turns"] == 0
+
+
+class _FakeCountResponse:
+    def __init__(self, total_tokens: int):
+        self.total_tokens = total_tokens
+
+
+class _FakeModels:
+    def __init__(self):
+        self.requests = []
+
+    def count_tokens(self, model, contents):
+        self.requests.append(contents)
+        return _FakeCountResponse(90)
+
+
+class _FakeGemini:
+    def __init__(self):
+        self.models = _FakeModels()
+
+
+def test_history_planner_counts_tokens_in_one_request():
+    from google.genai.types import GenerateContentResponseUsageMetadata
+
+    from suisei.history_planner import HistoryPlanner
+
+    gemini = _FakeGemini()
+    planner = HistoryPlanner(gemini=gemini, store=_FakeStore(), valkey=_FakeValkey())
+
+    # 合計を文字数の比で分ける
+    contents = [_text("user", "a" * 10), _text("user", "b" * 20)]
+    assert planner.count_tokens(contents) == [30, 60]
+    assert len(gemini.models.requests) == 1
+
+    # 生成したターンと関数の実行結果はusage_metadataから数える
+    previous = GenerateContentResponseUsageMetadata(
+        prompt_token_count=100, candidates_token_count=7
+    )
+    usage = GenerateContentResponseUsageMetadata(
+        prompt_token_count=130, candidates_token_count=5
+    )
+    assert planner.reply_tokens([_text("model", "c")], usage) == [5]
+    assert planner.function_response_tokens(_text("user", "d"), previous, usage) == 23
+    assert len(gemini.models.requests) == 1
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+# suisei.envは読み込み時に必須の設定を確認するため、先に設定しておく
+os.environ.setdefault("GEMINI_SYSTEM_TEXT", "test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-test")
+
+
+class _Stop(BaseException):
+    pass
+
+
+class _FailingQueue:
+    def __init__(self, failures: int):
+        self.failures = failures
+
+    def read(self, consumer, block_ms):
+        if self.failures == 0:
+            raise _Stop()
+        self.failures -= 1
+        raise ConnectionError("valkey is down")
+
+
+def test_worker_loop_backs_off_when_read_fails(monkeypatch):
+    from suisei import job_worker
+
+    sleeps = []
+    monkeypatch.setattr(job_worker, "job_queue", _FailingQueue(6))
+    monkeypatch.setattr(job_worker.time, "sleep", sleeps.append)
+
+    with pytest.raises(_Stop):
+        job_worker._worker_loop("consumer")
+
+    assert sleeps == [1, 2, 4, 8, 16, 30]
+
+
+class _AckFailingQueue:
+    def heartbeat(self, consumer, entry_id):
+        pass
+
+    def ack(self, entry_id):
+        raise ConnectionError("valkey is down")
+
+
+def test_process_job_logs_failed_ack(monkeypatch):
+    from suisei import job_worker
+
+    processed = []
+    monkeypatch.setattr(job_worker, "job_queue", _AckFailingQueue())
+    monkeypatch.setattr(
+        job_worker, "process_event", lambda entry_id, event: processed.append(entry_id)
+    )
+
+    job_worker._process_job("consumer", "1-0", {})
+
+    assert processed == ["1-0"]
@@ -0,0 +1,122 @@
+import logging
+import os
+
+from google.genai.types import (
+    Candidate,
+    Content,
+    FunctionCall,
+    FunctionDeclaration,
+    GenerateContentResponse,
+    Part,
+)
+
+# suisei.envは読み込み時に必須の設定を確認するため、先に設定しておく
+os.environ.setdefault("GEMINI_SYSTEM_TEXT", "test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+
+class _FakeChunker:
+    parsed_bytes = 0
+    rendered_blocks = 0
+    rendered_chars = 0
+
+    def feed(self, text: str):
+        pass
+
+    def consume(self):
+        return None
+
+    def finish(self):
+        return None
+
+    def submit(self, func):
+        pass
+
+    def wait(self):
+        return []
+
+
+class _FakeModels:
+    def __init__(self):
+        self.requests = 0
+
+    def generate_content_stream(self, model, contents, config):
+        # 毎回関数を呼び出そうとするモデル
+        self.requests += 1
+        yield GenerateContentResponse(
+            candidates=[
+                Candidate(
+                    content=Content(
+                        role="model",
+                        parts=[
+                            Part(text=f"step {self.requests}"),
+                            Part(function_call=FunctionCall(name="echo", args={})),
+                        ],
+                    ),
+                    finish_reason="STOP",
+                )
+            ]
+        )
+
+
+class _FakeGemini:
+    def __init__(self):
+        self.models = _FakeModels()
+
+
+def test_model_streamer_drops_unanswered_calls_at_step_limit(monkeypatch):
+    from slack_bolt import BoltContext
+
+    from suisei import llm_slack_executor
+    from suisei.tool_runner import ToolRunner
+
+    gemini = _FakeGemini()
+    monkeypatch.setattr(llm_slack_executor, "gemini", gemini)
+    monkeypatch.setattr(llm_slack_executor, "TOOL_MAX_STEPS", 1)
+    monkeypatch.setattr(
+        llm_slack_executor, "tool_runner", ToolRunner({"echo": lambda: "ok"})
+    )
+    monkeypatch.setattr(
+        llm_slack_executor, "_create_chunker", lambda *args: _FakeChunker()
+    )
+
+    replies, tokens = llm_slack_executor._model_streamer(
+        context=BoltContext(),
+        client=None,
+        logger=logging.getLogger(__name__),
+        channel="C",
+        thread_ts="1",
+        messages=[Content(role="user", parts=[Part(text="hi")])],
+    )
+
+    assert gemini.models.requests == 2
+    # 実行した呼び出しには応答があり、上限で実行しなかった呼び出しは残らない
+    calls = [part for reply in replies for part in reply.parts if part.function_call]
+    responses = [
+        part for reply in replies for part in reply.parts if part.function_response
+    ]
+    assert len(calls) == len(responses) == 1
+    assert replies[-1].role == "model"
+    assert [part.text for part in replies[-1].parts] == ["step 2"]
+    assert len(tokens) == len(replies)
+
+
+class _FakeGitHubTools:
+    def function_declarations(self, client):
+        return [FunctionDeclaration(name="get_github_files")]
+
+
+def test_tools_do_not_mix_search_and_functions(monkeypatch):
+    from suisei import llm_slack_executor
+
+    llm_slack_executor._tools.cache_clear()
+    [tool] = llm_slack_executor._tools()
+    assert tool.google_search is not None
+    assert tool.function_declarations is None
+
+    llm_slack_executor._tools.cache_clear()
+    monkeypatch.setattr(llm_slack_executor, "github_tools", _FakeGitHubTools())
+    [tool] = llm_slack_executor._tools()
+    assert tool.google_search is None
+    assert [f.name for f in tool.function_declarations] == ["get_github_files"]
+    llm_slack_executor._tools.cache_clear()
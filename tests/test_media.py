@@ -0,0 +1,63 @@
+from io import BytesIO
+
+from PIL import Image
+
+from suisei.media import preprocess_media
+
+MAX_PIXELS = 1568 * 1568
+
+
+def _image(size, format="PNG", **kwargs) -> bytes:
+    output = BytesIO()
+    Image.new("RGB", size, (255, 0, 0)).save(output, format=format, **kwargs)
+    return output.getvalue()
+
+
+def test_large_image_is_downscaled():
+    data = _image((4000, 3000))
+
+    mime_type, processed = preprocess_media("image/png", data, MAX_PIXELS)
+
+    assert mime_type == "image/webp"
+    with Image.open(BytesIO(processed)) as image:
+        assert image.width * image.height <= MAX_PIXELS
+        assert abs(image.width / image.height - 4 / 3) < 0.01
+
+
+def test_small_image_is_unchanged():
+    data = _image((640, 480))
+
+    assert preprocess_media("image/png", data, MAX_PIXELS) == ("image/png", data)
+
+
+def test_exif_is_stripped():
+    exif = Image.Exif()
+    # Orientation: 90度回転
+    exif[0x0112] = 6
+    data = _image((200, 100), format="JPEG", exif=exif)
+
+    mime_type, processed = preprocess_media(
+        "image/jpeg", data, MAX_PIXELS, image_format="jpeg"
+    )
+
+    assert mime_type == "image/jpeg"
+    with Image.open(BytesIO(processed)) as image:
+        assert len(image.getexif()) == 0
+        assert image.size == (100, 200)
+
+
+def test_pdf_is_trimmed_to_max_pages():
+    import pypdf
+
+    writer = pypdf.PdfWriter()
+    for _ in range(5):
+        writer.add_blank_page(width=100, height=100)
+    output = BytesIO()
+    writer.write(output)
+
+    mime_type, processed = preprocess_media(
+        "application/pdf", output.getvalue(), MAX_PIXELS, pdf_max_pages=2
+    )
+
+    assert mime_type == "application/pdf"
+    assert len(pypdf.PdfReader(BytesIO(processed)).pages) == 2
@@ -1,12 +1,7 @@
+import pytest
 from deepdiff import DeepDiff
 
-
-def test_slack_renderer_1():
-    from marko import Markdown
-    from suisei.slack_markdown.renderer import SlackRenderer
-    from suisei.slack_markdown.extensions import SLACK_EXTENSION
-
-    MARKDOWN_TEXT = """
+MARKDOWN_TEXT = """
 **Hello *world***
 ~~strike~~
 
@@ -43,6 +38,12 @@ https://example.com
 
 """
 
+
+def test_slack_renderer_1():
+    from marko import Markdown
+    from suisei.slack_markdown.renderer import SlackRenderer
+    from suisei.slack_markdown.extensions import SLACK_EXTENSION
+
     markdown = Markdown(renderer=SlackRenderer)
     markdown.use(SLACK_EXTENSION)
     parsed = markdown.parse(MARKDOWN_TEXT)
@@ -217,3 +218,46 @@ https://example.com
     ]
 
     assert not DeepDiff(rendered, expected)
+
+
+def test_slack_renderer_postprocess_stats():
+    from marko import Markdown
+    from suisei.slack_markdown.renderer import SlackRenderer
+    from suisei.slack_markdown.extensions import SLACK_EXTENSION
+
+    markdown = Markdown(renderer=SlackRenderer)
+    markdown.use(SLACK_EXTENSION)
+    rendered = markdown.convert("Hello **world**\n\n> quote\n\n- a\n- b\n")
+
+    stats = {}
+    blocks = SlackRenderer.postprocess(rendered, stats)
+    assert stats["blocks"] == len(blocks)
+    # 空行は改行1文字として数える
+    assert stats["chars"] == len("Hello world") + len("quote") + len("ab") + 2
+
+    rendered = markdown.convert("| a | b |\n| - | - |\n| 1 | 2 |\n")
+    assert not SlackRenderer.validate(rendered)
+    with pytest.raises(ValueError):
+        SlackRenderer.postprocess(rendered)
+
+
+def test_slack_renderer_children_share_output():
+    from marko import Markdown
+    from suisei.slack_markdown.renderer import SlackRenderer
+    from suisei.slack_markdown.extensions import SLACK_EXTENSION
+
+    markdown = Markdown(renderer=SlackRenderer)
+    markdown.use(SLACK_EXTENSION)
+    doc = markdown.parse("# Title\n")
+
+    # 見出しとテキストは渡したリストに追記する
+    out = [{"type": "text", "text": "before"}]
+    with markdown.renderer as renderer:
+        renderer.root_node = doc
+        result = renderer.render_children(doc.children[0], out)
+
+    assert result is out
+    assert out == [
+        {"type": "text", "text": "before"},
+        {"type": "text", "text": "Title"},
+    ]
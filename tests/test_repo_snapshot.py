@@ -0,0 +1,136 @@
+import functools
+import http.server
+import io
+import tarfile
+import threading
+
+import pytest
+
+from suisei.tools.repo_snapshot import RepositorySnapshotCache
+
+
+def _tarball(files: dict) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for path, data in files.items():
+            info = tarfile.TarInfo(f"owner-repo-0123456/{path}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class FakeCommit:
+    def __init__(self, sha: str):
+        self.sha = sha
+
+
+class FakeRepository:
+    full_name = "owner/repo"
+
+    def __init__(self, url: str):
+        self.url = url
+        self.head = "a" * 40
+        self.downloads = 0
+
+    def get_commit(self, ref: str) -> FakeCommit:
+        return FakeCommit(self.head)
+
+    def get_archive_link(self, archive_format: str, ref: str) -> str:
+        self.downloads += 1
+        return f"{self.url}/{ref}.tar.gz"
+
+
+@pytest.fixture
+def repository(tmp_path):
+    served = tmp_path / "served"
+    served.mkdir()
+    (served / f"{'a' * 40}.tar.gz").write_bytes(
+        _tarball({"README.md": b"hello\n", "src/main.py": b"print(1)\n"})
+    )
+    (served / f"{'b' * 40}.tar.gz").write_bytes(_tarball({"README.md": b"moved\n"}))
+
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=str(served)
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield FakeRepository(f"http://127.0.0.1:{server.server_port}")
+    server.shutdown()
+
+
+def test_snapshot_lists_and_reads_files(tmp_path, repository):
+    cache = RepositorySnapshotCache(str(tmp_path / "cache"), max_bytes=1024)
+
+    with cache.get(repository, "main") as snapshot:
+        assert snapshot.list("") == [("file", "README.md", 6), ("dir", "src", 0)]
+        assert snapshot.list("src") == [("file", "main.py", 9)]
+        assert snapshot.read("src/main.py") == b"print(1)\n"
+        with pytest.raises(FileNotFoundError):
+            snapshot.read("missing")
+
+    # ディスクに保存したスナップショットは別のインスタンスからも使える
+    cache = RepositorySnapshotCache(str(tmp_path / "cache"), max_bytes=1024)
+    with cache.get(repository, "main") as snapshot:
+        assert snapshot.read("README.md") == b"hello\n"
+    assert repository.downloads == 1
+
+
+def test_snapshot_refreshes_when_branch_moves(tmp_path, repository):
+    cache = RepositorySnapshotCache(str(tmp_path / "cache"), max_bytes=1024, ref_ttl=0)
+    with cache.get(repository, "main") as snapshot:
+        assert snapshot.read("README.md") == b"hello\n"
+
+    repository.head = "b" * 40
+    with cache.get(repository, "main") as snapshot:
+        assert snapshot.read("README.md") == b"moved\n"
+    assert repository.downloads == 2
+
+
+def test_snapshot_evicted_while_reading(tmp_path, repository):
+    cache = RepositorySnapshotCache(
+        str(tmp_path / "cache"), max_bytes=1024, ref_ttl=0, max_open=1
+    )
+
+    with cache.get(repository, "main") as old:
+        # 他のスレッドが新しいスナップショットを開いて古いものが外されても読める
+        repository.head = "b" * 40
+        with cache.get(repository, "main") as new:
+            assert new.read("README.md") == b"moved\n"
+        assert old.read("README.md") == b"hello\n"
+
+    # 最後の利用者が解放した時に閉じる
+    with pytest.raises(ValueError):
+        old.read("README.md")
+
+
+def test_snapshot_too_large(tmp_path, repository):
+    cache = RepositorySnapshotCache(str(tmp_path / "cache"), max_bytes=4)
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            cache.get(repository, "main")
+    assert repository.downloads == 1
+
+
+def test_snapshot_reuse_updates_mtime(tmp_path, repository, monkeypatch):
+    import os
+
+    from suisei.tools import repo_snapshot
+
+    cache = RepositorySnapshotCache(str(tmp_path / "cache"), max_bytes=1024)
+    with cache.get(repository, "main"):
+        pass
+
+    index_path = os.path.join(cache.directory, f"owner__repo@{'a' * 40}.json")
+    os.utime(index_path, (0, 0))
+
+    # 間隔内であれば書き込まない
+    with cache.get(repository, "main"):
+        pass
+    assert os.path.getmtime(index_path) == 0
+
+    # メモリから使い回した場合も、ディスクのLRUのために更新する
+    monkeypatch.setattr(repo_snapshot, "TOUCH_INTERVAL", 0)
+    with cache.get(repository, "main"):
+        pass
+    assert os.path.getmtime(index_path) > 0
@@ -0,0 +1,117 @@
+import random
+import re
+
+from suisei.slack_format import (
+    SlackFormatStream,
+    format_assistant_reply,
+    markdown_to_slack,
+)
+
+
+# 以前の実装。変換結果が変わっていないことを確かめるために使う
+def legacy_format_assistant_reply(content: str) -> str:
+    for o, n in [
+        ("^\n+", ""),
+        ("^<@U.*?>\\s?:\\s?", ""),
+        ("```\\s*[Rr]ust\n", "```\n"),
+        ("```\\s*[Rr]uby\n", "```\n"),
+        ("```\\s*[Ss]cala\n", "```\n"),
+        ("```\\s*[Kk]otlin\n", "```\n"),
+        ("```\\s*[Jj]ava\n", "```\n"),
+        ("```\\s*[Gg]o\n", "```\n"),
+        ("```\\s*[Ss]wift\n", "```\n"),
+        ("```\\s*[Oo]objective[Cc]\n", "```\n"),
+        ("```\\s*[Cc]\n", "```\n"),
+        ("```\\s*[Cc][+][+]\n", "```\n"),
+        ("```\\s*[Cc][Pp][Pp]\n", "```\n"),
+        ("```\\s*[Cc]sharp\n", "```\n"),
+        ("```\\s*[Mm][Aa][Tt][Ll][Aa][Bb]\n", "```\n"),
+        ("```\\s*[Jj][Ss][Oo][Nn]\n", "```\n"),
+        ("```\\s*[Ll]a[Tt]e[Xx]\n", "```\n"),
+        ("```\\s*[Ll][Uu][Aa]\n", "```\n"),
+        ("```\\s*[Cc][Mm][Aa][Kk][Ee]\n", "```\n"),
+        ("```\\s*bash\n", "```\n"),
+        ("```\\s*zsh\n", "```\n"),
+        ("```\\s*sh\n", "```\n"),
+        ("```\\s*[Ss][Qq][Ll]\n", "```\n"),
+        ("```\\s*[Pp][Hh][Pp]\n", "```\n"),
+        ("```\\s*[Pp][Ee][Rr][Ll]\n", "```\n"),
+        ("```\\s*[Jj]ava[Ss]cript\n", "```\n"),
+        ("```\\s*[Ty]ype[Ss]cript\n", "```\n"),
+        ("```\\s*[Pp]ython\n", "```\n"),
+    ]:
+        content = re.sub(o, n, content)
+
+    return legacy_markdown_to_slack(content)
+
+
+def legacy_markdown_to_slack(content: str) -> str:
+    parts = re.split(r"(?s)(```.+?```|`[^`\n]+?`)", content)
+
+    result = ""
+    for part in parts:
+        if part.startswith("```") or part.startswith("`"):
+            result += part
+        else:
+            for o, n in [
+                (r"\*\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*\*", r"_*\1*_"),
+                (r"(?<![\*_])\*(?!\s)([^\*\n]+?)(?<!\s)\*(?![\*_])", r"_\1_"),
+                (r"\*\*(?!\s)([^\*\n]+?)(?<!\s)\*\*", r"*\1*"),
+                (r"__(?!\s)([^_\n]+?)(?<!\s)__", r"*\1*"),
+                (r"~~(?!\s)([^~\n]+?)(?<!\s)~~", r"~\1~"),
+                (r"\[([^\]]+?)\]\(([^)]+?)\)", r"<\2|\1>"),
+            ]:
+                part = re.sub(o, n, part)
+            result += part
+    return result
+
+
+EXAMPLES = [
+    "\n\n<@U123>: **Hello** *world* ***both*** __under__ ~~strike~~",
+    "```python\nprint('*not italic*')\n```\nand `*code*` [link](https://example.com)",
+    "```rust\npython\nsh\n```\n```C\nint x;\n```",
+    "```\npython\n```\n``` js\nlet a\n```",
+    "_***a***_ and __**b**__ and *a**b* and [**x**](http://x/*y*)",
+    "```` rust\nfoo\n```",
+    "`a```rust\nb`",
+]
+
+# 置換の対象になる記号を多めに含む文字列を作る
+TOKENS = [
+    "*", "**", "***", "_", "__", "~~", "`", "```", "[", "]", "(", ")", "](",
+    "\n", " ", "\t", "<@U1>", ":", "a", "b", "word", "python", "rust", "sh",
+    "C", "JavaScript", "http://x",
+]  # fmt: skip
+
+
+def _random_text(rng: random.Random) -> str:
+    return "".join(rng.choice(TOKENS) for _ in range(rng.randint(0, 40)))
+
+
+def test_format_matches_legacy_examples():
+    for text in EXAMPLES:
+        assert format_assistant_reply(text) == legacy_format_assistant_reply(text)
+        assert markdown_to_slack(text) == legacy_markdown_to_slack(text)
+
+
+def test_format_matches_legacy_random():
+    rng = random.Random(0)
+    for _ in range(5000):
+        text = _random_text(rng)
+        assert format_assistant_reply(text) == legacy_format_assistant_reply(text), text
+        assert markdown_to_slack(text) == legacy_markdown_to_slack(text), text
+
+
+def test_format_stream_matches_whole():
+    rng = random.Random(1)
+    for text in EXAMPLES + [_random_text(rng) for _ in range(3000)]:
+        stream = SlackFormatStream()
+        result = []
+        position = 0
+        while position < len(text):
+            step = rng.randint(1, 8)
+            result.append(stream.feed(text[position : position + step]))
+            position += step
+        result.append(stream.finish())
+
+        assert "".join(result) == legacy_format_assistant_reply(text), text
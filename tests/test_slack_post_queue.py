@@ -0,0 +1,78 @@
+import time
+
+
+def test_slack_post_queue_keeps_order():
+    from suisei.slack_post_queue import SlackPostQueue
+
+    queue = SlackPostQueue(rate=1000, burst=1)
+    posted = []
+
+    futures = [queue.submit("C1", lambda i=i: posted.append(i) or i) for i in range(20)]
+
+    assert [future.result(timeout=5) for future in futures] == list(range(20))
+    assert posted == list(range(20))
+
+
+def test_slack_post_queue_retry_after():
+    from slack_sdk.errors import SlackApiError
+    from slack_sdk.web import SlackResponse
+    from suisei.slack_post_queue import SlackPostQueue
+
+    queue = SlackPostQueue(rate=1000, burst=1)
+    calls = []
+
+    def post():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            response = SlackResponse(
+                client=None,
+                http_verb="POST",
+                api_url="https://slack.com/api/chat.postMessage",
+                req_args={},
+                data={"ok": False, "error": "ratelimited"},
+                headers={"Retry-After": "1"},
+                status_code=429,
+            )
+            raise SlackApiError("ratelimited", response)
+        return "ok"
+
+    assert queue.submit("C1", post).result(timeout=5) == "ok"
+    assert calls[1] - calls[0] >= 1
+
+
+def test_slack_post_queue_evicts_idle_bucket(monkeypatch):
+    import suisei.slack_post_queue as slack_post_queue
+    from suisei.slack_post_queue import SlackPostQueue
+
+    monkeypatch.setattr(slack_post_queue, "WORKER_IDLE_SECONDS", 0.1)
+    queue = SlackPostQueue(rate=1000, burst=1)
+
+    assert queue.submit("C1", lambda: "ok").result(timeout=5) == "ok"
+    assert "C1" in queue._buckets
+
+    deadline = time.monotonic() + 5
+    while "C1" in queue._queues and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert "C1" not in queue._queues
+    assert "C1" not in queue._buckets
+
+
+def test_async_slack_post_queue_keeps_order():
+    import asyncio
+    from suisei.slack_post_queue import AsyncSlackPostQueue
+
+    posted = []
+
+    async def post(i):
+        await asyncio.sleep(0)
+        posted.append(i)
+        return i
+
+    async def run():
+        queue = AsyncSlackPostQueue(rate=1000, burst=1)
+        futures = [queue.submit("C1", lambda i=i: post(i)) for i in range(20)]
+        return await asyncio.gather(*futures)
+
+    assert asyncio.run(run()) == list(range(20))
+    assert posted == list(range(20))
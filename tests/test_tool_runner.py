@@ -0,0 +1,94 @@
+import time
+
+from google.genai.types import FunctionCall
+
+from suisei.tool_runner import TRUNCATED_MARKER, ToolRunner
+
+
+def _responses(content) -> list:
+    return [part.function_response.response for part in content.parts]
+
+
+def test_tool_runner_runs_calls_in_parallel():
+    def slow(value: str) -> str:
+        time.sleep(0.2)
+        return value
+
+    runner = ToolRunner({"slow": slow}, max_workers=4)
+    calls = [FunctionCall(name="slow", args={"value": str(i)}) for i in range(4)]
+
+    started_at = time.monotonic()
+    content = runner.run(calls)
+
+    assert time.monotonic() - started_at < 0.6
+    assert _responses(content) == [{"result": str(i)} for i in range(4)]
+
+
+def test_tool_runner_errors_and_truncation():
+    def fail():
+        raise RuntimeError("failed")
+
+    def sleep():
+        time.sleep(1)
+
+    runner = ToolRunner(
+        {"fail": fail, "large": lambda: b"a" * 100, "sleep": sleep},
+        timeout=0.1,
+        max_result_chars=10,
+    )
+    content = runner.run(
+        [
+            FunctionCall(name="fail", args={}),
+            FunctionCall(name="large", args={}),
+            FunctionCall(name="sleep", args={}),
+            FunctionCall(name="unknown", args={}),
+        ]
+    )
+
+    fail_response, large_response, sleep_response, unknown_response = _responses(
+        content
+    )
+    assert fail_response == {"error": "failed"}
+    assert large_response == {"result": "a" * 10 + TRUNCATED_MARKER}
+    assert "Timed out" in sleep_response["error"]
+    assert "Unknown function" in unknown_response["error"]
+
+
+def test_tool_runner_caches_results():
+    called = []
+
+    def count(value: str) -> str:
+        called.append(value)
+        return value
+
+    runner = ToolRunner({"count": count})
+    runner.run([FunctionCall(name="count", args={"value": "a"})])
+    runner.run([FunctionCall(name="count", args={"value": "a"})])
+    runner.run([FunctionCall(name="count", args={"value": "b"})])
+
+    assert called == ["a", "b"]
+
+
+def test_tool_runner_stops_timed_out_calls():
+    import threading
+
+    from suisei.tool_runner import check_deadline
+
+    stopped = threading.Event()
+
+    def loop():
+        try:
+            while True:
+                check_deadline()
+                time.sleep(0.01)
+        finally:
+            stopped.set()
+
+    runner = ToolRunner({"loop": loop}, timeout=0.1)
+    content = runner.run([FunctionCall(name="loop", args={})])
+
+    assert "Timed out" in _responses(content)[0]["error"]
+    # 時間切れになった呼び出しはスレッドでも止まり、プールを使い続けない
+    assert stopped.wait(1)
+    # プールの外では期限はない
+    check_deadline()
@@ -0,0 +1,20 @@
+import os
+
+# suisei.envは読み込み時に必須の設定を確認するため、先に設定しておく
+os.environ.setdefault("GEMINI_SYSTEM_TEXT", "test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+
+def test_create_valkey_with_client_cache(monkeypatch):
+    from suisei import valkey_client
+
+    monkeypatch.setattr(valkey_client, "VALKEY_CLIENT_CACHE", True)
+    valkey = valkey_client.create_valkey()
+
+    # 接続せずにコネクションを作り、キャッシュの設定を受け付けることを確認する
+    pool = valkey.connection_pool
+    connection = pool.make_connection()
+    assert pool.connection_kwargs["cache_enabled"] is True
+    assert connection.protocol == 3
+    assert connection.client_cache is not None
+    connection.disconnect()